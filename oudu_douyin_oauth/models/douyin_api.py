@@ -19,7 +19,7 @@ class DouyinAPI(models.Model):
             _logger.info('开始获取用户公开信息: open_id=%s', open_id)
 
             # 构建请求URL
-            url = "https://open.douyin.com/api/douyin/v1/user/user_info/"
+            url = f"{config._get_api_base_url()}/api/douyin/v1/user/user_info/"
 
             # 构建请求参数
             params = {
@@ -95,7 +95,7 @@ class DouyinAPI(models.Model):
     def get_access_token(self, config, auth_code):
         """使用授权码获取access_token"""
         try:
-            url = "https://open.douyin.com/oauth/access_token/"
+            url = f"{config._get_api_base_url()}/oauth/access_token/"
             data = {
                 'client_key': config.client_key,
                 'client_secret': config.client_secret,
@@ -98,7 +98,7 @@ class DouyinAuth(models.Model):
     def refresh_access_token(self, config, refresh_token):
         """刷新Access Token"""
         try:
-            url = "https://open.douyin.com/oauth/refresh_token/"
+            url = f"{config._get_api_base_url()}/oauth/refresh_token/"
             data = {
                 'client_key': config.client_key,
                 'client_secret': config.client_secret,
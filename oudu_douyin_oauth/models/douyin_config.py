@@ -7,6 +7,9 @@ from odoo.exceptions import ValidationError, UserError
 
 _logger = logging.getLogger(__name__)
 
+# 抖音开放平台接口默认地址，可通过系统参数 oudu_douyin_oauth.api_base_url 覆盖(如指向本地模拟服务)
+DOUYIN_API_BASE_URL = 'https://open.douyin.com'
+
 
 class DouyinConfig(models.Model):
     """抖音开放平台配置模型 """
@@ -53,6 +56,12 @@ class DouyinConfig(models.Model):
         """获取默认配置"""
         return self.search([('active', '=', True)], limit=1)
 
+    @api.model
+    def _get_api_base_url(self):
+        """抖音开放平台接口地址，未配置系统参数时使用官方地址"""
+        return (self.env['ir.config_parameter'].sudo().get_param(
+            'oudu_douyin_oauth.api_base_url') or DOUYIN_API_BASE_URL).rstrip('/')
+
     @api.constrains('redirect_uri')
     def _check_redirect_uri(self):
         """验证回调地址格式"""
@@ -13,6 +13,9 @@ from datetime import datetime, timedelta
 
 _logger = logging.getLogger(__name__)
 
+# 微信接口默认地址，可通过系统参数 oudu_wechat_login.api_base_url 覆盖(如指向本地模拟服务)
+WECHAT_API_BASE_URL = 'https://api.weixin.qq.com'
+
 
 class WechatConfig(models.Model):
     _name = 'wechat.sso.config'
@@ -107,6 +110,12 @@ class WechatConfig(models.Model):
             _logger.error("查询微信配置时发生异常: %s", str(e))
             raise
 
+    @api.model
+    def _get_api_base_url(self):
+        """微信接口地址，未配置系统参数时使用官方地址"""
+        return (self.env['ir.config_parameter'].sudo().get_param(
+            'oudu_wechat_login.api_base_url') or WECHAT_API_BASE_URL).rstrip('/')
+
     def get_wechat_access_token(self):
         """使用稳定版接口获取 token (适配微信最新要求)"""
         self.ensure_one()
@@ -123,7 +132,7 @@ class WechatConfig(models.Model):
                 _logger.error("解析过期时间失败: %s", str(e))
 
         # 调用稳定版接口
-        url = "https://api.weixin.qq.com/cgi-bin/stable_token"
+        url = f"{self._get_api_base_url()}/cgi-bin/stable_token"
         data = {
             "grant_type": "client_credential",
             "appid": self.app_id,
@@ -64,7 +64,7 @@ class ResUsers(models.Model):
 
         try:
             # 1. 通过code获取access_token和openid
-            token_url = "https://api.weixin.qq.com/sns/oauth2/access_token"
+            token_url = f"{config._get_api_base_url()}/sns/oauth2/access_token"
             token_params = {
                 'appid': config.app_id,
                 'secret': config.app_secret,
@@ -85,7 +85,7 @@ class ResUsers(models.Model):
             wechat_user_id = openid  # 使用openid作为微信用户ID
 
             # 2. 获取用户信息
-            user_info_url = "https://api.weixin.qq.com/sns/userinfo"
+            user_info_url = f"{config._get_api_base_url()}/sns/userinfo"
             user_info_params = {
                 'access_token': access_token,
                 'openid': openid,
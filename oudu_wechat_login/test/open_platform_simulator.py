@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+"""
+微信 / 抖音开放平台本地模拟服务
+
+用于离线压测群发和登录流程，只依赖标准库。启动后将系统参数
+oudu_wechat_login.api_base_url 和 oudu_douyin_oauth.api_base_url 设置为本服务地址即可：
+
+    python open_platform_simulator.py --port 8900 --latency 0.05 --error-rate 0.01 --throttle-rate 0.02
+
+支持的接口：
+    GET  /sns/oauth2/access_token          网页授权code换取access_token
+    GET  /sns/userinfo                     网页授权用户信息
+    POST /cgi-bin/stable_token             稳定版接口调用凭证
+    POST /cgi-bin/message/template/send    模板消息发送
+    GET  /cgi-bin/user/get                 关注用户列表
+    POST /cgi-bin/user/info/batchget       批量获取用户信息
+    POST /oauth/access_token/              抖音授权码换取access_token
+    POST /oauth/refresh_token/             抖音刷新access_token
+    GET  /api/douyin/v1/user/user_info/    抖音用户公开信息
+    GET  /_stats                           各接口调用统计
+"""
+import argparse
+import hashlib
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+
+_logger = logging.getLogger(__name__)
+
+
+class SimulatorState:
+    """模拟服务的共享状态：已签发的token、消息ID计数、接口统计和限流桶"""
+
+    def __init__(self, options):
+        self.options = options
+        self.lock = threading.Lock()
+        self.tokens = {}
+        self.stable_token = None
+        self.msgid = 0
+        self.stats = {}
+        self.bucket = float(options.max_qps or 0)
+        self.bucket_time = time.monotonic()
+        self.openids = [self.make_openid(f'user{i}') for i in range(options.users)]
+
+    @staticmethod
+    def make_openid(seed):
+        return 'o' + hashlib.md5(seed.encode('utf-8')).hexdigest()[:27]
+
+    def issue_token(self):
+        token = uuid.uuid4().hex
+        with self.lock:
+            self.tokens[token] = time.time() + self.options.token_ttl
+        return token
+
+    def get_stable_token(self, force_refresh=False):
+        with self.lock:
+            token = self.stable_token
+            if token and not force_refresh and self.tokens.get(token, 0) > time.time():
+                return token, int(self.tokens[token] - time.time())
+        token = self.issue_token()
+        with self.lock:
+            self.stable_token = token
+        return token, self.options.token_ttl
+
+    def check_token(self, token):
+        """返回token对应的错误码，0表示有效"""
+        with self.lock:
+            expires = self.tokens.get(token)
+        if not token:
+            return 41001
+        if expires is None:
+            return 40001
+        if expires <= time.time():
+            return 42001
+        if random.random() < self.options.token_invalid_rate:
+            with self.lock:
+                self.tokens.pop(token, None)
+            return 40001
+        return 0
+
+    def next_msgid(self):
+        with self.lock:
+            self.msgid += 1
+            return self.msgid
+
+    def count(self, path, errcode):
+        with self.lock:
+            stat = self.stats.setdefault(path, {'total': 0, 'errors': {}})
+            stat['total'] += 1
+            if errcode:
+                stat['errors'][str(errcode)] = stat['errors'].get(str(errcode), 0) + 1
+
+    def take_quota(self):
+        """全局每秒请求上限，超出时返回False"""
+        if not self.options.max_qps:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.bucket = min(self.options.max_qps,
+                              self.bucket + (now - self.bucket_time) * self.options.max_qps)
+            self.bucket_time = now
+            if self.bucket < 1:
+                return False
+            self.bucket -= 1
+            return True
+
+
+class SimulatorHandler(BaseHTTPRequestHandler):
+    """按路径分发到各接口的处理方法"""
+
+    server_version = 'OpenPlatformSimulator/1.0'
+    protocol_version = 'HTTP/1.1'
+
+    routes = {
+        ('GET', '/sns/oauth2/access_token'): 'wechat_oauth_access_token',
+        ('GET', '/sns/userinfo'): 'wechat_sns_userinfo',
+        ('POST', '/cgi-bin/stable_token'): 'wechat_stable_token',
+        ('POST', '/cgi-bin/message/template/send'): 'wechat_template_send',
+        ('GET', '/cgi-bin/user/get'): 'wechat_user_get',
+        ('POST', '/cgi-bin/user/info/batchget'): 'wechat_user_batchget',
+        ('POST', '/oauth/access_token/'): 'douyin_access_token',
+        ('POST', '/oauth/refresh_token/'): 'douyin_access_token',
+        ('GET', '/api/douyin/v1/user/user_info/'): 'douyin_user_info',
+        ('GET', '/_stats'): 'simulator_stats',
+    }
+
+    @property
+    def state(self) -> SimulatorState:
+        return self.server.state
+
+    def log_message(self, format, *args):
+        _logger.debug(format, *args)
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def _dispatch(self, method):
+        parts = urlsplit(self.path)
+        self.query = dict(parse_qsl(parts.query))
+        self.body = self._read_body()
+        handler = self.routes.get((method, parts.path))
+        if not handler:
+            return self._send_json({'errcode': 404, 'errmsg': 'not found'}, status=404)
+
+        options = self.state.options
+        if options.latency or options.jitter:
+            time.sleep(max(0.0, options.latency + random.uniform(-options.jitter, options.jitter)))
+
+        douyin = parts.path.startswith(('/oauth/', '/api/douyin/'))
+        if parts.path != '/_stats':
+            errcode = self._simulate_failure()
+            if errcode:
+                self.state.count(parts.path, errcode)
+                return self._send_error(errcode, douyin)
+
+        result = getattr(self, handler)()
+        errcode = result.get('errcode') or result.get('data', {}).get('error_code')
+        self.state.count(parts.path, errcode)
+        self._send_json(result)
+
+    def _simulate_failure(self):
+        """按配置的概率返回系统繁忙或限流错误码"""
+        options = self.state.options
+        if not self.state.take_quota():
+            return options.throttle_errcodes[0]
+        roll = random.random()
+        if roll < options.error_rate:
+            return -1
+        if roll < options.error_rate + options.throttle_rate:
+            return random.choice(options.throttle_errcodes)
+        return 0
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        if not raw:
+            return {}
+        if 'application/x-www-form-urlencoded' in (self.headers.get('Content-Type') or ''):
+            return dict(parse_qsl(raw.decode('utf-8')))
+        try:
+            return json.loads(raw.decode('utf-8'))
+        except ValueError:
+            return dict(parse_qsl(raw.decode('utf-8')))
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, errcode, douyin=False):
+        errmsg = 'system error' if errcode == -1 else 'api freq out of limit'
+        if douyin:
+            return self._send_json({'data': {'error_code': errcode, 'description': errmsg}, 'message': 'error'})
+        return self._send_json({'errcode': errcode, 'errmsg': errmsg})
+
+    # 微信接口
+    def wechat_oauth_access_token(self):
+        code = self.query.get('code')
+        if not code:
+            return {'errcode': 40029, 'errmsg': 'invalid code'}
+        openid = self.state.make_openid(code)
+        return {
+            'access_token': self.state.issue_token(),
+            'expires_in': self.state.options.token_ttl,
+            'refresh_token': uuid.uuid4().hex,
+            'openid': openid,
+            'scope': 'snsapi_userinfo',
+            'unionid': 'u' + openid[1:],
+        }
+
+    def wechat_sns_userinfo(self):
+        errcode = self.state.check_token(self.query.get('access_token'))
+        if errcode:
+            return {'errcode': errcode, 'errmsg': 'invalid access_token'}
+        openid = self.query.get('openid') or ''
+        return self._wechat_user(openid)
+
+    def wechat_stable_token(self):
+        if not self.body.get('appid') or not self.body.get('secret'):
+            return {'errcode': 40013, 'errmsg': 'invalid appid'}
+        token, expires_in = self.state.get_stable_token(bool(self.body.get('force_refresh')))
+        return {'access_token': token, 'expires_in': expires_in}
+
+    def wechat_template_send(self):
+        errcode = self.state.check_token(self.query.get('access_token'))
+        if errcode:
+            return {'errcode': errcode, 'errmsg': 'invalid credential, access_token is invalid or not latest'}
+        if not self.body.get('touser'):
+            return {'errcode': 40003, 'errmsg': 'invalid openid'}
+        if not self.body.get('template_id'):
+            return {'errcode': 40037, 'errmsg': 'invalid template_id'}
+        return {'errcode': 0, 'errmsg': 'ok', 'msgid': self.state.next_msgid()}
+
+    def wechat_user_get(self):
+        errcode = self.state.check_token(self.query.get('access_token'))
+        if errcode:
+            return {'errcode': errcode, 'errmsg': 'invalid access_token'}
+        openids = self.state.openids
+        start = openids.index(self.query['next_openid']) + 1 if self.query.get('next_openid') in openids else 0
+        page = openids[start:start + 10000]
+        return {
+            'total': len(openids),
+            'count': len(page),
+            'data': {'openid': page},
+            'next_openid': page[-1] if page else '',
+        }
+
+    def wechat_user_batchget(self):
+        errcode = self.state.check_token(self.query.get('access_token'))
+        if errcode:
+            return {'errcode': errcode, 'errmsg': 'invalid access_token'}
+        user_list = self.body.get('user_list') or []
+        if len(user_list) > 100:
+            return {'errcode': 45035, 'errmsg': 'user_list size out of limit'}
+        return {'user_info_list': [
+            dict(self._wechat_user(item.get('openid', '')), subscribe=1, subscribe_time=int(time.time()))
+            for item in user_list
+        ]}
+
+    @staticmethod
+    def _wechat_user(openid):
+        return {
+            'openid': openid,
+            'nickname': f'模拟用户{openid[-6:]}',
+            'sex': 0,
+            'province': '',
+            'city': '',
+            'country': '中国',
+            'headimgurl': '',
+            'privilege': [],
+            'unionid': 'u' + openid[1:],
+        }
+
+    # 抖音接口
+    def douyin_access_token(self):
+        seed = self.body.get('code') or self.body.get('refresh_token')
+        if not seed:
+            return {'data': {'error_code': 10007, 'description': 'code is invalid'}, 'message': 'error'}
+        return {
+            'data': {
+                'error_code': 0,
+                'description': '',
+                'access_token': self.state.issue_token(),
+                'expires_in': self.state.options.token_ttl,
+                'refresh_token': uuid.uuid4().hex,
+                'refresh_expires_in': 2592000,
+                'open_id': self.state.make_openid(seed),
+                'scope': 'user_info',
+            },
+            'message': 'success',
+        }
+
+    def douyin_user_info(self):
+        errcode = self.state.check_token(self.query.get('access_token'))
+        if errcode:
+            return {'data': {'error_code': 2190008, 'description': 'access_token expired'}, 'message': 'error'}
+        open_id = self.query.get('open_id') or ''
+        return {
+            'data': {
+                'error_code': 0,
+                'description': '',
+                'open_id': open_id,
+                'union_id': 'u' + open_id[1:],
+                'nickname': f'抖音模拟用户{open_id[-6:]}',
+                'avatar': '',
+            },
+            'message': 'success',
+        }
+
+    def simulator_stats(self):
+        with self.state.lock:
+            return {'stats': json.loads(json.dumps(self.state.stats)), 'msgid': self.state.msgid}
+
+
+def build_server(options):
+    server = ThreadingHTTPServer((options.host, options.port), SimulatorHandler)
+    server.daemon_threads = True
+    server.state = SimulatorState(options)
+    return server
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='微信/抖音开放平台本地模拟服务')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--latency', type=float, default=0.0, help='每个请求的平均延迟(秒)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='延迟的随机浮动范围(秒)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='返回errcode=-1系统繁忙的概率')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='返回限流错误码的概率')
+    parser.add_argument('--throttle-errcodes', type=lambda v: [int(c) for c in v.split(',')],
+                        default=[45009], help='限流错误码，逗号分隔，如 45009,45011,45047')
+    parser.add_argument('--max-qps', type=float, default=0.0, help='全局每秒请求上限，超出返回限流错误码，0表示不限')
+    parser.add_argument('--token-ttl', type=int, default=7200, help='签发token的有效期(秒)')
+    parser.add_argument('--token-invalid-rate', type=float, default=0.0,
+                        help='有效token被随机作废并返回40001的概率，用于测试发送中途token失效')
+    parser.add_argument('--users', type=int, default=1000, help='user/get返回的模拟关注用户数')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    options = parse_args(argv)
+    server = build_server(options)
+    _logger.info("开放平台模拟服务已启动: http://%s:%s", options.host, options.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -368,7 +368,7 @@ class WechatQRLoginController(http.Controller):
         """获取微信用户信息"""
         try:
             # 第一步：通过code获取access_token
-            token_url = "https://api.weixin.qq.com/sns/oauth2/access_token"
+            token_url = f"{config._get_api_base_url()}/sns/oauth2/access_token"
             token_params = {
                 'appid': config.app_id,
                 'secret': config.app_secret,
@@ -384,7 +384,7 @@ class WechatQRLoginController(http.Controller):
                 return None
 
             # 第二步：通过access_token获取用户信息
-            user_info_url = "https://api.weixin.qq.com/sns/userinfo"
+            user_info_url = f"{config._get_api_base_url()}/sns/userinfo"
             user_info_params = {
                 'access_token': token_data['access_token'],
                 'openid': token_data['openid'],
@@ -6,7 +6,7 @@
         该模块提供独立的微信服务号消息发送服务，其他模块可以调用其公共方法发送模板消息。
         包含完整的消息存储、权限控制和运营分析功能。        
     """,
-    "version": "18.0.3.0",
+    "version": "18.0.3.1",
     'author': 'DuodooTEKr多度科技',
     'phone': '18951631470',
     'email': 'zou.jason@qq.com',
@@ -19,19 +19,28 @@
         'web',
         'website',
         'auth_oauth',
+        'bus',
         'oudu_wechat_login'
     ],
     "data": [
         'security/security_rules.xml',
         'security/ir.model.access.csv',
         'data/sequence_data.xml',
+        'data/ir_cron_data.xml',
         'views/wechat_message_views.xml',
         'views/wechat_user_message_views.xml',
+        'views/wechat_sso_config_views.xml',
+        'views/wechat_audience_segment_views.xml',
         'views/templates.xml',
     ],
     "assets": {
         "web.assets_frontend": [
             # 'oudu_wechat_message/static/src/css/style.css',
+            'oudu_wechat_message/static/src/js/message_inbox.js',
+        ],
+        "web.assets_backend": [
+            'oudu_wechat_message/static/src/js/send_progress_widget.js',
+            'oudu_wechat_message/static/src/xml/send_progress_widget.xml',
         ],
     },
     'images': [
@@ -9,11 +9,25 @@
 from odoo import http, _
 from odoo.http import request, Response
 from odoo.exceptions import AccessError, MissingError, UserError
+from odoo.addons.oudu_wechat_message.utils.event_crypto import EventCryptoError
+from datetime import datetime
+from lxml import etree
+import hmac
+import json
 import logging
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Tuple
 
 _logger = logging.getLogger(__name__)
 
+# 批量接入：每次请求最多接收的通知数、每次批量入队的数量、单行/请求体大小上限(字节)
+INGEST_MAX_ITEMS = 10000
+INGEST_CHUNK_SIZE = 500
+INGEST_MAX_LINE_BYTES = 64 * 1024
+INGEST_MAX_BODY_BYTES = 32 * 1024 * 1024
+# 外部系统可以填写的消息字段，其余字段忽略
+INGEST_TEXT_FIELDS = ('report_title', 'report_type', 'report_target', 'report_content', 'redirect_url')
+INGEST_MESSAGE_TYPES = ('system_notification', 'business_report', 'alert_warning', 'custom_message')
+
 
 class WechatMessageController(http.Controller):
 
@@ -80,38 +94,251 @@ class WechatMessageController(http.Controller):
             })
 
     @http.route('/wechat/message/list', type='http', auth='user', website=True)
-    def wechat_message_list(self, **kw):
-        """用户消息列表页面"""
+    def wechat_message_list(self, before=None, limit=20, **kw):
+        """用户消息列表页面
+
+        按游标分页：before 为上一页末尾的游标，limit 为每页数量(最多100)。
+        请求头带 X-Requested-With 时只返回列表片段，用于无限滚动追加。
+        """
         try:
-            # 获取用户有权限查看的消息
-            user_messages = self._get_user_accessible_messages(request.env.user)
+            try:
+                limit = max(1, min(100, int(limit)))
+            except (TypeError, ValueError):
+                limit = 20
+            user_message_model = request.env['wechat.user.message'].sudo()
+            items, next_cursor = user_message_model._get_inbox_page(
+                request.env.user.id, limit=limit, before=self._parse_inbox_cursor(before))
+            values = {
+                'items': items,
+                'next_url': f'/wechat/message/list?before={self._format_inbox_cursor(next_cursor)}&limit={limit}'
+                            if next_cursor else None,
+                'user': request.env.user,
+            }
+            if request.httprequest.headers.get('X-Requested-With') == 'XMLHttpRequest':
+                return request.render('oudu_wechat_message.message_list_items', values)
+
+            values['unread_count'] = user_message_model._count_unread(request.env.user.id)
+            return request.render('oudu_wechat_message.message_list_template', values)
+
+        except Exception as e:
+            _logger.error(f"消息列表页异常: {str(e)}")
+            return request.render('oudu_wechat_message.error_template', {
+                'error_message': _('系统异常')
+            })
+
+    @http.route('/wechat/message/digest/<int:digest_id>', type='http', auth='user', website=True)
+    def wechat_message_digest(self, digest_id: int, **kw):
+        """合并摘要详情页面，列出摘要中合并的所有消息"""
+        try:
+            digest = request.env['wechat.message.digest'].sudo().browse(digest_id)
+            if not digest.exists() or digest.user_id != request.env.user:
+                return request.render('oudu_wechat_message.access_denied_template', {
+                    'error_message': _('您没有权限查看此消息')
+                })
+
+            for message in digest.message_ids:
+                self._update_message_open_stats(message.id, request.env.user)
 
-            return request.render('oudu_wechat_message.message_list_template', {
-                'messages': user_messages,
+            return request.render('oudu_wechat_message.message_digest_template', {
+                'digest': digest,
+                'messages': digest.message_ids.sorted('id', reverse=True),
                 'user': request.env.user
             })
 
         except Exception as e:
-            _logger.error(f"消息列表页异常: {str(e)}")
+            _logger.error(f"消息摘要页异常: {str(e)}")
             return request.render('oudu_wechat_message.error_template', {
                 'error_message': _('系统异常')
             })
 
-    def _log_message_click(self, message_id: int, request) -> None:
-        """记录消息点击行为"""
+    @http.route('/wechat/message/event/<int:config_id>', type='http', auth='public',
+                methods=['GET', 'POST'], csrf=False, save_session=False)
+    def wechat_message_event(self, config_id: int, **kw):
+        """公众号服务器配置的事件推送入口
+
+        GET 为接入验证，校验签名后原样返回 echostr；POST 为事件推送，支持明文和安全模式。
+        模板消息送达事件(TEMPLATESENDJOBFINISH)只追加到回执缓冲，由定时任务批量写回。
+        """
+        config = request.env['wechat.sso.config'].sudo().browse(config_id)
+        if not config.exists():
+            return Response('not found', status=404)
+        timestamp, nonce = kw.get('timestamp', ''), kw.get('nonce', '')
+
         try:
-            # 查找对应的用户消息记录
-            user_message = request.env['wechat.user.message'].sudo().search([
-                ('wechat_message_id', '=', message_id),
-                ('user_id.wechat_openid', '=', request.params.get('openid'))
-            ], limit=1)
+            crypto = config._get_event_crypto()
+            if request.httprequest.method == 'GET':
+                if crypto.check_signature(kw.get('signature'), timestamp, nonce):
+                    return Response(kw.get('echostr', ''), content_type='text/plain')
+                return Response('invalid signature', status=403)
+
+            root = self._parse_event_xml(request.httprequest.get_data())
+            encrypt = root.findtext('Encrypt')
+            if kw.get('encrypt_type') == 'aes' and encrypt:
+                if not crypto.check_signature(kw.get('msg_signature'), timestamp, nonce, encrypt):
+                    return Response('invalid signature', status=403)
+                root = self._parse_event_xml(crypto.decrypt(encrypt).encode())
+            elif not crypto.check_signature(kw.get('signature'), timestamp, nonce):
+                return Response('invalid signature', status=403)
+
+            if root.findtext('MsgType') == 'event' and root.findtext('Event') == 'TEMPLATESENDJOBFINISH':
+                request.env['wechat.message.receipt'].sudo().record_receipt(
+                    root.findtext('MsgID'), root.findtext('Status'))
+
+        except (etree.XMLSyntaxError, EventCryptoError) as e:
+            _logger.warning(f"无效的微信事件推送 配置ID {config_id}: {str(e)}")
+            return Response('invalid payload', status=400)
+
+        # 微信要求5秒内回复，success 表示不需要被动回复消息
+        return Response('success', content_type='text/plain')
+
+    @http.route('/wechat/message/ingest/<int:config_id>', type='http', auth='public',
+                methods=['POST'], csrf=False, save_session=False)
+    def wechat_message_ingest(self, config_id: int, **kw):
+        """外部系统批量推送通知的入口
+
+        请求头 Authorization: Bearer <批量接入Token>；请求体为 NDJSON(每行一条)或 JSON 数组，
+        每条通知包含 report_title/report_type/report_target/report_content，可选 redirect_url、
+        message_type 和 segment_id。通知逐条校验后按块批量创建并写入发送队列，立即返回消息ID，
+        不等待发送。发送队列积压超过上限时返回 429 和 Retry-After，调用方应等待后重发整批。
+        """
+        config = request.env['wechat.sso.config'].sudo().browse(config_id)
+        if not config.exists() or not config.ingest_token:
+            return request.make_json_response({'error': 'not found'}, status=404)
+        authorization = request.httprequest.headers.get('Authorization', '')
+        token = authorization[7:] if authorization.startswith('Bearer ') else ''
+        if not hmac.compare_digest(token.encode(), config.ingest_token.encode()):
+            return request.make_json_response({'error': 'invalid token'}, status=401)
+
+        retry_after = config._get_ingest_retry_after()
+        if retry_after:
+            return request.make_json_response(
+                {'error': 'outbox saturated', 'retry_after': retry_after},
+                headers=[('Retry-After', str(retry_after))], status=429)
 
-            if user_message:
-                user_message.mark_as_clicked()
+        try:
+            items = self._iter_ingest_items(request.httprequest)
+            result = self._enqueue_ingest_items(config, items)
+        except (ValueError, OverflowError) as e:
+            # 请求体格式错误或超出限制时整批不入队，调用方修正后可以直接重发
+            request.env.cr.rollback()
+            return request.make_json_response({'error': str(e)},
+                                              status=413 if isinstance(e, OverflowError) else 400)
+
+        _logger.info(f"批量接入通知 配置ID {config_id}: 入队 {result['accepted']}, 拒绝 {result['rejected']}")
+        return request.make_json_response(result, status=202)
+
+    def _iter_ingest_items(self, httprequest):
+        """逐条读取请求体中的通知，NDJSON 按行流式解析，JSON 数组整体解析"""
+        if (httprequest.content_length or 0) > INGEST_MAX_BODY_BYTES:
+            raise OverflowError('request body too large')
+        if httprequest.mimetype in ('application/x-ndjson', 'application/jsonl', 'application/x-jsonlines'):
+            stream = httprequest.stream
+            while True:
+                line = stream.readline(INGEST_MAX_LINE_BYTES + 1)
+                if not line:
+                    break
+                if len(line) > INGEST_MAX_LINE_BYTES and not line.endswith(b'\n'):
+                    raise OverflowError('line too long')
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # 单行无法解析时只拒绝该行
+                    yield None
+        elif httprequest.mimetype == 'application/json':
+            try:
+                items = json.loads(httprequest.get_data(cache=False))
+            except ValueError:
+                raise ValueError('invalid JSON body')
+            if not isinstance(items, list):
+                raise ValueError('JSON body must be an array')
+            yield from items
+        else:
+            raise ValueError('unsupported content type, use application/x-ndjson or application/json')
+
+    def _enqueue_ingest_items(self, config, items) -> Dict[str, Any]:
+        """校验通知并按块调用批量发送接口入队，返回各条通知的处理结果"""
+        service = request.env['wechat.notification.service'].sudo()
+        ids: List[Optional[int]] = []
+        errors: List[Dict[str, Any]] = []
+        chunk: List[Tuple[int, Dict[str, Any]]] = []
+        segments: Dict[int, bool] = {}
+
+        def flush():
+            message_ids = service.create_and_send_many([vals for _index, vals in chunk])
+            for (index, _vals), message_id in zip(chunk, message_ids):
+                ids[index] = message_id
+                if not message_id:
+                    errors.append({'index': index, 'error': 'no target users or enqueue failed'})
+            chunk.clear()
+
+        for index, item in enumerate(items):
+            if index >= INGEST_MAX_ITEMS:
+                raise OverflowError(f'at most {INGEST_MAX_ITEMS} notifications per request')
+            ids.append(None)
+            vals, error = self._validate_ingest_item(config, item, segments)
+            if error:
+                errors.append({'index': index, 'error': error})
+                continue
+            chunk.append((index, vals))
+            if len(chunk) >= INGEST_CHUNK_SIZE:
+                flush()
+        if chunk:
+            flush()
+
+        errors.sort(key=lambda error: error['index'])
+        accepted = sum(1 for message_id in ids if message_id)
+        return {'accepted': accepted, 'rejected': len(ids) - accepted, 'ids': ids, 'errors': errors}
+
+    @staticmethod
+    def _validate_ingest_item(config, item, segments: Dict[int, bool]) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+        """校验单条通知，返回 (消息字段, 错误信息)；segments 缓存本次请求中已检查过的受众分组"""
+        if not isinstance(item, dict):
+            return None, 'notification must be a JSON object'
+        vals = {'wechat_config_id': config.id}
+        for field in INGEST_TEXT_FIELDS:
+            value = item.get(field)
+            if value is None:
+                continue
+            if not isinstance(value, str):
+                return None, f'{field} must be a string'
+            vals[field] = value
+        missing = [field for field in INGEST_TEXT_FIELDS[:4] if not vals.get(field)]
+        if missing:
+            return None, f"missing required fields: {', '.join(missing)}"
+        if 'message_type' in item:
+            if item['message_type'] not in INGEST_MESSAGE_TYPES:
+                return None, 'invalid message_type'
+            vals['message_type'] = item['message_type']
+        if item.get('segment_id') is not None:
+            segment_id = item['segment_id']
+            if not isinstance(segment_id, int) or isinstance(segment_id, bool):
+                return None, 'invalid segment_id'
+            if segment_id not in segments:
+                segments[segment_id] = bool(config.env['wechat.audience.segment'].browse(segment_id).exists())
+            if not segments[segment_id]:
+                return None, 'invalid segment_id'
+            vals['segment_id'] = segment_id
+        return vals, None
+
+    @staticmethod
+    def _parse_event_xml(data: bytes):
+        """解析事件推送XML，不解析外部实体"""
+        parser = etree.XMLParser(resolve_entities=False, no_network=True)
+        return etree.fromstring(data, parser=parser)
 
-                # 更新总点击次数
-                message = request.env['wechat.message'].sudo().browse(message_id)
-                message.write({'open_count': message.open_count + 1})
+    def _log_message_click(self, message_id: int, request) -> None:
+        """记录消息点击行为
+
+        只追加一条点击事件，计数由定时任务批量累加，跳转请求不更新消息记录。
+        """
+        try:
+            user = request.env.user
+            user_id = user.id if user and user != request.website.user_id else None
+            request.env['wechat.message.click.event'].sudo().record_event(
+                message_id, user_id=user_id, openid=request.params.get('openid'))
 
         except Exception as e:
             _logger.error(f"记录点击行为失败: {str(e)}")
@@ -168,24 +395,28 @@ class WechatMessageController(http.Controller):
 
         return bool(user_message)
 
-    def _get_user_accessible_messages(self, user) -> List[Any]:
-        """获取用户可访问的消息列表"""
-        user_messages = request.env['wechat.user.message'].search([
-            ('user_id', '=', user.id)
-        ])
-
-        return user_messages.mapped('wechat_message_id')
+    @staticmethod
+    def _format_inbox_cursor(cursor: Tuple) -> str:
+        """收件箱游标编码为 URL 参数：发送时间_记录ID"""
+        send_time, user_message_id = cursor
+        return f"{send_time:%Y%m%d%H%M%S%f}_{user_message_id}"
+
+    @staticmethod
+    def _parse_inbox_cursor(value: Optional[str]) -> Optional[Tuple]:
+        """解析收件箱游标，无效时从第一页开始"""
+        if not value:
+            return None
+        try:
+            send_time, user_message_id = value.split('_', 1)
+            return datetime.strptime(send_time, '%Y%m%d%H%M%S%f'), int(user_message_id)
+        except ValueError:
+            return None
 
     def _update_message_open_stats(self, message_id: int, user) -> None:
-        """更新消息打开统计"""
+        """更新消息打开统计，与跳转相同写入点击事件缓冲"""
         try:
-            user_message = request.env['wechat.user.message'].search([
-                ('wechat_message_id', '=', message_id),
-                ('user_id', '=', user.id)
-            ], limit=1)
-
-            if user_message and user_message.state != 'clicked':
-                user_message.mark_as_clicked()
+            request.env['wechat.message.click.event'].sudo().record_event(
+                message_id, user_id=user.id, source='detail')
 
         except Exception as e:
-            _logger.error(f"更新消息统计失败: {str(e)}")
\ No newline at end of file
+            _logger.error(f"更新消息统计失败: {str(e)}")
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from odoo import api, SUPERUSER_ID
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+def migrate(cr, version):
+    """将已有数据的 wechat_user_message 转换为按发送时间分区的表，并删除多余的队列消费任务
+
+    已经是分区表时只补建索引和外键。
+    """
+    if not version:
+        return
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    _logger.info(f"从 {version} 升级，检查 wechat_user_message 分区")
+    env['wechat.user.message']._partition_table()
+    # 队列并发由分区进程池和 _trigger 提供，不再需要第二个消费任务(noupdate 记录不会被自动删除)
+    cron = env.ref('oudu_wechat_message.ir_cron_drain_outbox_2', raise_if_not_found=False)
+    if cron:
+        cron.unlink()
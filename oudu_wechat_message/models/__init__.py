@@ -1,5 +1,14 @@
 # -*- coding: utf-8 -*-
 
+from . import wechat_api_quota
 from . import wechat_message
 from . import wechat_user_message
 from . import wechat_notification_service
+from . import wechat_message_outbox
+from . import wechat_sso_config
+from . import wechat_audience_segment
+from . import wechat_message_digest
+from . import wechat_message_click_event
+from . import wechat_message_receipt
+from . import wechat_message_dead_letter
+from . import ir_websocket
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2025/09/23 10:33
+@Author  : Jason Zou
+@Email   : zou.jason@qq.com
+@Mobile  ：18951631470
+@Website: http://www.duodoo.tech
+"""
+from odoo import models
+
+PROGRESS_CHANNEL_PREFIX = 'wechat_message_progress_'
+
+
+class IrWebsocket(models.AbstractModel):
+    _inherit = 'ir.websocket'
+
+    def _build_bus_channel_list(self, channels):
+        """将前端订阅的 wechat_message_progress_<ID> 转换为消息记录频道 (消息, 'progress')
+
+        只有能读取该消息的用户才能订阅其发送进度，字符串频道本身不会被订阅。
+        """
+        channels = list(channels)
+        message_ids = []
+        for channel in list(channels):
+            if isinstance(channel, str) and channel.startswith(PROGRESS_CHANNEL_PREFIX):
+                channels.remove(channel)
+                suffix = channel[len(PROGRESS_CHANNEL_PREFIX):]
+                if suffix.isdigit():
+                    message_ids.append(int(suffix))
+        if message_ids:
+            messages = self.env['wechat.message'].browse(message_ids).exists()
+            channels.extend((message, 'progress') for message in messages if message.has_access('read'))
+        return super()._build_bus_channel_list(channels)
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2025/09/23 10:33
+@Author  : Jason Zou
+@Email   : zou.jason@qq.com
+@Mobile  ：18951631470
+@Website: http://www.duodoo.tech
+"""
+from odoo import models, fields, api, _
+from datetime import datetime, time as dt_time, timedelta
+import logging
+import pytz
+
+_logger = logging.getLogger(__name__)
+
+# 微信接口每日额度按北京时间零点重置
+QUOTA_TZ = pytz.timezone('Asia/Shanghai')
+# 模板消息发送接口，额度台账按接口路径记账
+TEMPLATE_SEND_API = '/cgi-bin/message/template/send'
+# 今日额度不足、未发出的请求使用的错误码，记录在额度重置后自动重试
+QUOTA_EXCEEDED_ERRCODE = -3
+
+
+class WechatApiQuota(models.Model):
+    """微信接口每日额度台账
+
+    按 app_id、接口和日期(北京时间)记录已预占的调用次数。发送前先预占额度，
+    预占在独立的短事务中完成，不会在发送期间持有台账行锁。
+    """
+    _name = 'wechat.api.quota'
+    _description = '微信接口每日额度'
+    _order = 'day desc, app_id, api_path'
+
+    app_id = fields.Char(string='App ID', required=True, readonly=True)
+    api_path = fields.Char(string='接口', required=True, readonly=True)
+    day = fields.Date(string='日期', required=True, readonly=True, help='北京时间日期')
+    used = fields.Integer(string='已用次数', readonly=True)
+
+    _sql_constraints = [
+        ('unique_app_api_day', 'unique(app_id, api_path, day)', '同一接口每天只有一条额度记录!'),
+    ]
+
+    @api.model
+    def _quota_day(self):
+        """当前额度日期(北京时间)"""
+        return datetime.now(QUOTA_TZ).date()
+
+    @api.model
+    def _next_reset(self):
+        """下一次额度重置的时间(UTC)"""
+        next_day = QUOTA_TZ.localize(datetime.combine(self._quota_day() + timedelta(days=1), dt_time.min))
+        return next_day.astimezone(pytz.utc).replace(tzinfo=None)
+
+    @api.model
+    def _get_limit(self, config, priority=False):
+        """可用额度上限，None 表示不限；非预警消息不能占用为预警消息预留的额度"""
+        if not config.template_daily_quota:
+            return None
+        if priority:
+            return config.template_daily_quota
+        return max(0, config.template_daily_quota - config.template_quota_reserve)
+
+    @api.model
+    def consume(self, config, count, priority=False, api_path=TEMPLATE_SEND_API):
+        """预占额度，返回实际获得的次数(可能小于 count)
+
+        priority=True (预警提醒)时可以使用预留额度。未设置每日额度时全部放行，只记账。
+        使用独立的短事务，并发的预占按行锁排队，不会超出额度。
+        """
+        if count <= 0:
+            return 0
+        params = {
+            'app_id': config.app_id,
+            'api_path': api_path,
+            'day': self._quota_day(),
+            'count': count,
+            'limit': self._get_limit(config, priority),
+            'uid': self.env.uid,
+        }
+        with self.env.registry.cursor() as cr:
+            cr.execute("""
+                INSERT INTO wechat_api_quota (app_id, api_path, day, used, create_uid, write_uid, create_date, write_date)
+                VALUES (%(app_id)s, %(api_path)s, %(day)s, 0, %(uid)s, %(uid)s,
+                        NOW() AT TIME ZONE 'UTC', NOW() AT TIME ZONE 'UTC')
+                ON CONFLICT (app_id, api_path, day) DO NOTHING
+            """, params)
+            cr.execute("""
+                WITH cur AS (
+                        SELECT id, used FROM wechat_api_quota
+                         WHERE app_id = %(app_id)s AND api_path = %(api_path)s AND day = %(day)s
+                           FOR UPDATE
+                     )
+                UPDATE wechat_api_quota q
+                   SET used = q.used + g.granted,
+                       write_date = NOW() AT TIME ZONE 'UTC'
+                  FROM (SELECT id, LEAST(%(count)s, GREATEST(0, COALESCE(%(limit)s::int, used + %(count)s) - used))
+                               AS granted
+                          FROM cur) g
+                 WHERE q.id = g.id
+             RETURNING g.granted
+            """, params)
+            granted = cr.fetchone()[0]
+        if granted < count:
+            _logger.warning(f"微信接口 {api_path} 今日额度不足(app_id {config.app_id}), 申请 {count}, 获得 {granted}")
+        return granted
+
+    @api.model
+    def release(self, config, count, day=None, api_path=TEMPLATE_SEND_API):
+        """退还已预占但未发出的额度(如熔断期间未发出的请求)
+
+        day 为预占时的额度日期，跨零点时退还到预占当天，不会增加新一天的额度。
+        """
+        if count <= 0:
+            return
+        with self.env.registry.cursor() as cr:
+            cr.execute("""
+                UPDATE wechat_api_quota
+                   SET used = GREATEST(0, used - %s),
+                       write_date = NOW() AT TIME ZONE 'UTC'
+                 WHERE app_id = %s AND api_path = %s AND day = %s
+            """, (count, config.app_id, api_path, day or self._quota_day()))
+
+    @api.model
+    def remaining(self, config, priority=False, api_path=TEMPLATE_SEND_API):
+        """今日剩余额度，None 表示不限"""
+        limit = self._get_limit(config, priority)
+        if limit is None:
+            return None
+        self.env.cr.execute("""
+            SELECT used FROM wechat_api_quota WHERE app_id = %s AND api_path = %s AND day = %s
+        """, (config.app_id, api_path, self._quota_day()))
+        row = self.env.cr.fetchone()
+        return max(0, limit - (row[0] if row else 0))
+
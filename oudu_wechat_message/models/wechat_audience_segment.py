@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2025/09/23 10:33
+@Author  : Jason Zou
+@Email   : zou.jason@qq.com
+@Mobile  ：18951631470
+@Website: http://www.duodoo.tech
+"""
+from odoo import models, fields, api, _
+from odoo.exceptions import ValidationError, UserError
+from odoo.tools.safe_eval import safe_eval
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+class WechatAudienceSegment(models.Model):
+    _name = 'wechat.audience.segment'
+    _description = '微信消息受众分组'
+    _order = 'name'
+
+    name = fields.Char(string='分组名称', required=True)
+    active = fields.Boolean(string='启用', default=True)
+    domain = fields.Char(
+        string='用户筛选条件',
+        default='[]',
+        required=True,
+        help='res.users 的筛选条件，如用户组、公司、联系人标签等；始终只包含已绑定微信且启用的用户'
+    )
+    snapshot_count = fields.Integer(string='快照用户数', readonly=True)
+    last_refresh_time = fields.Datetime(string='最近刷新时间', readonly=True)
+
+    @api.constrains('domain')
+    def _check_domain(self):
+        for segment in self:
+            try:
+                self.env['res.users'].search_count(segment._get_user_domain(), limit=1)
+            except Exception as e:
+                raise ValidationError(_('用户筛选条件无效: %s') % str(e))
+
+    def _get_user_domain(self):
+        """分组的完整用户筛选条件"""
+        self.ensure_one()
+        return safe_eval(self.domain or '[]') + [
+            ('wechat_openid', '!=', False),
+            ('active', '=', True),
+        ]
+
+    def _is_in_use(self):
+        """是否有使用该分组的消息正在发送"""
+        self.ensure_one()
+        return bool(self.env['wechat.message'].search_count([
+            ('segment_id', '=', self.id),
+            ('state', '=', 'sending'),
+        ], limit=1))
+
+    def refresh_snapshot(self, chunk_size=5000):
+        """增量刷新受众快照
+
+        按用户ID区间分块比较：每块只删除不再匹配的用户、插入新用户、更新openid有变化的用户，
+        未变化的快照行不会被改写。有消息正在使用该分组发送时跳过刷新，保证续发和重试的受众不变。
+        """
+        Users = self.env['res.users'].sudo().with_context(active_test=False)
+        Users.flush_model(['active', 'wechat_openid'])
+        for segment in self:
+            if segment._is_in_use():
+                _logger.info(f"受众分组 {segment.name} 正在发送中，跳过快照刷新")
+                continue
+
+            domain = segment._get_user_domain()
+            last_id = 0
+            while True:
+                user_ids = Users.search(domain + [('id', '>', last_id)], order='id', limit=chunk_size).ids
+                upper_id = user_ids[-1] if len(user_ids) == chunk_size else None
+                self.env.cr.execute("""
+                    DELETE FROM wechat_audience_snapshot
+                     WHERE segment_id = %s
+                       AND user_id > %s
+                       AND (%s IS NULL OR user_id <= %s)
+                       AND user_id != ALL(%s)
+                """, (segment.id, last_id, upper_id, upper_id, user_ids))
+                if user_ids:
+                    self.env.cr.execute("""
+                        INSERT INTO wechat_audience_snapshot (segment_id, user_id, wechat_openid)
+                        SELECT %s, u.id, u.wechat_openid
+                          FROM res_users u
+                         WHERE u.id = ANY(%s)
+                        ON CONFLICT (segment_id, user_id) DO UPDATE
+                           SET wechat_openid = EXCLUDED.wechat_openid
+                         WHERE wechat_audience_snapshot.wechat_openid IS DISTINCT FROM EXCLUDED.wechat_openid
+                    """, (segment.id, user_ids))
+                if upper_id is None:
+                    break
+                last_id = upper_id
+                self.env.invalidate_all()
+
+            self.env.cr.execute(
+                "SELECT COUNT(*) FROM wechat_audience_snapshot WHERE segment_id = %s", (segment.id,))
+            segment.write({
+                'snapshot_count': self.env.cr.fetchone()[0],
+                'last_refresh_time': fields.Datetime.now(),
+            })
+            _logger.info(f"受众分组 {segment.name} 快照已刷新, 用户数: {segment.snapshot_count}")
+        self.env['wechat.audience.snapshot'].invalidate_model()
+        return True
+
+    def action_refresh_snapshot(self):
+        """手动刷新快照"""
+        for segment in self:
+            if segment._is_in_use():
+                raise UserError(_('分组 %s 有消息正在发送，发送完成后才能刷新快照') % segment.name)
+        return self.refresh_snapshot()
+
+    def _ensure_snapshot(self):
+        """从未刷新过的分组在首次发送前生成快照"""
+        self.filtered(lambda s: not s.last_refresh_time).refresh_snapshot()
+
+    @api.model
+    def cron_refresh_snapshots(self):
+        """定时任务：刷新所有启用的受众分组快照"""
+        for segment in self.search([]):
+            try:
+                segment.refresh_snapshot()
+                self.env.cr.commit()
+            except Exception as e:
+                self.env.cr.rollback()
+                _logger.error(f"刷新受众分组快照失败 {segment.name}: {str(e)}")
+
+
+class WechatAudienceSnapshot(models.Model):
+    _name = 'wechat.audience.snapshot'
+    _description = '微信消息受众快照'
+    _order = 'segment_id, user_id'
+
+    segment_id = fields.Many2one(
+        'wechat.audience.segment',
+        string='受众分组',
+        required=True,
+        ondelete='cascade'
+    )
+    user_id = fields.Many2one(
+        'res.users',
+        string='用户',
+        required=True,
+        ondelete='cascade'
+    )
+    wechat_openid = fields.Char(string='微信OpenID')
+
+    _sql_constraints = [
+        ('unique_segment_user', 'unique(segment_id, user_id)', '同一分组中用户不能重复!'),
+    ]
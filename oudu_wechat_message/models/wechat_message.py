@@ -8,13 +8,20 @@
 """
 from odoo import models, fields, api, _
 from odoo.exceptions import ValidationError, UserError
+from odoo.tools.sql import create_index
 import logging
 from urllib.parse import quote
-from datetime import datetime
+from datetime import timedelta
+from collections import defaultdict
+from odoo.addons.oudu_wechat_message.utils.circuit_breaker import CIRCUIT_OPEN_ERRCODE
+from odoo.addons.oudu_wechat_message.models.wechat_api_quota import QUOTA_EXCEEDED_ERRCODE
 import pytz
 
 _logger = logging.getLogger(__name__)
 
+# 发送进度按总数分为多少档推送，已处理数跨过一档时推送一次
+PROGRESS_PUSH_STEPS = 100
+
 # 在类顶部添加新方法
 def format_to_eight(dt_str, format_str="%Y年%m月%d日 %H:%M:%S"):
     """统一将UTC时间转换为东8区时间"""
@@ -98,6 +105,42 @@ class WechatMessage(models.Model):
         default=lambda self: self._get_default_wechat_config()
     )
 
+    # 多进程分区发送
+    partition_mode = fields.Selection([
+        ('none', '不分区'),
+        ('openid_hash', '按OpenID哈希'),
+        ('id_range', '按用户ID区间'),
+    ], string='分区发送', default='none', required=True,
+        help='超大规模群发时将目标用户分区，由多个进程并行发送，进程数取自微信配置')
+    partition_count = fields.Integer(string='分区数', readonly=True, copy=False)
+
+    # 灰度发送：先发送给少量用户，错误率未超过阈值时才继续发送给其余用户
+    canary_size = fields.Integer(
+        string='灰度用户数',
+        default=0,
+        help='大于0时先随机发送给这么多用户，0表示直接发送给全部用户'
+    )
+    canary_error_threshold = fields.Float(
+        string='灰度失败率阈值(%)',
+        default=20,
+        help='灰度用户的发送失败率超过此值时中止发送，其余用户保留在队列中'
+    )
+    canary_state = fields.Selection([
+        ('none', '未启用'),
+        ('running', '灰度中'),
+        ('passed', '已通过'),
+        ('aborted', '已中止'),
+    ], string='灰度状态', default='none', required=True, readonly=True, copy=False)
+    canary_result = fields.Text(string='灰度结果', readonly=True, copy=False)
+
+    # 目标受众：为空时发送给所有已绑定微信的用户
+    segment_id = fields.Many2one(
+        'wechat.audience.segment',
+        string='受众分组',
+        ondelete='restrict',
+        help='选择受众分组时只发送给分组快照中的用户'
+    )
+
     # 状态跟踪
     state = fields.Selection([
         ('draft', '草稿'),
@@ -107,11 +150,11 @@ class WechatMessage(models.Model):
         ('cancelled', '已取消')
     ], string='状态', default='draft', readonly=True, index=True)
 
-    # 发送统计
+    # 发送统计：由用户消息记录的创建和状态变化以原子SQL增量维护
     total_recipients = fields.Integer(
         string='目标用户数',
-        compute='_compute_send_stats',
-        store=True
+        default=0,
+        readonly=True
     )
 
     sent_count = fields.Integer(
@@ -135,7 +178,19 @@ class WechatMessage(models.Model):
 
     # 时间字段
     scheduled_send_time = fields.Datetime(string='计划发送时间')
+    dispatch_after = fields.Datetime(
+        string='队列开始时间',
+        readonly=True,
+        copy=False,
+        help='计划发送的消息到期后按配置错开启动，队列在此时间之后才开始发送'
+    )
     actual_send_time = fields.Datetime(string='实际发送时间', readonly=True)
+    send_started_time = fields.Datetime(
+        string='开始发送时间',
+        readonly=True,
+        copy=False,
+        help='第一批用户开始发送的时间，作为该消息所有用户消息记录的发送时间(分区键)'
+    )
 
     # 技术字段
     template_id = fields.Char(string='微信模板ID')
@@ -149,14 +204,114 @@ class WechatMessage(models.Model):
         string='用户消息记录'
     )
 
-    # 计算字段和方法
-    @api.depends('user_message_ids')
-    def _compute_send_stats(self):
-        """计算发送统计信息"""
-        for record in self:
-            record.total_recipients = len(record.user_message_ids)
-            record.sent_count = len(record.user_message_ids.filtered(lambda m: m.state == 'sent'))
-            record.failed_count = len(record.user_message_ids.filtered(lambda m: m.state == 'failed'))
+    def init(self):
+        super().init()
+        create_index(self.env.cr, 'wechat_message_state_scheduled_send_time_index',
+                     self._table, ['state', 'scheduled_send_time'])
+
+    # 发送统计维护
+    def _increment_send_stats(self, deltas):
+        """原子累加发送统计
+
+        deltas 为 {message_id: [目标用户增量, 成功增量, 失败增量]}，
+        每条消息一条 UPDATE ... SET x = x + k，不读取用户消息记录。
+        """
+        deltas = {message_id: delta for message_id, delta in deltas.items() if any(delta)}
+        if not deltas:
+            return
+        self.flush_model(['total_recipients', 'sent_count', 'failed_count'])
+        for message_id, (total, sent, failed) in deltas.items():
+            self.env.cr.execute("""
+                UPDATE wechat_message
+                   SET total_recipients = total_recipients + %s,
+                       sent_count = sent_count + %s,
+                       failed_count = failed_count + %s
+                 WHERE id = %s
+             RETURNING state, total_recipients, sent_count, failed_count, send_started_time
+            """, (total, sent, failed, message_id))
+            row = self.env.cr.fetchone()
+            if row:
+                self._publish_progress(message_id, *row, previous_done=row[2] + row[3] - sent - failed)
+        self.browse(list(deltas)).invalidate_recordset(['total_recipients', 'sent_count', 'failed_count'])
+
+    @api.model
+    def _publish_progress(self, message_id, state, total, sent, failed, started=None, previous_done=None):
+        """通过 bus.bus 推送发送进度到消息记录的频道 (消息, 'progress')
+
+        统计值直接取自累加SQL的返回结果，不额外查询数据库；已处理数每跨过总数的
+        1/PROGRESS_PUSH_STEPS 推送一次，未传入 previous_done(状态变化)时立即推送。
+        速率和预计剩余时间按开始发送时间和数据库中的累计数计算，与由哪个进程发送无关。
+        """
+        done = sent + failed
+        if previous_done is not None:
+            step = max(1, total // PROGRESS_PUSH_STEPS)
+            if done // step == previous_done // step:
+                return
+        elapsed = (fields.Datetime.now() - started).total_seconds() if started else 0
+        rate = done / elapsed if elapsed > 0 else 0.0
+        remaining = max(0, total - done)
+        message = self.browse(message_id)
+        self.env['bus.bus']._sendone((message, 'progress'), 'wechat_message_progress', {
+            'id': message_id,
+            'state': state,
+            'total': total,
+            'sent': sent,
+            'failed': failed,
+            'rate': round(rate, 2),
+            'eta': round(remaining / rate) if rate > 0 and remaining else None,
+        })
+
+    def _ensure_send_started_time(self):
+        """原子设置并返回开始发送时间，多个进程同时开始发送时取同一个值"""
+        self.ensure_one()
+        self.flush_recordset(['send_started_time'])
+        self.env.cr.execute("""
+            UPDATE wechat_message
+               SET send_started_time = COALESCE(send_started_time, NOW() AT TIME ZONE 'UTC')
+             WHERE id = %s
+         RETURNING send_started_time
+        """, (self.id,))
+        self.invalidate_recordset(['send_started_time'])
+        return self.env.cr.fetchone()[0]
+
+    def _recompute_send_stats(self):
+        """用一次分组聚合SQL重新统计发送数据，用于校正计数
+
+        已归档分区的用户消息按归档汇总计入。
+        """
+        if not self:
+            return
+        self.env['wechat.user.message'].flush_model(['wechat_message_id', 'state'])
+        self.env.cr.execute("""
+            UPDATE wechat_message m
+               SET total_recipients = s.total,
+                   sent_count = s.sent,
+                   failed_count = s.failed
+              FROM (
+                    SELECT msg.id,
+                           COALESCE(SUM(t.total), 0) AS total,
+                           COALESCE(SUM(t.sent), 0) AS sent,
+                           COALESCE(SUM(t.failed), 0) AS failed
+                      FROM wechat_message msg
+                      LEFT JOIN (
+                            SELECT um.wechat_message_id,
+                                   COUNT(*) AS total,
+                                   COUNT(*) FILTER (WHERE um.state NOT IN ('failed', 'pending')) AS sent,
+                                   COUNT(*) FILTER (WHERE um.state = 'failed') AS failed
+                              FROM wechat_user_message um
+                             WHERE um.wechat_message_id = ANY(%s)
+                             GROUP BY um.wechat_message_id
+                             UNION ALL
+                            SELECT a.wechat_message_id, a.total, a.sent_count, a.failed_count
+                              FROM wechat_user_message_archive a
+                             WHERE a.wechat_message_id = ANY(%s)
+                           ) t ON t.wechat_message_id = msg.id
+                     WHERE msg.id = ANY(%s)
+                     GROUP BY msg.id
+                   ) s
+             WHERE m.id = s.id
+        """, (self.ids, self.ids, self.ids))
+        self.invalidate_recordset(['total_recipients', 'sent_count', 'failed_count'])
 
     @api.model
     def _get_default_wechat_config(self):
@@ -166,6 +321,14 @@ class WechatMessage(models.Model):
         return config.id if config else None
 
     # 约束和验证
+    @api.constrains('canary_size', 'canary_error_threshold')
+    def _check_canary_settings(self):
+        for record in self:
+            if record.canary_size < 0:
+                raise ValidationError(_('灰度用户数不能为负数'))
+            if record.canary_error_threshold < 0 or record.canary_error_threshold > 100:
+                raise ValidationError(_('灰度失败率阈值必须在0到100之间'))
+
     @api.constrains('scheduled_send_time')
     def _check_scheduled_time(self):
         """验证计划发送时间"""
@@ -176,12 +339,41 @@ class WechatMessage(models.Model):
     # 序列号生成逻辑
     @api.model_create_multi
     def create(self, vals_list):
-        """创建时生成序列号"""
-        for vals in vals_list:
-            if vals.get('message_sequence', _('New')) == _('New'):
-                vals['message_sequence'] = self.env['ir.sequence'].next_by_code('wechat.message') or _('New')
+        """创建时生成序列号，批量创建时一次分配所有序列号"""
+        pending = [vals for vals in vals_list if vals.get('message_sequence', _('New')) == _('New')]
+        for vals, sequence in zip(pending, self._allocate_sequences(len(pending))):
+            vals['message_sequence'] = sequence
         return super().create(vals_list)
 
+    @api.model
+    def _allocate_sequences(self, count):
+        """一次分配多个消息编号
+
+        标准序列用一条 nextval 查询取出所有号码；按日期区间或无间隔序列逐个取号。
+        """
+        if not count:
+            return []
+        sequence = self.env['ir.sequence'].sudo().search([
+            ('code', '=', 'wechat.message'),
+            ('company_id', 'in', [self.env.company.id, False]),
+        ], order='company_id', limit=1)
+        if not sequence:
+            return [_('New')] * count
+        if count == 1 or sequence.implementation != 'standard' or sequence.use_date_range:
+            return [sequence.next_by_id() for _i in range(count)]
+        self.env.cr.execute("SELECT nextval(%s) FROM generate_series(1, %s)",
+                            (f'ir_sequence_{sequence.id:03d}', count))
+        return [sequence.get_next_char(row[0]) for row in self.env.cr.fetchall()]
+
+    def write(self, vals):
+        """状态变化时立即推送一次进度"""
+        res = super().write(vals)
+        if 'state' in vals:
+            for record in self:
+                self._publish_progress(record.id, record.state, record.total_recipients,
+                                       record.sent_count, record.failed_count, record.send_started_time)
+        return res
+
     def _prepare_redirect_url(self):
         """准备跳转URL - 动态构建微信OAuth授权URL"""
         # 优先使用配置的跳转链接
@@ -237,24 +429,22 @@ class WechatMessage(models.Model):
             return f"{self.get_base_url()}{target_path}"
 
     def action_send_message(self):
-        """发送微信消息 - 手动发送入口"""
+        """发送微信消息 - 手动发送入口
+
+        目标用户写入发送队列后立即返回，由队列消费任务分批发送，
+        全部发送完毕后消息切换为已发送或发送失败。
+        """
+        outbox = self.env['wechat.message.outbox'].sudo()
+        notification_service = self.env['wechat.notification.service']
+        success = True
         for record in self:
             if record.state != 'draft':
                 raise UserError(_('只能发送草稿状态的消息'))
 
             try:
-                # 通过服务类发送消息
-                notification_service = self.env['wechat.notification.service']
-                success = notification_service.send_wechat_message(record)
-
-                if success:
-                    _logger.info(f"微信消息发送完成: {record.message_sequence}")
-                else:
-                    record.write({
-                        'state': 'failed',
-                        'error_message': _('发送服务返回失败')
-                    })
-                    return False
+                queued = outbox.enqueue_message(
+                    record, notification_service._iter_target_recipients(segment=record.segment_id))
+                success = record._start_queued_send(queued) and success
 
             except Exception as e:
                 _logger.error(f"发送微信消息失败: {str(e)}")
@@ -262,8 +452,182 @@ class WechatMessage(models.Model):
                     'state': 'failed',
                     'error_message': str(e)
                 })
-                return False
+                success = False
+
+        self._trigger_outbox_cron()
+        return success
+
+    def _start_queued_send(self, queued):
+        """目标用户入队后切换为发送中，返回是否有目标用户
+
+        按当日剩余额度规划发送，并按消息设置分配分区和灰度用户。
+        """
+        self.ensure_one()
+        outbox = self.env['wechat.message.outbox'].sudo()
+        if not queued:
+            self.write({
+                'state': 'failed',
+                'error_message': _('没有找到目标用户')
+            })
+            return False
+
+        # 发送前按当日剩余额度规划：额度已用完时整条消息顺延到额度重置后，
+        # 额度不足以发完时由队列按天分批发送
+        remaining = self.env['wechat.api.quota'].remaining(
+            self.wechat_config_id, priority=self.message_type == 'alert_warning')
+        if remaining == 0:
+            self._defer_until_quota_reset()
+        elif remaining is not None and queued > remaining:
+            _logger.info(f"微信消息 {self.message_sequence} 用户数 {queued} 超出今日剩余额度 {remaining}，"
+                         f"超出部分将在额度重置后继续发送")
+
+        if self.partition_mode != 'none' and self.wechat_config_id.send_processes > 1:
+            self.partition_count = min(self.wechat_config_id.send_processes, queued)
+            outbox.assign_partitions(self)
+        canary_state = 'none'
+        if 0 < self.canary_size < queued:
+            outbox.assign_canary(self, self.canary_size)
+            canary_state = 'running'
+        self.write({'state': 'sending', 'error_message': False, 'canary_state': canary_state})
+        _logger.info(f"微信消息已加入发送队列: {self.message_sequence}, 用户数: {queued}")
+        return True
 
+    def _evaluate_canary(self):
+        """灰度用户全部发送完毕后按错误码分布决定继续发送或中止
+
+        熔断和额度不足未实际发出的记录不计入，等待重发后再评估。
+        中止的消息切换为发送失败，其余用户保留在队列中，修正后可继续发送。
+        """
+        self.ensure_one()
+        outbox = self.env['wechat.message.outbox']
+        if outbox.search_count([('wechat_message_id', '=', self.id), ('canary', '=', True),
+                                ('state', '=', 'queued')], limit=1):
+            return
+        self.env['wechat.user.message'].flush_model(['state', 'errcode'])
+        self.env.cr.execute("""
+            SELECT um.state, um.errcode, COUNT(*)
+              FROM wechat_message_outbox o
+              JOIN wechat_user_message um ON um.wechat_message_id = o.wechat_message_id AND um.user_id = o.user_id
+             WHERE o.wechat_message_id = %s AND o.canary
+             GROUP BY um.state, um.errcode
+        """, (self.id,))
+        distribution = defaultdict(int)
+        for state, errcode, count in self.env.cr.fetchall():
+            if state == 'pending':
+                return
+            if state != 'failed':
+                distribution[0] += count
+            elif errcode not in (CIRCUIT_OPEN_ERRCODE, QUOTA_EXCEEDED_ERRCODE):
+                distribution[errcode if errcode is not None else -1] += count
+        total = sum(distribution.values())
+        if not total:
+            return
+
+        failed = total - distribution[0]
+        rate = failed * 100.0 / total
+        result = _('灰度用户 %(total)s 人，失败 %(failed)s 人 (%(rate).1f%%)；错误码分布：%(codes)s') % {
+            'total': total,
+            'failed': failed,
+            'rate': rate,
+            'codes': '，'.join(f"{code}×{count}" for code, count in sorted(distribution.items())),
+        }
+        if rate <= self.canary_error_threshold:
+            self.write({'canary_state': 'passed', 'canary_result': result})
+            _logger.info(f"微信消息 {self.message_sequence} 灰度通过，继续发送: {result}")
+            self._trigger_outbox_cron()
+        else:
+            self.write({
+                'state': 'failed',
+                'canary_state': 'aborted',
+                'canary_result': result,
+                'error_message': _('灰度失败率超过阈值 %(threshold)s%%，已中止发送，其余用户保留在队列中。%(result)s') % {
+                    'threshold': self.canary_error_threshold,
+                    'result': result,
+                },
+            })
+            _logger.warning(f"微信消息 {self.message_sequence} 灰度失败，已中止: {result}")
+
+    def action_resume_rollout(self):
+        """灰度中止的消息修正后继续发送给其余用户"""
+        for record in self:
+            if record.canary_state != 'aborted':
+                raise UserError(_('只能继续发送灰度已中止的消息'))
+        self.write({'state': 'sending', 'canary_state': 'passed', 'error_message': False})
+        self._trigger_outbox_cron()
+        return True
+
+    def _defer_until_quota_reset(self):
+        """当日额度不足，消息的剩余队列顺延到额度重置后发送"""
+        reset = self.env['wechat.api.quota']._next_reset()
+        for record in self:
+            if not record.dispatch_after or record.dispatch_after < reset:
+                record.dispatch_after = reset
+                _logger.warning(f"微信消息 {record.message_sequence} 今日额度不足，剩余用户顺延至 {reset} (UTC) 发送")
+        self._trigger_outbox_cron()
+
+    def _trigger_outbox_cron(self):
+        """触发队列消费任务执行，错开启动的消息在其开始时间再触发一次"""
+        at = sorted({dt for dt in self.mapped('dispatch_after') if dt and dt > fields.Datetime.now()})
+        cron = self.env.ref('oudu_wechat_message.ir_cron_drain_outbox', raise_if_not_found=False)
+        if cron:
+            cron.sudo()._trigger()
+            if at:
+                cron.sudo()._trigger(at)
+
+    def _assign_dispatch_slots(self):
+        """为同时到期的计划消息分配错开的开始时间
+
+        同一微信配置下的消息按计划时间依次间隔 schedule_stagger_seconds 启动，
+        并排在该配置已在发送中的错峰消息之后，避免同一秒集中开始发送。
+        """
+        now = fields.Datetime.now()
+        for config in self.mapped('wechat_config_id'):
+            stagger = timedelta(seconds=config.schedule_stagger_seconds)
+            self.env.cr.execute("""
+                SELECT MAX(dispatch_after)
+                  FROM wechat_message
+                 WHERE state = 'sending' AND wechat_config_id = %s
+            """, (config.id,))
+            last_slot = self.env.cr.fetchone()[0]
+            slot = max(now, last_slot + stagger) if last_slot else now
+            messages = self.filtered(lambda m: m.wechat_config_id == config)
+            for message in messages.sorted(lambda m: (m.scheduled_send_time, m.id)):
+                message.dispatch_after = slot
+                slot += stagger
+
+    @api.model
+    def cron_dispatch_scheduled_messages(self, batch_size=50):
+        """定时任务：分批领取到期的计划发送消息并加入发送队列
+
+        使用 (state, scheduled_send_time) 索引查找到期草稿，FOR UPDATE SKIP LOCKED 保证多进程不重复领取。
+        """
+        while True:
+            self.flush_model(['state', 'scheduled_send_time'])
+            self.env.cr.execute("""
+                SELECT id
+                  FROM wechat_message
+                 WHERE state = 'draft'
+                   AND scheduled_send_time <= NOW() AT TIME ZONE 'UTC'
+                 ORDER BY scheduled_send_time, id
+                 LIMIT %s
+                   FOR UPDATE SKIP LOCKED
+            """, (batch_size,))
+            messages = self.browse([row[0] for row in self.env.cr.fetchall()])
+            if not messages:
+                break
+            messages._assign_dispatch_slots()
+            messages.action_send_message()
+            self.env.cr.commit()
+            _logger.info(f"计划发送消息已加入发送队列: {', '.join(messages.mapped('message_sequence'))}")
+
+    def action_cancel_message(self):
+        """取消消息，发送中的消息最多在一个批次内停止"""
+        for record in self:
+            if record.state not in ('draft', 'sending') and record.canary_state != 'aborted':
+                raise UserError(_('只能取消草稿、发送中或灰度已中止的消息'))
+        self.write({'state': 'cancelled'})
+        self.env['wechat.message.outbox'].sudo().cancel_message(self)
+        self.env['wechat.message.digest'].sudo().remove_messages(self)
         return True
 
     def action_view_user_messages(self):
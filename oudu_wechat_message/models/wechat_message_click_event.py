@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2025/09/23 10:33
+@Author  : Jason Zou
+@Email   : zou.jason@qq.com
+@Mobile  ：18951631470
+@Website: http://www.duodoo.tech
+"""
+from odoo import models, fields, api, _
+from collections import defaultdict
+import logging
+import time
+
+_logger = logging.getLogger(__name__)
+
+
+class WechatMessageClickEvent(models.Model):
+    """消息点击事件缓冲
+
+    跳转、详情页和摘要页只追加一行事件，不更新用户消息和消息记录；
+    定时任务批量取出事件，按消息和用户聚合后用原子SQL累加计数。
+    """
+    _name = 'wechat.message.click.event'
+    _description = '微信消息点击事件'
+    _order = 'id'
+    _log_access = False
+
+    wechat_message_id = fields.Many2one(
+        'wechat.message',
+        string='微信消息',
+        required=True,
+        ondelete='cascade'
+    )
+    user_id = fields.Many2one(
+        'res.users',
+        string='用户',
+        ondelete='cascade'
+    )
+    wechat_openid = fields.Char(string='微信OpenID')
+    source = fields.Selection([
+        ('redirect', '消息跳转'),
+        ('detail', '详情页'),
+    ], string='来源', required=True, default='redirect', help='只有消息跳转累加点击次数和消息的打开次数，详情页只在首次查看时记为点击')
+    event_time = fields.Datetime(string='点击时间', required=True, default=fields.Datetime.now)
+
+    @api.model
+    def record_event(self, message_id, user_id=None, openid=None, source='redirect'):
+        """追加一条点击事件，一条 INSERT，不锁定消息记录"""
+        if not user_id and not openid:
+            return
+        self.env.cr.execute("""
+            INSERT INTO wechat_message_click_event (wechat_message_id, user_id, wechat_openid, source, event_time)
+            VALUES (%s, %s, %s, %s, NOW() AT TIME ZONE 'UTC')
+        """, (message_id, user_id or None, openid or None, source))
+
+    def _take_batch(self, batch_size):
+        """原子取出一批事件，返回事件行；并行的刷新任务取到的事件互不重叠"""
+        self.env.cr.execute("""
+            DELETE FROM wechat_message_click_event
+             WHERE id IN (
+                    SELECT id FROM wechat_message_click_event
+                     ORDER BY id
+                     LIMIT %s
+                       FOR UPDATE SKIP LOCKED
+                   )
+         RETURNING wechat_message_id, user_id, wechat_openid, source, event_time
+        """, (batch_size,))
+        return self.env.cr.fetchall()
+
+    @api.model
+    def _apply_events(self, events):
+        """按 (消息, 用户) 聚合事件并累加计数
+
+        用户消息的点击次数和点击时间、消息的打开次数都用 x = x + k 更新，
+        每条消息每批只更新一次，不会因读改写丢失计数。
+        只有消息跳转累加点击次数；详情页和摘要页只在用户消息尚未点击时记为一次点击，
+        刷新页面不会重复计数。
+        """
+        hits = defaultdict(lambda: [0, 0, None])
+        for message_id, user_id, openid, source, event_time in events:
+            counter = hits[(message_id, user_id or 0, openid or '')]
+            if source == 'redirect':
+                counter[0] += 1
+            else:
+                counter[1] += 1
+            counter[2] = max(counter[2], event_time) if counter[2] else event_time
+        if not hits:
+            return
+
+        keys = list(hits)
+        self.env['wechat.user.message'].flush_model(['state', 'click_time', 'click_count'])
+        self.env['wechat.message'].flush_model(['open_count'])
+        # 已登录用户按用户ID匹配，未登录时按跳转链接中的 openid 匹配用户
+        self.env.cr.execute("""
+            WITH ev AS (
+                    SELECT *
+                      FROM unnest(%s::int[], %s::int[], %s::varchar[], %s::int[], %s::int[], %s::timestamp[])
+                           AS e(message_id, user_id, openid, clicks, views, last_time)
+                 ),
+                 matched AS (
+                    SELECT ev.message_id, COALESCE(NULLIF(ev.user_id, 0), u.id) AS user_id,
+                           SUM(ev.clicks) AS clicks, SUM(ev.views) AS views, MAX(ev.last_time) AS last_time
+                      FROM ev
+                      LEFT JOIN res_users u ON ev.user_id = 0 AND u.wechat_openid = ev.openid
+                     WHERE COALESCE(NULLIF(ev.user_id, 0), u.id) IS NOT NULL
+                     GROUP BY 1, 2
+                 ),
+                 upd AS (
+                    UPDATE wechat_user_message um
+                       SET click_count = um.click_count + matched.clicks
+                                         + CASE WHEN matched.clicks = 0 THEN 1 ELSE 0 END,
+                           click_time = GREATEST(um.click_time, matched.last_time),
+                           state = CASE WHEN um.state IN ('pending', 'failed') THEN um.state ELSE 'clicked' END,
+                           write_date = NOW() AT TIME ZONE 'UTC'
+                      FROM matched
+                     WHERE um.wechat_message_id = matched.message_id
+                       AND um.user_id = matched.user_id
+                       AND (matched.clicks > 0 OR um.state != 'clicked')
+                 RETURNING um.wechat_message_id, matched.clicks AS opens
+                 )
+            UPDATE wechat_message m
+               SET open_count = m.open_count + s.opens
+              FROM (SELECT wechat_message_id, SUM(opens) AS opens FROM upd GROUP BY wechat_message_id) s
+             WHERE m.id = s.wechat_message_id AND s.opens > 0
+        """, (
+            [key[0] for key in keys],
+            [key[1] for key in keys],
+            [key[2] for key in keys],
+            [hits[key][0] for key in keys],
+            [hits[key][1] for key in keys],
+            [hits[key][2] for key in keys],
+        ))
+        self.env['wechat.user.message'].invalidate_model(['state', 'click_time', 'click_count'])
+        self.env['wechat.message'].invalidate_model(['open_count'])
+
+    @api.model
+    def flush_events(self, batch_size=5000, time_limit=50):
+        """取出并累加缓冲中的点击事件，返回处理的事件数量"""
+        deadline = time.time() + time_limit
+        processed = 0
+        while time.time() < deadline:
+            events = self._take_batch(batch_size)
+            if not events:
+                break
+            self._apply_events(events)
+            self.env.cr.commit()
+            processed += len(events)
+        return processed
+
+    @api.model
+    def cron_flush_click_events(self):
+        """定时任务：累加缓冲的消息点击计数"""
+        processed = self.flush_events()
+        if processed:
+            _logger.info(f"微信消息点击事件本次累加: {processed}")
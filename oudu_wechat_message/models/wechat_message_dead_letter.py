@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2025/09/23 10:33
+@Author  : Jason Zou
+@Email   : zou.jason@qq.com
+@Mobile  ：18951631470
+@Website: http://www.duodoo.tech
+"""
+from odoo import models, fields, api, _
+from urllib.parse import urlsplit
+import logging
+import time
+
+_logger = logging.getLogger(__name__)
+
+
+class WechatMessageDeadLetter(models.Model):
+    """熔断期间未发出的用户消息
+
+    用户消息记录保持"发送失败"且不参与定时重试，熔断器探测成功后由定时任务自动重发。
+    首次发送超过配置的死信保留时间仍未重发成功的记录不再重发，消息随即结束发送。
+    用户消息表按发送时间分区，主键包含分区键，这里只保存记录ID。
+    """
+    _name = 'wechat.message.dead.letter'
+    _description = '微信消息死信队列'
+    _order = 'id'
+
+    user_message_id = fields.Integer(string='用户消息记录ID', required=True, index=True)
+    wechat_message_id = fields.Many2one(
+        'wechat.message',
+        string='微信消息',
+        required=True,
+        index=True,
+        ondelete='cascade'
+    )
+    wechat_config_id = fields.Many2one(
+        'wechat.sso.config',
+        string='微信配置',
+        required=True,
+        ondelete='cascade'
+    )
+    user_id = fields.Many2one('res.users', string='用户', required=True, ondelete='cascade')
+    wechat_openid = fields.Char(string='微信OpenID')
+
+    _sql_constraints = [
+        ('unique_user_message', 'unique(user_message_id)', '同一用户消息记录只能进入一次死信队列!'),
+    ]
+
+    @api.model
+    def park(self, message_record, user_message_ids):
+        """将熔断期间未发出的用户消息记录加入死信队列"""
+        if not user_message_ids:
+            return
+        self.env['wechat.user.message'].flush_model(['wechat_message_id', 'user_id', 'wechat_openid'])
+        self.env.cr.execute("""
+            INSERT INTO wechat_message_dead_letter
+                (user_message_id, wechat_message_id, wechat_config_id, user_id, wechat_openid,
+                 create_uid, write_uid, create_date, write_date)
+            SELECT um.id, um.wechat_message_id, %s, um.user_id, um.wechat_openid,
+                   %s, %s, NOW() AT TIME ZONE 'UTC', NOW() AT TIME ZONE 'UTC'
+              FROM wechat_user_message um
+             WHERE um.id = ANY(%s)
+            ON CONFLICT (user_message_id) DO NOTHING
+        """, (message_record.wechat_config_id.id, self.env.uid, self.env.uid, list(user_message_ids)))
+        self.invalidate_model()
+
+    @api.model
+    def _has_dead_letters(self, message_id):
+        """消息是否还有等待重发的死信"""
+        self.env.cr.execute("SELECT 1 FROM wechat_message_dead_letter WHERE wechat_message_id = %s LIMIT 1",
+                            (message_id,))
+        return bool(self.env.cr.fetchone())
+
+    @api.model
+    def _expire(self):
+        """丢弃超过保留时间的死信，用户消息保持发送失败，返回涉及的消息ID
+
+        保留时间从用户消息首次预占发送时算起，死信重发后再次入队不会重新计时。
+        """
+        self.env['wechat.user.message'].flush_model()
+        self.env.cr.execute("""
+            WITH expired AS (
+                    DELETE FROM wechat_message_dead_letter d
+                     USING wechat_user_message um, wechat_sso_config c
+                     WHERE um.id = d.user_message_id
+                       AND c.id = d.wechat_config_id
+                       AND um.create_date < NOW() AT TIME ZONE 'UTC'
+                                            - make_interval(hours => COALESCE(c.dead_letter_max_hours, 24))
+                 RETURNING d.user_message_id, d.wechat_message_id
+                 )
+            UPDATE wechat_user_message um
+               SET error_message = %s,
+                   write_date = NOW() AT TIME ZONE 'UTC'
+              FROM expired
+             WHERE um.id = expired.user_message_id
+            RETURNING expired.wechat_message_id
+        """, (_('微信接口熔断期间未发出，超过死信保留时间，不再重发'),))
+        message_ids = sorted({row[0] for row in self.env.cr.fetchall()})
+        self.env['wechat.user.message'].invalidate_model(['error_message'])
+        if message_ids:
+            _logger.warning(f"微信消息死信超过保留时间，不再重发，涉及消息ID: {message_ids}")
+        return message_ids
+
+    def _claim_batch(self, config, batch_size):
+        """原子取出一批死信并将对应记录重新置为待发送，返回 (记录ID, 消息ID, user_id, openid) 列表
+
+        与定时重试相同，先提交预占再发送；已取消的消息的死信直接丢弃。
+        """
+        self.env['wechat.user.message'].flush_model()
+        self.env.cr.execute("""
+            WITH claimed AS (
+                    DELETE FROM wechat_message_dead_letter
+                     WHERE id IN (
+                            SELECT d.id FROM wechat_message_dead_letter d
+                             WHERE d.wechat_config_id = %s
+                             ORDER BY d.id
+                             LIMIT %s
+                               FOR UPDATE SKIP LOCKED
+                           )
+                 RETURNING user_message_id
+                 )
+            UPDATE wechat_user_message um
+               SET state = 'pending',
+                   write_date = NOW() AT TIME ZONE 'UTC'
+              FROM claimed, wechat_message m
+             WHERE um.id = claimed.user_message_id
+               AND m.id = um.wechat_message_id
+               AND um.state = 'failed'
+               AND m.state IN ('sending', 'sent', 'failed')
+               AND m.canary_state != 'aborted'
+            RETURNING um.id, um.wechat_message_id, um.user_id, um.wechat_openid
+        """, (config.id, batch_size))
+        rows = self.env.cr.fetchall()
+        deltas = {}
+        for row in rows:
+            deltas.setdefault(row[1], [0, 0, 0])[2] -= 1
+        self.env['wechat.user.message'].invalidate_model()
+        self.env['wechat.message']._increment_send_stats(deltas)
+        return rows
+
+    @api.model
+    def replay(self, batch_size=200, time_limit=240):
+        """熔断关闭后重发死信，返回成功数量
+
+        熔断未关闭时每次只取一条死信，由发送器作为半开探测请求发出：
+        探测成功后熔断关闭，继续整批重发；探测失败时死信重新入队，等待下次执行。
+        熔断时间未到时不领取死信。超过保留时间的死信先被丢弃，对应消息结束发送。
+        """
+        deadline = time.time() + time_limit
+        service = self.env['wechat.notification.service']
+        outbox = self.env['wechat.message.outbox']
+        success_count = 0
+        expired_message_ids = self._expire()
+        self.env.cr.commit()
+        if expired_message_ids:
+            outbox._finalize_messages(expired_message_ids)
+        self.env.cr.execute("SELECT DISTINCT wechat_config_id FROM wechat_message_dead_letter")
+        configs = self.env['wechat.sso.config'].browse([row[0] for row in self.env.cr.fetchall()])
+        touched_message_ids = set()
+        for config in configs:
+            breaker = config._get_circuit_breaker()
+            endpoint = urlsplit(config._get_template_send_url('')).path
+            if not breaker.probe_due(endpoint):
+                continue
+            while time.time() < deadline:
+                closed = breaker.is_closed(endpoint)
+                rows = self._claim_batch(config, batch_size if closed else 1)
+                self.env.cr.commit()
+                if not rows:
+                    break
+                for message in self.env['wechat.message'].browse(sorted({row[1] for row in rows})):
+                    reserved = [row[0:1] + row[2:4] for row in rows if row[1] == message.id]
+                    try:
+                        access_token = config.get_wechat_access_token()
+                        compiled = service._compile_payload(access_token, message)
+                        with config._get_template_dispatcher() as dispatcher:
+                            success_count += service._deliver_reserved(dispatcher, compiled, message, reserved)
+                    except Exception as e:
+                        _logger.error(f"重发死信失败 {message.message_sequence}: {str(e)}")
+                        service._record_delivery_results(
+                            message, [row[0] for row in reserved],
+                            [{'errcode': -1, 'errmsg': str(e)}] * len(reserved))
+                    self.env.cr.commit()
+                touched_message_ids.update(row[1] for row in rows)
+                outbox._finalize_messages(sorted({row[1] for row in rows}))
+                self.env.invalidate_all()
+                if not closed and not breaker.is_closed(endpoint):
+                    break
+
+        # 与定时重试相同，全部失败的消息在重发成功后恢复为已发送，灰度中止的消息保持失败
+        for message in self.env['wechat.message'].browse(list(touched_message_ids)):
+            if message.state == 'failed' and message.sent_count and message.canary_state != 'aborted' \
+                    and not self._has_dead_letters(message.id):
+                message.write({'state': 'sent', 'error_message': False})
+        self.env.cr.commit()
+        return success_count
+
+    @api.model
+    def cron_replay_dead_letters(self):
+        """定时任务：熔断恢复后重发死信队列"""
+        success_count = self.replay()
+        if success_count:
+            _logger.info(f"微信消息死信队列本次重发成功: {success_count}")
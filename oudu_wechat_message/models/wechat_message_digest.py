@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2025/09/23 10:33
+@Author  : Jason Zou
+@Email   : zou.jason@qq.com
+@Mobile  ：18951631470
+@Website: http://www.duodoo.tech
+"""
+from odoo import models, fields, api, _
+from odoo.addons.oudu_wechat_message.models.wechat_api_quota import QUOTA_EXCEEDED_ERRCODE
+from odoo.addons.oudu_wechat_message.utils.circuit_breaker import CIRCUIT_OPEN_ERRCODE
+from datetime import timedelta
+import logging
+import time
+
+_logger = logging.getLogger(__name__)
+
+
+class WechatMessageDigest(models.Model):
+    _name = 'wechat.message.digest'
+    _description = '微信消息合并摘要'
+    _order = 'id desc'
+
+    wechat_config_id = fields.Many2one(
+        'wechat.sso.config',
+        string='微信配置',
+        required=True,
+        ondelete='cascade'
+    )
+    user_id = fields.Many2one(
+        'res.users',
+        string='用户',
+        required=True,
+        index=True,
+        ondelete='cascade'
+    )
+    wechat_openid = fields.Char(string='微信OpenID')
+    state = fields.Selection([
+        ('open', '合并中'),
+        ('done', '已发送'),
+    ], string='状态', default='open', required=True)
+    window_end = fields.Datetime(string='合并截止时间', required=True)
+    send_time = fields.Datetime(string='发送时间', readonly=True)
+    message_ids = fields.Many2many(
+        'wechat.message',
+        'wechat_message_digest_rel',
+        'digest_id',
+        'message_id',
+        string='合并的消息'
+    )
+
+    def init(self):
+        super().init()
+        # 每个用户同一时间只有一个合并中的摘要，合并写入依赖此唯一索引
+        self.env.cr.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS wechat_message_digest_open_user_uniq
+                ON wechat_message_digest (wechat_config_id, user_id)
+             WHERE state = 'open'
+        """)
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS wechat_message_digest_open_window_end_index
+                ON wechat_message_digest (window_end)
+             WHERE state = 'open'
+        """)
+
+    @api.model
+    def coalesce_message(self, message_record, recipient_chunks):
+        """将消息并入各目标用户当前的合并摘要，返回合并的用户数
+
+        用户没有合并中的摘要时新建一个，合并窗口从该用户的第一条消息开始计算。
+        """
+        config = message_record.wechat_config_id
+        window_end = fields.Datetime.now() + timedelta(minutes=config.coalesce_window_minutes)
+        coalesced = 0
+        for recipients in recipient_chunks:
+            user_ids, openids = zip(*recipients)
+            self.env.cr.execute("""
+                INSERT INTO wechat_message_digest AS d
+                    (wechat_config_id, user_id, wechat_openid, state, window_end,
+                     create_uid, write_uid, create_date, write_date)
+                SELECT %s, r.user_id, r.openid, 'open', %s,
+                       %s, %s, NOW() AT TIME ZONE 'UTC', NOW() AT TIME ZONE 'UTC'
+                  FROM unnest(%s::int[], %s::varchar[]) AS r(user_id, openid)
+                ON CONFLICT (wechat_config_id, user_id) WHERE state = 'open'
+                DO UPDATE SET wechat_openid = EXCLUDED.wechat_openid,
+                              write_date = EXCLUDED.write_date
+                RETURNING d.id
+            """, (config.id, window_end, self.env.uid, self.env.uid, list(user_ids), list(openids)))
+            digest_ids = [row[0] for row in self.env.cr.fetchall()]
+            self.env.cr.execute("""
+                INSERT INTO wechat_message_digest_rel (digest_id, message_id)
+                SELECT d.id, %s FROM unnest(%s::int[]) AS d(id)
+                ON CONFLICT DO NOTHING
+            """, (message_record.id, digest_ids))
+            coalesced += len(digest_ids)
+        self.invalidate_model()
+        return coalesced
+
+    @api.model
+    def remove_messages(self, message_records):
+        """从合并中的摘要移除消息(取消消息时调用)"""
+        self.env.cr.execute("""
+            DELETE FROM wechat_message_digest_rel rel
+             USING wechat_message_digest d
+             WHERE d.id = rel.digest_id AND d.state = 'open'
+               AND rel.message_id = ANY(%s)
+        """, (message_records.ids,))
+        self.invalidate_model(['message_ids'])
+
+    @api.model
+    def _has_open_digest(self, message_id):
+        """消息是否还有尚未发送的合并摘要"""
+        self.env.cr.execute("""
+            SELECT 1
+              FROM wechat_message_digest_rel rel
+              JOIN wechat_message_digest d ON d.id = rel.digest_id
+             WHERE rel.message_id = %s AND d.state = 'open'
+             LIMIT 1
+        """, (message_id,))
+        return bool(self.env.cr.fetchone())
+
+    def _claim_due(self, batch_size):
+        """原子领取一批合并窗口已结束的摘要"""
+        self.env.cr.execute("""
+            SELECT id FROM wechat_message_digest
+             WHERE state = 'open' AND window_end <= NOW() AT TIME ZONE 'UTC'
+             ORDER BY window_end
+             LIMIT %s
+               FOR UPDATE SKIP LOCKED
+        """, (batch_size,))
+        return self.browse([row[0] for row in self.env.cr.fetchall()])
+
+    def _reserve_digests(self):
+        """标记摘要已发送并为每条原始消息预占用户消息记录
+
+        返回 {(消息ID, 用户ID): 记录ID}，已有记录的用户不会重复发送。
+        调用方提交后再发送，进程中断时不会重复发送。
+        """
+        service = self.env['wechat.notification.service']
+        self.write({'state': 'done', 'send_time': fields.Datetime.now()})
+        reserved = {}
+        for message in self.mapped('message_ids'):
+            recipients = [(d.user_id.id, d.wechat_openid) for d in self if message in d.message_ids]
+            for row_id, user_id, _openid in service._reserve_recipients(message, recipients):
+                reserved[(message.id, user_id)] = row_id
+        return reserved
+
+    def _deliver_digests(self, reserved):
+        """发送同一微信配置下的一批已预占摘要
+
+        每个用户只调用一次模板消息接口，发送结果写回该用户在所有原始消息上的记录，
+        原始消息的统计和失败重试保持不变。只有一条消息的摘要直接发送原始消息。
+        超出当日额度的摘要不发送，各原始消息的记录在额度重置后按原消息重试。
+        """
+        service = self.env['wechat.notification.service']
+        config = self.wechat_config_id
+        sendable = self.filtered(lambda d: any((m.id, d.user_id.id) in reserved for m in d.message_ids))
+        if not sendable:
+            return
+
+        messages_by_digest = {digest: digest._reserved_messages(reserved) for digest in sendable}
+        quota = self.env['wechat.api.quota']
+        quota_day = quota._quota_day()
+        priority = any(message.message_type == 'alert_warning'
+                       for messages in messages_by_digest.values() for message in messages)
+        granted = quota.consume(config, len(sendable), priority=priority)
+        try:
+            access_token = config.get_wechat_access_token()
+            url = config._get_template_send_url(access_token)
+            payloads = []
+            for digest in sendable[:granted]:
+                messages = messages_by_digest[digest]
+                if len(messages) == 1:
+                    payloads.append(service._compile_payload(access_token, messages)
+                                    .render(digest.wechat_openid))
+                else:
+                    payloads.append(service._build_wechat_message_data(
+                        digest.wechat_openid, service._get_template_id(config),
+                        digest._prepare_template_data(messages)))
+            with config._get_template_dispatcher() as dispatcher:
+                results = list(dispatcher.map(url, payloads))
+        except Exception as e:
+            _logger.error(f"发送合并摘要失败: {str(e)}")
+            # 未拿到发送结果，记录按失败重试，预占的额度全部退还
+            quota.release(config, granted, quota_day)
+            results = [{'errcode': -1, 'errmsg': str(e)}] * granted
+        quota.release(config, sum(1 for result in results if result.get('errcode') == CIRCUIT_OPEN_ERRCODE), quota_day)
+        results += [{'errcode': QUOTA_EXCEEDED_ERRCODE, 'errmsg': _('今日模板消息额度已用完')}] * (len(sendable) - granted)
+
+        result_by_user = {digest.user_id.id: result for digest, result in zip(sendable, results)}
+        for message in sendable.mapped('message_ids'):
+            rows = [(row_id, result_by_user[user_id])
+                    for (message_id, user_id), row_id in reserved.items()
+                    if message_id == message.id and user_id in result_by_user]
+            if rows:
+                service._record_delivery_results(message, [row[0] for row in rows], [row[1] for row in rows])
+
+    def _reserved_messages(self, reserved):
+        """摘要中本次为该用户预占成功的原始消息，已有记录的消息不计入"""
+        self.ensure_one()
+        return self.message_ids.filtered(lambda m: (m.id, self.user_id.id) in reserved)
+
+    def _prepare_template_data(self, messages=None):
+        """摘要模板消息数据，跳转到摘要详情页，条数和标题只取实际发送的消息"""
+        self.ensure_one()
+        service = self.env['wechat.notification.service']
+        messages = messages or self.message_ids
+        latest = messages.sorted('id')[-1]
+        return {
+            'thing16': {'value': service._truncate_content(_('您有%s条新通知') % len(messages), 20)},
+            'thing6': {'value': service._truncate_content(latest.report_title, 20)},
+            'time13': {'value': service._format_report_time(self.window_end)},
+            'url': f"{self.get_base_url()}/wechat/message/digest/{self.id}",
+        }
+
+    @api.model
+    def flush_due(self, batch_size=200, time_limit=240):
+        """发送所有合并窗口已结束的摘要，返回处理的摘要数量"""
+        deadline = time.time() + time_limit
+        processed = 0
+        outbox = self.env['wechat.message.outbox']
+        while time.time() < deadline:
+            batch = self._claim_due(batch_size)
+            if not batch:
+                break
+            message_ids = batch.mapped('message_ids').ids
+            reserved = batch._reserve_digests()
+            self.env.cr.commit()
+            for config in batch.mapped('wechat_config_id'):
+                batch.filtered(lambda d: d.wechat_config_id == config)._deliver_digests(reserved)
+                self.env.cr.commit()
+            processed += len(batch)
+            outbox._finalize_messages(message_ids)
+            self.env.invalidate_all()
+        return processed
+
+    @api.model
+    def cron_flush_digests(self):
+        """定时任务：发送合并窗口已结束的消息摘要"""
+        processed = self.flush_due()
+        if processed:
+            _logger.info(f"微信消息合并摘要本次发送: {processed}")
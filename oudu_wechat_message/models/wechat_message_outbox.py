@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2025/09/23 10:33
+@Author  : Jason Zou
+@Email   : zou.jason@qq.com
+@Mobile  ：18951631470
+@Website: http://www.duodoo.tech
+"""
+from odoo import models, fields, api, _
+from odoo.addons.oudu_wechat_message.utils.partitioned_dispatch import run_partitions
+import logging
+import time
+
+_logger = logging.getLogger(__name__)
+
+
+class WechatMessageOutbox(models.Model):
+    _name = 'wechat.message.outbox'
+    _description = '微信消息发送队列'
+    _order = 'id'
+
+    wechat_message_id = fields.Many2one(
+        'wechat.message',
+        string='微信消息',
+        required=True,
+        index=True,
+        ondelete='cascade'
+    )
+
+    user_id = fields.Many2one(
+        'res.users',
+        string='用户',
+        required=True,
+        ondelete='cascade'
+    )
+
+    wechat_openid = fields.Char(string='微信OpenID')
+
+    state = fields.Selection([
+        ('queued', '待发送'),
+        ('done', '已处理'),
+        ('cancelled', '已取消')
+    ], string='状态', default='queued', required=True, index=True)
+
+    processed_time = fields.Datetime(string='处理时间')
+
+    partition_no = fields.Integer(string='分区', default=0, help='多进程分区发送时记录所属的分区')
+
+    canary = fields.Boolean(string='灰度用户', default=False, help='灰度发送时先发送的用户')
+
+    _sql_constraints = [
+        ('unique_outbox_message_user', 'unique(wechat_message_id, user_id)', '同一消息对同一用户只能入队一次!'),
+    ]
+
+    @api.model
+    def enqueue_message(self, message_record, recipient_chunks):
+        """将消息的目标用户逐块写入发送队列，返回入队数量
+
+        recipient_chunks 为 (user_id, openid) 元组列表的迭代器。
+        """
+        queued = 0
+        for recipients in recipient_chunks:
+            user_ids, openids = zip(*recipients)
+            self.env.cr.execute("""
+                INSERT INTO wechat_message_outbox
+                    (wechat_message_id, user_id, wechat_openid, state,
+                     create_uid, write_uid, create_date, write_date)
+                SELECT %s, r.user_id, r.openid, 'queued',
+                       %s, %s, NOW() AT TIME ZONE 'UTC', NOW() AT TIME ZONE 'UTC'
+                  FROM unnest(%s::int[], %s::varchar[]) AS r(user_id, openid)
+                ON CONFLICT (wechat_message_id, user_id) DO NOTHING
+            """, (message_record.id, self.env.uid, self.env.uid, list(user_ids), list(openids)))
+            queued += self.env.cr.rowcount
+        return queued
+
+    @api.model
+    def enqueue_messages(self, message_records, recipient_chunks):
+        """将同一受众的多条消息一并写入发送队列，返回 {消息ID: 入队数量}
+
+        每块用户只写一条 INSERT，与所有消息交叉生成队列记录，受众只需解析一次。
+        """
+        queued = dict.fromkeys(message_records.ids, 0)
+        for recipients in recipient_chunks:
+            user_ids, openids = zip(*recipients)
+            self.env.cr.execute("""
+                INSERT INTO wechat_message_outbox
+                    (wechat_message_id, user_id, wechat_openid, state,
+                     create_uid, write_uid, create_date, write_date)
+                SELECT m.id, r.user_id, r.openid, 'queued',
+                       %s, %s, NOW() AT TIME ZONE 'UTC', NOW() AT TIME ZONE 'UTC'
+                  FROM unnest(%s::int[]) AS m(id)
+                 CROSS JOIN unnest(%s::int[], %s::varchar[]) AS r(user_id, openid)
+                ON CONFLICT (wechat_message_id, user_id) DO NOTHING
+             RETURNING wechat_message_id
+            """, (self.env.uid, self.env.uid, message_records.ids, list(user_ids), list(openids)))
+            for (message_id,) in self.env.cr.fetchall():
+                queued[message_id] += 1
+        return queued
+
+    @api.model
+    def count_queued(self, config, limit):
+        """统计配置下待发送的队列记录数，最多计数到 limit"""
+        self.flush_model(['state'])
+        self.env.cr.execute("""
+            SELECT count(*) FROM (
+                    SELECT 1 FROM wechat_message_outbox o
+                      JOIN wechat_message m ON m.id = o.wechat_message_id
+                     WHERE o.state = 'queued' AND m.wechat_config_id = %s
+                     LIMIT %s
+                 ) q
+        """, (config.id, limit))
+        return self.env.cr.fetchone()[0]
+
+    @api.model
+    def assign_partitions(self, message_record):
+        """按消息的分区方式为队列记录分配分区
+
+        按OpenID哈希分区时各分区用户数大致相同且与用户ID无关；
+        按用户ID区间分区时每个分区是一段连续的用户ID，数量相等。
+        """
+        partitions = message_record.partition_count
+        if message_record.partition_mode == 'openid_hash':
+            self.env.cr.execute("""
+                UPDATE wechat_message_outbox
+                   SET partition_no = abs(hashtext(coalesce(wechat_openid, ''))::bigint) %% %s
+                 WHERE wechat_message_id = %s AND state = 'queued'
+            """, (partitions, message_record.id))
+        elif message_record.partition_mode == 'id_range':
+            self.env.cr.execute("""
+                UPDATE wechat_message_outbox o
+                   SET partition_no = r.partition_no
+                  FROM (
+                        SELECT id, ntile(%s) OVER (ORDER BY user_id) - 1 AS partition_no
+                          FROM wechat_message_outbox
+                         WHERE wechat_message_id = %s AND state = 'queued'
+                       ) r
+                 WHERE o.id = r.id
+            """, (partitions, message_record.id))
+        self.invalidate_model(['partition_no'])
+
+    @api.model
+    def assign_canary(self, message_record, size):
+        """从消息的队列中随机抽取灰度用户"""
+        self.env.cr.execute("""
+            UPDATE wechat_message_outbox
+               SET canary = TRUE
+             WHERE id IN (
+                    SELECT id FROM wechat_message_outbox
+                     WHERE wechat_message_id = %s AND state = 'queued'
+                     ORDER BY random()
+                     LIMIT %s
+                   )
+        """, (message_record.id, size))
+        self.invalidate_model(['canary'])
+        return self.env.cr.rowcount
+
+    @api.model
+    def cancel_message(self, message_record):
+        """取消消息尚未发送的队列记录
+
+        正在被其他进程处理的批次会在其提交后再判断状态，
+        因此取消最多在一个批次内生效。
+        """
+        self.env.cr.execute("""
+            UPDATE wechat_message_outbox
+               SET state = 'cancelled', write_date = NOW() AT TIME ZONE 'UTC'
+             WHERE wechat_message_id = ANY(%s) AND state = 'queued'
+        """, (message_record.ids,))
+        self.invalidate_model(['state'])
+        return self.env.cr.rowcount
+
+    def _claim_batch(self, batch_size, message_id=None, partition=None):
+        """原子领取一批待发送记录
+
+        FOR UPDATE SKIP LOCKED 保证多个进程并行消费时互不重复，
+        行锁一直持有到本批次提交，进程异常退出时记录自动回到待发送状态。
+        已取消或不在发送中的消息不会再被领取，错峰消息在开始时间之前也不会被领取。
+        灰度发送中的消息只领取灰度用户，灰度通过后才领取其余用户。
+        传入 message_id 和 partition 时只领取该消息指定分区的记录；
+        不指定分区时不领取分区消息，分区消息只由进程池中的子进程消费。
+        """
+        self.env.cr.execute("""
+            SELECT o.id
+              FROM wechat_message_outbox o
+              JOIN wechat_message m ON m.id = o.wechat_message_id
+             WHERE o.state = 'queued' AND m.state = 'sending'
+               AND (m.dispatch_after IS NULL OR m.dispatch_after <= NOW() AT TIME ZONE 'UTC')
+               AND (m.canary_state != 'running' OR o.canary)
+               AND (%(message_id)s IS NULL OR o.wechat_message_id = %(message_id)s)
+               AND (%(partition)s IS NULL OR o.partition_no = %(partition)s)
+               AND (%(partition)s IS NOT NULL OR COALESCE(m.partition_count, 0) <= 1
+                    OR m.partition_mode = 'none')
+             ORDER BY o.id
+             LIMIT %(limit)s
+               FOR UPDATE OF o SKIP LOCKED
+        """, {'limit': batch_size, 'message_id': message_id, 'partition': partition})
+        return self.browse([row[0] for row in self.env.cr.fetchall()])
+
+    def _process_batch(self):
+        """发送已领取的一批记录，按消息分组调用通知服务
+
+        队列记录先标记为已处理，与用户消息预占一起提交后才开始发送，
+        进程中断时已预占的用户不会被其他进程重复发送。
+        超出当日剩余额度的记录保持待发送，不会被标记为失败。
+        """
+        service = self.env['wechat.notification.service']
+        quota = self.env['wechat.api.quota']
+        batches = []
+        deferred = self.browse()
+        for message in self.mapped('wechat_message_id'):
+            rows = self.filtered(lambda r: r.wechat_message_id == message)
+            # 当日剩余额度不足时只发送额度内的用户，其余留在队列中，消息顺延到额度重置后继续发送
+            remaining = quota.remaining(message.wechat_config_id, priority=message.message_type == 'alert_warning')
+            if remaining is not None and remaining < len(rows):
+                deferred |= rows[remaining:]
+                rows = rows[:remaining]
+                message._defer_until_quota_reset()
+            if rows:
+                batches.append((message, [(row.user_id.id, row.wechat_openid) for row in rows]))
+        (self - deferred).write({'state': 'done', 'processed_time': fields.Datetime.now()})
+        for message, recipients in batches:
+            try:
+                access_token = message.wechat_config_id.get_wechat_access_token()
+                service._send_batch_messages(access_token, message, recipients, commit=True)
+            except Exception as e:
+                _logger.error(f"队列发送失败 {message.message_sequence}: {str(e)}")
+                service._fail_recipients(message, recipients, str(e), commit=True)
+
+    @api.model
+    def drain(self, batch_size=200, time_limit=240, message_id=None, partition=None):
+        """消费发送队列，直到队列为空或超过时间限制
+
+        每个批次单独提交，可由定时任务和分区子进程同时调用。
+        分区发送的子进程只消费指定消息的一个分区。
+        """
+        deadline = time.time() + time_limit
+        processed = 0
+        if partition is None:
+            self.env['wechat.notification.service']._expire_pending_deliveries()
+            self.env.cr.commit()
+        while time.time() < deadline:
+            batch = self._claim_batch(batch_size, message_id=message_id, partition=partition)
+            if not batch:
+                break
+            message_ids = batch.mapped('wechat_message_id').ids
+            batch._process_batch()
+            self.env.cr.commit()
+            processed += len(batch)
+            self._finalize_messages(message_ids)
+            self.env.invalidate_all()
+        if partition is None:
+            self._finalize_messages()
+        return processed
+
+    @api.model
+    def drain_partitioned(self, batch_size=200, time_limit=240):
+        """多进程分区发送：每条分区消息的各分区在独立的子进程中并行消费
+
+        子进程各自使用独立的数据库游标和HTTP连接池，发送统计通过原子SQL累加直接合并到父消息，
+        全部分区结束后由父进程切换消息的最终状态。通过会话级咨询锁保证同一消息只有一个进程池在运行。
+        返回处理的记录数量。
+        """
+        messages = self.env['wechat.message'].search([
+            ('state', '=', 'sending'),
+            ('partition_mode', '!=', 'none'),
+            ('partition_count', '>', 1),
+            '|', ('dispatch_after', '=', False), ('dispatch_after', '<=', fields.Datetime.now()),
+        ])
+        processed = 0
+        for message in messages:
+            if not self.search_count([('wechat_message_id', '=', message.id), ('state', '=', 'queued')], limit=1):
+                continue
+            self.env.cr.execute("SELECT pg_try_advisory_lock(hashtext('wechat_message_partition'), %s)",
+                                (message.id,))
+            if not self.env.cr.fetchone()[0]:
+                continue
+            try:
+                self.env.cr.commit()
+                results = run_partitions(self.env.cr.dbname, message.id, message.partition_count,
+                                         batch_size=batch_size, time_limit=time_limit)
+                counts = [count for count, _error in results]
+                processed += sum(counts)
+                _logger.info(f"微信消息分区发送: {message.message_sequence}, 各分区处理数量: {counts}")
+                for partition, (_count, error) in enumerate(results):
+                    if error:
+                        # 未领取的记录留在队列中，下次定时任务重新启动该分区
+                        _logger.error(f"分区发送失败 {message.message_sequence} 分区 {partition}:\n{error}")
+            finally:
+                self.env.cr.execute("SELECT pg_advisory_unlock(hashtext('wechat_message_partition'), %s)",
+                                    (message.id,))
+            self.env.invalidate_all()
+            self._finalize_messages(message.ids)
+        return processed
+
+    @api.model
+    def _finalize_messages(self, message_ids=None):
+        """队列全部处理完毕的消息切换为最终状态
+
+        在批次提交之后执行，并锁定消息记录，确保每条消息只切换一次。
+        灰度发送中的消息在灰度用户全部发送完毕后评估是否继续。
+        """
+        domain = [('state', '=', 'sending')]
+        if message_ids:
+            domain.append(('id', 'in', message_ids))
+        for message in self.env['wechat.message'].search(domain):
+            self.env.cr.execute("""
+                SELECT id FROM wechat_message
+                 WHERE id = %s AND state = 'sending'
+                   FOR UPDATE SKIP LOCKED
+            """, (message.id,))
+            if not self.env.cr.fetchone():
+                continue
+            if message.canary_state == 'running':
+                message._evaluate_canary()
+                self.env.cr.commit()
+                continue
+            pending = self.env['wechat.user.message'].search_count([
+                ('wechat_message_id', '=', message.id), ('state', '=', 'pending')
+            ])
+            if pending or self.search_count([('wechat_message_id', '=', message.id), ('state', '=', 'queued')]) \
+                    or self.env['wechat.message.digest']._has_open_digest(message.id) \
+                    or self.env['wechat.message.dead.letter']._has_dead_letters(message.id):
+                self.env.cr.commit()
+                continue
+            message.invalidate_recordset(['sent_count', 'failed_count'])
+            sent_count, failed_count = message.sent_count, message.failed_count
+            message.write({
+                'state': 'sent' if sent_count else 'failed',
+                'actual_send_time': fields.Datetime.now(),
+                'error_message': False if sent_count else _('所有用户发送失败'),
+            })
+            self.env.cr.commit()
+            _logger.info(f"微信消息队列发送完成: {message.message_sequence}, 成功: {sent_count}, 失败: {failed_count}")
+
+    @api.model
+    def cron_drain_outbox(self):
+        """定时任务：消费微信消息发送队列，分区消息先由进程池并行发送
+
+        达到时间限制后队列仍有记录时立即再触发一次，不等下一个调度周期。
+        """
+        processed = self.drain_partitioned() + self.drain()
+        if processed:
+            _logger.info(f"微信消息发送队列本次处理: {processed}")
+            if self.search_count([('state', '=', 'queued')], limit=1):
+                self.env.ref('oudu_wechat_message.ir_cron_drain_outbox').sudo()._trigger()
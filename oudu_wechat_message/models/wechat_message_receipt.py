@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2025/09/23 10:33
+@Author  : Jason Zou
+@Email   : zou.jason@qq.com
+@Mobile  ：18951631470
+@Website: http://www.duodoo.tech
+"""
+from odoo import models, fields, api, _
+from collections import defaultdict
+from datetime import timedelta
+import logging
+import time
+
+_logger = logging.getLogger(__name__)
+
+# 送达回执先于发送结果写回到达时，回执在缓冲中保留等待匹配的时长
+RECEIPT_MATCH_WINDOW = timedelta(hours=1)
+
+
+class WechatMessageReceipt(models.Model):
+    """模板消息送达回执缓冲
+
+    事件推送接口只追加一行回执；定时任务批量取出，按 msgid 索引
+    一条 UPDATE 写回用户消息的送达状态。
+    """
+    _name = 'wechat.message.receipt'
+    _description = '微信模板消息送达回执'
+    _order = 'id'
+    _log_access = False
+
+    msgid = fields.Char(string='微信消息ID', required=True)
+    status = fields.Char(string='推送状态', required=True, help='success 或 failed:user block 等失败原因')
+    received_time = fields.Datetime(string='接收时间', required=True, default=fields.Datetime.now)
+
+    @api.model
+    def record_receipt(self, msgid, status):
+        """追加一条送达回执"""
+        self.env.cr.execute("""
+            INSERT INTO wechat_message_receipt (msgid, status, received_time)
+            VALUES (%s, %s, NOW() AT TIME ZONE 'UTC')
+        """, (str(msgid), status or 'success'))
+
+    def _take_batch(self, batch_size, max_id):
+        """原子取出一批回执，并行的任务取到的回执互不重叠
+
+        只取 max_id 之前的回执，本次放回缓冲的回执留到下次执行。
+        """
+        self.env.cr.execute("""
+            DELETE FROM wechat_message_receipt
+             WHERE id IN (
+                    SELECT id FROM wechat_message_receipt
+                     WHERE id <= %s
+                     ORDER BY id
+                     LIMIT %s
+                       FOR UPDATE SKIP LOCKED
+                   )
+         RETURNING msgid, status, received_time
+        """, (max_id, batch_size))
+        return self.env.cr.fetchall()
+
+    @api.model
+    def _apply_receipts(self, receipts):
+        """按 msgid 批量写回送达状态，返回 (已匹配数, 重新缓冲数)
+
+        只更新仍为"已发送"的记录：成功置为已送达，用户拒收等失败置为发送失败且不再重试，
+        同时修正消息的成功/失败统计。已阅读或已点击的记录保持不变。
+        还没有写回 msgid 的回执在匹配窗口内放回缓冲，下次再处理。
+        """
+        latest = {}
+        for msgid, status, received_time in receipts:
+            latest[msgid] = (status, received_time)
+        msgids = list(latest)
+
+        user_message_model = self.env['wechat.user.message']
+        user_message_model.flush_model(['state', 'message_id', 'error_message'])
+        self.env.cr.execute("""
+            UPDATE wechat_user_message um
+               SET state = CASE WHEN r.status = 'success' THEN 'delivered' ELSE 'failed' END,
+                   error_message = CASE WHEN r.status = 'success' THEN um.error_message ELSE r.status END,
+                   next_retry_time = NULL,
+                   write_date = NOW() AT TIME ZONE 'UTC'
+              FROM unnest(%s::varchar[], %s::varchar[]) AS r(msgid, status)
+             WHERE um.message_id = r.msgid AND um.state = 'sent'
+         RETURNING um.wechat_message_id, um.state
+        """, (msgids, [latest[msgid][0] for msgid in msgids]))
+        rows = self.env.cr.fetchall()
+        deltas = defaultdict(lambda: [0, 0, 0])
+        for message_id, state in rows:
+            if state == 'failed':
+                deltas[message_id][1] -= 1
+                deltas[message_id][2] += 1
+        self.env['wechat.message'].sudo()._increment_send_stats(deltas)
+        user_message_model.invalidate_model(['state', 'error_message', 'next_retry_time'])
+
+        # 找不到对应记录的回执：可能发送结果尚未提交，窗口内放回缓冲
+        self.env.cr.execute("""
+            SELECT r.msgid
+              FROM unnest(%s::varchar[]) AS r(msgid)
+             WHERE NOT EXISTS (SELECT 1 FROM wechat_user_message um WHERE um.message_id = r.msgid)
+        """, (msgids,))
+        cutoff = fields.Datetime.now() - RECEIPT_MATCH_WINDOW
+        pending = [msgid for (msgid,) in self.env.cr.fetchall() if latest[msgid][1] > cutoff]
+        if pending:
+            self.env.cr.execute("""
+                INSERT INTO wechat_message_receipt (msgid, status, received_time)
+                SELECT * FROM unnest(%s::varchar[], %s::varchar[], %s::timestamp[])
+            """, (pending, [latest[msgid][0] for msgid in pending], [latest[msgid][1] for msgid in pending]))
+        return len(rows), len(pending)
+
+    @api.model
+    def flush_receipts(self, batch_size=5000, time_limit=50):
+        """处理缓冲中的送达回执，返回写回的记录数量"""
+        deadline = time.time() + time_limit
+        applied = 0
+        self.env.cr.execute("SELECT COALESCE(MAX(id), 0) FROM wechat_message_receipt")
+        max_id = self.env.cr.fetchone()[0]
+        while time.time() < deadline:
+            receipts = self._take_batch(batch_size, max_id)
+            if not receipts:
+                break
+            matched, _pending = self._apply_receipts(receipts)
+            self.env.cr.commit()
+            applied += matched
+        return applied
+
+    @api.model
+    def cron_flush_receipts(self):
+        """定时任务：写回模板消息送达回执"""
+        applied = self.flush_receipts()
+        if applied:
+            _logger.info(f"微信模板消息送达回执本次写回: {applied}")
@@ -1,11 +1,21 @@
 # -*- coding: utf-8 -*-
-from odoo import models, api, fields, _
+from odoo import models, api, fields, tools, _
 import logging
-import requests
+import random
+import time
+from collections import defaultdict
 from datetime import datetime, timedelta
+from odoo.addons.oudu_wechat_message.utils.template_dispatcher import CompiledTemplateMessage
+from odoo.addons.oudu_wechat_message.utils.circuit_breaker import CIRCUIT_OPEN_ERRCODE
+from odoo.addons.oudu_wechat_message.models.wechat_api_quota import QUOTA_EXCEEDED_ERRCODE
 
 _logger = logging.getLogger(__name__)
 
+# 可重试的错误码：系统繁忙/网络异常、频率限制、access_token失效
+RETRYABLE_ERRCODES = frozenset([-1, 45009, 45011, 45047, 40001, 40014, 42001])
+# 重试间隔上限(秒)
+RETRY_MAX_DELAY = 6 * 3600
+
 
 class WechatNotificationService(models.Model):
     _name = 'wechat.notification.service'
@@ -13,37 +23,35 @@ class WechatNotificationService(models.Model):
 
     @api.model
     def send_wechat_message(self, message_record):
-        """发送微信消息的核心方法"""
+        """发送微信消息的核心方法
+
+        目标用户写入发送队列后立即返回，由队列定时任务分批发送、逐批提交，
+        全部发送完毕后按成功和失败数量切换消息的最终状态。
+        可重复调用：已有用户消息记录或已在队列中的用户不会再次入队。
+        """
         try:
             if not message_record or message_record._name != 'wechat.message':
                 _logger.error("无效的消息记录")
                 return False
 
-            wechat_config = message_record.wechat_config_id
-            if not wechat_config:
+            if not message_record.wechat_config_id:
                 _logger.error("未找到有效的微信配置")
                 return False
 
-            access_token = wechat_config.get_wechat_access_token()
-            if not access_token:
-                _logger.error("获取微信access_token失败")
-                return False
-
-            target_users = self._get_target_users()
-            if not target_users:
+            if message_record.state == 'draft':
+                return message_record.action_send_message()
+
+            batch_size = message_record.wechat_config_id.send_batch_size or 200
+            queued = self.env['wechat.message.outbox'].sudo().enqueue_message(
+                message_record, self._iter_target_recipients(batch_size, exclude_message_id=message_record.id,
+                                                             segment=message_record.segment_id))
+            if queued:
+                if not message_record._start_queued_send(queued):
+                    return False
+                message_record._trigger_outbox_cron()
+            elif not message_record.total_recipients:
                 _logger.warning("没有找到目标用户")
                 return False
-
-            success_count = self._send_batch_messages(access_token, message_record, target_users)
-
-            message_record.write({
-                'state': 'sent',
-                'actual_send_time': fields.Datetime.now(),
-                'sent_count': success_count,
-                'failed_count': len(target_users) - success_count
-            })
-
-            _logger.info(f"微信消息发送完成: {message_record.message_sequence}, 成功: {success_count}")
             return True
 
         except Exception as e:
@@ -53,30 +61,116 @@ class WechatNotificationService(models.Model):
             return False
 
     @api.model
-    def create_and_send_message(self, message_vals):
-        """创建并发送微信消息"""
+    def create_and_send_message(self, message_vals, coalesce=None):
+        """创建并发送微信消息
+
+        coalesce 为 None 时按微信配置的合并窗口决定是否合并发送；
+        合并发送时消息先并入各用户的合并摘要，窗口结束后每个用户只收到一条摘要消息。
+        """
         try:
-            required_fields = ['report_title', 'report_type', 'report_target', 'report_content']
-            if any(field not in message_vals for field in required_fields):
+            message_vals = self._prepare_message_vals(message_vals)
+            if not message_vals:
                 _logger.error("缺少必要字段")
                 return False, None
 
-            default_vals = {
-                'report_time': fields.Datetime.now(),
-                'message_type': 'purchase_notification',
-                'state': 'draft',
-            }
-            message_record = self.env['wechat.message'].create({**default_vals, **message_vals})
-            success = self.send_wechat_message(message_record)
+            message_record = self.env['wechat.message'].create(message_vals)
+            if coalesce is None:
+                coalesce = message_record.wechat_config_id.coalesce_window_minutes > 0
+            if coalesce:
+                success = self.coalesce_wechat_message(message_record)
+            else:
+                success = self.send_wechat_message(message_record)
             return success, message_record.id if success else None
 
         except Exception as e:
             _logger.error(f"创建并发送消息失败: {str(e)}")
             return False, None
 
+    @api.model
+    def _prepare_message_vals(self, message_vals):
+        """补全消息默认值，缺少必要字段时返回 None"""
+        required_fields = ['report_title', 'report_type', 'report_target', 'report_content']
+        if any(field not in message_vals for field in required_fields):
+            return None
+        default_vals = {
+            'report_time': fields.Datetime.now(),
+            'message_type': 'system_notification',
+            'state': 'draft',
+        }
+        return {**default_vals, **message_vals}
+
+    @api.model
+    def create_and_send_many(self, message_vals_list, coalesce=None):
+        """批量创建并发送微信消息，按输入顺序返回消息ID列表
+
+        所有消息一次创建、批量分配编号；微信配置和受众分组相同的消息只解析一次目标用户，
+        在同一事务中写入发送队列(或合并摘要)后立即返回，由定时任务发送。
+        缺少必要字段或没有目标用户的消息对应位置返回 None。
+        """
+        result = [None] * len(message_vals_list)
+        prepared = [(index, self._prepare_message_vals(vals)) for index, vals in enumerate(message_vals_list)]
+        valid = [(index, vals) for index, vals in prepared if vals]
+        if len(valid) < len(prepared):
+            _logger.error(f"批量发送消息中 {len(prepared) - len(valid)} 条缺少必要字段")
+        if not valid:
+            return result
+
+        try:
+            with self.env.cr.savepoint():
+                messages = self.env['wechat.message'].create([vals for _index, vals in valid])
+                groups = defaultdict(lambda: self.env['wechat.message'])
+                for message in messages:
+                    groups[(message.wechat_config_id, message.segment_id)] |= message
+
+                started = set()
+                outbox = self.env['wechat.message.outbox'].sudo()
+                for (config, segment), group in groups.items():
+                    chunk_size = config.send_batch_size or 1000
+                    # 与单条发送相同：未指定时按配置决定，未设置合并窗口时直接发送
+                    use_digest = coalesce is not False and config.coalesce_window_minutes > 0
+                    coalesced = group if use_digest else group.browse()
+                    queued_messages = group - coalesced
+                    if coalesced:
+                        chunks = list(self._iter_target_recipients(chunk_size, segment=segment))
+                        started.update(self._coalesce_many(coalesced, chunks))
+                    if queued_messages:
+                        queued = outbox.enqueue_messages(
+                            queued_messages, self._iter_target_recipients(chunk_size, segment=segment))
+                        for message in queued_messages:
+                            if message._start_queued_send(queued[message.id]):
+                                started.add(message.id)
+
+                messages._trigger_outbox_cron()
+        except Exception as e:
+            _logger.error(f"批量创建并发送消息失败: {str(e)}")
+            return result
+
+        for (index, _vals), message in zip(valid, messages):
+            if message.id in started:
+                result[index] = message.id
+        _logger.info(f"批量发送消息已入队: {len(started)}/{len(message_vals_list)}")
+        return result
+
+    def _coalesce_many(self, messages, recipient_chunks):
+        """将多条消息并入同一批目标用户的合并摘要，返回成功合并的消息ID"""
+        digest_model = self.env['wechat.message.digest'].sudo()
+        coalesced_ids = []
+        for message in messages:
+            if not digest_model.coalesce_message(message, recipient_chunks):
+                message.write({'state': 'failed', 'error_message': _('没有找到目标用户')})
+                continue
+            message.write({'state': 'sending', 'error_message': False})
+            coalesced_ids.append(message.id)
+        if coalesced_ids:
+            cron = self.env.ref('oudu_wechat_message.ir_cron_flush_digests', raise_if_not_found=False)
+            if cron:
+                cron.sudo()._trigger(fields.Datetime.now() + timedelta(
+                    minutes=messages[:1].wechat_config_id.coalesce_window_minutes))
+        return coalesced_ids
+
     @api.model
     def send_quick_notification(self, title, content, message_type='采购通知',
-                                target='全体用户', redirect_url=None):
+                                target='全体用户', redirect_url=None, coalesce=None):
         """快速发送通知"""
         message_vals = {
             'report_title': title,
@@ -85,9 +179,35 @@ class WechatNotificationService(models.Model):
             'report_content': content,
             'redirect_url': redirect_url,
         }
-        success, _ = self.create_and_send_message(message_vals)
+        success, _ = self.create_and_send_message(message_vals, coalesce=coalesce)
         return success
 
+    def coalesce_wechat_message(self, message_record):
+        """将消息并入目标用户的合并摘要，由定时任务在合并窗口结束后发送"""
+        try:
+            if not message_record.wechat_config_id.coalesce_window_minutes:
+                return self.send_wechat_message(message_record)
+
+            digest_model = self.env['wechat.message.digest'].sudo()
+            coalesced = digest_model.coalesce_message(
+                message_record, self._iter_target_recipients(segment=message_record.segment_id))
+            if not coalesced:
+                _logger.warning("没有找到目标用户")
+                return False
+
+            message_record.write({'state': 'sending', 'error_message': False})
+            cron = self.env.ref('oudu_wechat_message.ir_cron_flush_digests', raise_if_not_found=False)
+            if cron:
+                cron.sudo()._trigger(fields.Datetime.now() + timedelta(
+                    minutes=message_record.wechat_config_id.coalesce_window_minutes))
+            _logger.info(f"微信消息已并入合并摘要: {message_record.message_sequence}, 用户数: {coalesced}")
+            return True
+
+        except Exception as e:
+            _logger.error(f"合并微信消息失败: {str(e)}")
+            message_record.write({'state': 'failed', 'error_message': str(e)})
+            return False
+
     def _prepare_template_data(self, message_record):
         """准备模板消息数据"""
         redirect_url = message_record._prepare_redirect_url()
@@ -102,39 +222,274 @@ class WechatNotificationService(models.Model):
             'url': full_url
         }
 
-    def _send_batch_messages(self, access_token, message_record, users):
-        """批量发送消息"""
+    @tools.ormcache('message_id', 'write_date', 'access_token', 'template_id', 'config_write_date', 'base_url')
+    def _get_compiled_payload(self, message_id, write_date, access_token, template_id, config_write_date, base_url):
+        """按消息缓存预编译的发送请求
+
+        模板ID、带access_token的接口地址和序列化后的消息体每条消息只构建一次，
+        发送时只替换touser。消息内容修改(write_date变化)、token轮换、模板ID修改、
+        微信配置修改或网站地址修改后自动重建。
+        """
+        message_record = self.env['wechat.message'].browse(message_id)
+        url = message_record.wechat_config_id._get_template_send_url(access_token)
         template_data = self._prepare_template_data(message_record)
+        message_data = self._build_wechat_message_data(None, template_id, template_data)
+        return CompiledTemplateMessage(url, message_data)
+
+    def _compile_payload(self, access_token, message_record):
+        """获取消息的预编译发送请求"""
+        return self._get_compiled_payload(message_record.id, message_record.write_date, access_token,
+                                          self._get_template_id(message_record.wechat_config_id),
+                                          message_record.wechat_config_id.write_date,
+                                          self.get_base_url())
+
+    def _send_batch_messages(self, access_token, message_record, recipients, commit=False):
+        """批量发送消息
+
+        recipients 为 (user_id, openid) 元组列表，按批处理：
+        先以(wechat_message_id, user_id, send_time)唯一约束为幂等键预占用户消息记录，
+        只发送本次成功预占的用户，再以一条SQL批量写回发送结果。
+        commit=True 时预占和结果分别提交，进程中断最多影响正在发送的一批，
+        且中断的那一批不会被重复发送。
+        """
+        compiled = self._compile_payload(access_token, message_record)
+        config = message_record.wechat_config_id
+        batch_size = config.send_batch_size or 200
         success_count = 0
 
-        for user in users:
-            try:
-                result = self._send_single_message(access_token, template_data, user.wechat_openid)
-                if result.get('errcode') == 0:
-                    success_count += 1
-                    self._create_user_message_record(user, message_record, 'sent', result.get('msgid'))
-                else:
-                    self._create_user_message_record(user, message_record, 'failed',
-                                                     error_message=result.get('errmsg'))
-            except Exception as e:
-                self._create_user_message_record(user, message_record, 'failed', error_message=str(e))
+        with config._get_template_dispatcher() as dispatcher:
+            for start in range(0, len(recipients), batch_size):
+                reserved = self._reserve_recipients(message_record, recipients[start:start + batch_size])
+                if commit:
+                    self.env.cr.commit()
+                if not reserved:
+                    continue
+
+                success_count += self._deliver_reserved(dispatcher, compiled, message_record, reserved)
+                if commit:
+                    self.env.cr.commit()
 
         return success_count
 
-    def _send_single_message(self, access_token, template_data, openid):
-        """发送单条消息到微信API"""
-        try:
-            url = f"https://api.weixin.qq.com/cgi-bin/message/template/send?access_token={access_token}"
-            template_id = self._get_template_id()
-            message_data = self._build_wechat_message_data(openid, template_id, template_data)
+    def _deliver_reserved(self, dispatcher, compiled, message_record, reserved, retry_counts=None):
+        """发送已预占的记录并写回结果，返回成功数量
+
+        reserved 为 (记录ID, user_id, openid) 列表。工作线程只执行HTTP请求，
+        结果回到主线程后再写库，保证ORM单线程访问。
+        发送前先预占当日额度，超出额度的记录不发送，在额度重置后自动重试；
+        熔断期间未发出的请求退还预占的额度。
+        """
+        quota = self.env['wechat.api.quota']
+        quota_day = quota._quota_day()
+        granted = quota.consume(
+            message_record.wechat_config_id, len(reserved), priority=message_record.message_type == 'alert_warning')
+        payloads = [compiled.render(openid) for _row_id, _user_id, openid in reserved[:granted]]
+        if dispatcher.max_workers > 1:
+            results = list(dispatcher.map(compiled.url, payloads))
+        else:
+            results = [dispatcher.post(compiled.url, payload) for payload in payloads]
+        quota.release(message_record.wechat_config_id,
+                      sum(1 for result in results if result.get('errcode') == CIRCUIT_OPEN_ERRCODE), quota_day)
+        results += [{'errcode': QUOTA_EXCEEDED_ERRCODE, 'errmsg': _('今日模板消息额度已用完')}] * (len(reserved) - granted)
+        return self._record_delivery_results(
+            message_record, [row[0] for row in reserved], results, retry_counts)
+
+    def _reserve_recipients(self, message_record, recipients):
+        """预占待发送的用户消息记录，返回 (记录ID, user_id, openid) 列表
+
+        已存在记录的用户(已发送、已失败或正被其他进程发送)不会返回，保证同一消息不会重复发给同一用户。
+        """
+        if not recipients:
+            return []
+        user_ids, openids = zip(*recipients)
+        send_time = message_record._ensure_send_started_time()
+        self.env['wechat.user.message'].flush_model()
+        self.env.cr.execute("""
+            INSERT INTO wechat_user_message
+                (wechat_message_id, user_id, wechat_openid, state, click_count, send_time,
+                 create_uid, write_uid, create_date, write_date)
+            SELECT %s, r.user_id, r.openid, 'pending', 0, %s,
+                   %s, %s, NOW() AT TIME ZONE 'UTC', NOW() AT TIME ZONE 'UTC'
+              FROM unnest(%s::int[], %s::varchar[]) AS r(user_id, openid)
+            ON CONFLICT (wechat_message_id, user_id, send_time) DO NOTHING
+            RETURNING id, user_id, wechat_openid
+        """, (message_record.id, send_time, self.env.uid, self.env.uid, list(user_ids), list(openids)))
+        reserved = self.env.cr.fetchall()
+        message_record._increment_send_stats({message_record.id: [len(reserved), 0, 0]})
+        return reserved
+
+    def _record_delivery_results(self, message_record, user_message_ids, results, retry_counts=None):
+        """以一条UPDATE写回一批预占记录的发送结果，返回成功数量
+
+        可重试的失败会按已重试次数计算下次重试时间，永久性错误不再重试。
+        熔断期间未发出的记录不参与定时重试，转入死信队列等待熔断恢复后重发。
+        超出当日额度未发出的记录在额度重置后重试。
+        """
+        config = message_record.wechat_config_id
+        retry_counts = retry_counts or [0] * len(results)
+        now = fields.Datetime.now()
+        quota_reset = self.env['wechat.api.quota']._next_reset()
+        states, msgids, errors, errcodes, next_retries = [], [], [], [], []
+        for result, retry_count in zip(results, retry_counts):
+            errcode = result.get('errcode')
+            success = errcode == 0
+            states.append('sent' if success else 'failed')
+            msgids.append(str(result['msgid']) if success and result.get('msgid') else None)
+            errors.append(None if success else result.get('errmsg'))
+            errcodes.append(errcode if isinstance(errcode, int) else None)
+            if errcode == QUOTA_EXCEEDED_ERRCODE:
+                next_retries.append(quota_reset)
+                continue
+            delay = None if success else self._get_retry_delay(config, errcode, retry_count)
+            next_retries.append(now + timedelta(seconds=delay) if delay is not None else None)
+
+        self.env.cr.execute("""
+            UPDATE wechat_user_message um
+               SET state = r.state,
+                   message_id = r.msgid,
+                   error_message = r.error,
+                   errcode = r.errcode,
+                   next_retry_time = r.next_retry,
+                   write_date = NOW() AT TIME ZONE 'UTC'
+              FROM unnest(%s::int[], %s::varchar[], %s::varchar[], %s::text[], %s::int[], %s::timestamp[])
+                   AS r(id, state, msgid, error, errcode, next_retry)
+             WHERE um.id = r.id AND um.state = 'pending'
+            RETURNING um.id, r.state, r.errcode
+        """, (list(user_message_ids), states, msgids, errors, errcodes, next_retries))
+        # 只统计本次实际写回的记录，已写回过结果的记录重复写回时不会重复计数
+        written = self.env.cr.fetchall()
+        self.env['wechat.user.message'].browse(user_message_ids).invalidate_recordset()
+        self.env['wechat.message.dead.letter'].park(message_record, [
+            row_id for row_id, _state, errcode in written if errcode == CIRCUIT_OPEN_ERRCODE
+        ])
 
-            response = requests.post(url, json=message_data, timeout=10)
-            response.raise_for_status()
-            return response.json()
+        success_count = sum(1 for _row_id, state, _errcode in written if state == 'sent')
+        message_record._increment_send_stats({
+            message_record.id: [0, success_count, len(written) - success_count]
+        })
+        return success_count
 
-        except Exception as e:
-            _logger.error(f"发送微信消息异常: {str(e)}")
-            return {'errcode': -1, 'errmsg': str(e)}
+    def _fail_recipients(self, message_record, recipients, error_message, commit=False):
+        """未发送即失败的用户(如获取token失败)直接记录为发送失败"""
+        reserved = self._reserve_recipients(message_record, recipients)
+        self._record_delivery_results(
+            message_record, [row[0] for row in reserved],
+            [{'errcode': -1, 'errmsg': error_message}] * len(reserved))
+        if commit:
+            self.env.cr.commit()
+
+    @api.model
+    def _get_retry_delay(self, config, errcode, retry_count):
+        """计算下次重试的等待秒数，不可重试时返回None
+
+        指数退避并加入随机抖动，避免大量失败记录在同一时刻集中重试。
+        """
+        if errcode not in RETRYABLE_ERRCODES or retry_count >= config.retry_max_attempts:
+            return None
+        delay = min(RETRY_MAX_DELAY, (config.retry_base_delay or 60) * (2 ** retry_count))
+        return delay * random.uniform(0.75, 1.25)
+
+    def _claim_retry_batch(self, batch_size):
+        """原子领取一批到期的失败记录重新置为待发送
+
+        与首次发送相同，先提交预占再发送，重试过程中断也不会重复发送。
+        """
+        self.env['wechat.user.message'].flush_model()
+        self.env.cr.execute("""
+            UPDATE wechat_user_message um
+               SET state = 'pending',
+                   retry_count = um.retry_count + 1,
+                   next_retry_time = NULL,
+                   write_date = NOW() AT TIME ZONE 'UTC'
+             WHERE um.id IN (
+                    SELECT r.id
+                      FROM wechat_user_message r
+                      JOIN wechat_message m ON m.id = r.wechat_message_id
+                     WHERE r.state = 'failed'
+                       AND r.next_retry_time <= NOW() AT TIME ZONE 'UTC'
+                       AND m.state IN ('sending', 'sent', 'failed')
+                       AND m.canary_state != 'aborted'
+                     ORDER BY r.next_retry_time
+                     LIMIT %s
+                       FOR UPDATE OF r SKIP LOCKED
+                   )
+            RETURNING um.id, um.wechat_message_id, um.user_id, um.wechat_openid, um.retry_count
+        """, (batch_size,))
+        rows = self.env.cr.fetchall()
+        deltas = {}
+        for row in rows:
+            deltas.setdefault(row[1], [0, 0, 0])[2] -= 1
+        self.env['wechat.user.message'].invalidate_model()
+        self.env['wechat.message']._increment_send_stats(deltas)
+        return rows
+
+    @api.model
+    def retry_failed_deliveries(self, batch_size=200, time_limit=240):
+        """按用户重试到期的失败记录，只处理失败的用户消息记录，返回成功数量"""
+        deadline = time.time() + time_limit
+        success_count = 0
+        touched_message_ids = set()
+        while time.time() < deadline:
+            rows = self._claim_retry_batch(batch_size)
+            self.env.cr.commit()
+            if not rows:
+                break
+            for message in self.env['wechat.message'].browse(sorted({row[1] for row in rows})):
+                message_rows = [row for row in rows if row[1] == message.id]
+                reserved = [row[0:1] + row[2:4] for row in message_rows]
+                retry_counts = [row[4] for row in message_rows]
+                config = message.wechat_config_id
+                try:
+                    access_token = config.get_wechat_access_token()
+                    compiled = self._compile_payload(access_token, message)
+                    with config._get_template_dispatcher() as dispatcher:
+                        success_count += self._deliver_reserved(
+                            dispatcher, compiled, message, reserved, retry_counts)
+                except Exception as e:
+                    _logger.error(f"重试消息失败 {message.message_sequence}: {str(e)}")
+                    self._record_delivery_results(
+                        message, [row[0] for row in reserved],
+                        [{'errcode': -1, 'errmsg': str(e)}] * len(reserved), retry_counts)
+                touched_message_ids.add(message.id)
+                self.env.cr.commit()
+
+        # 全部失败的消息在重试成功后恢复为已发送，灰度中止的消息保持失败
+        for message in self.env['wechat.message'].browse(list(touched_message_ids)):
+            if message.state == 'failed' and message.sent_count and message.canary_state != 'aborted':
+                message.write({'state': 'sent', 'error_message': False})
+        self.env.cr.commit()
+        return success_count
+
+    @api.model
+    def _expire_pending_deliveries(self):
+        """将长时间停留在待发送状态的记录标记为失败
+
+        这些记录所在的批次已被预占但进程在写回结果前中断，无法确认用户是否已收到，
+        为避免重复发送，不会再被自动发送。
+        超时时间按各微信配置一批记录在最低限流速率下的最长发送时间计算，仍在发送的批次不会被误判为中断。
+        """
+        self.env['wechat.user.message'].flush_model()
+        configs = self.env['wechat.sso.config'].with_context(active_test=False).search([])
+        self.env.cr.execute("""
+            UPDATE wechat_user_message um
+               SET state = 'failed',
+                   error_message = %s,
+                   write_date = NOW() AT TIME ZONE 'UTC'
+              FROM wechat_message m,
+                   unnest(%s::int[], %s::int[]) AS c(config_id, max_age)
+             WHERE um.state = 'pending'
+               AND m.id = um.wechat_message_id
+               AND c.config_id = m.wechat_config_id
+               AND um.write_date < NOW() AT TIME ZONE 'UTC' - make_interval(secs => c.max_age)
+            RETURNING um.wechat_message_id
+        """, (_('发送中断，无法确认是否送达，为避免重复发送不再自动重发'),
+              configs.ids, [config._get_pending_expiry_seconds() for config in configs]))
+        deltas = {}
+        for (message_id,) in self.env.cr.fetchall():
+            deltas.setdefault(message_id, [0, 0, 0])[2] += 1
+        self.env['wechat.user.message'].invalidate_model()
+        self.env['wechat.message']._increment_send_stats(deltas)
+        return sum(delta[2] for delta in deltas.values())
 
     def _build_wechat_message_data(self, openid, template_id, template_data):
         """构建微信消息数据"""
@@ -153,13 +508,58 @@ class WechatNotificationService(models.Model):
             }
         }
 
-    def _get_target_users(self):
-        """获取目标用户列表"""
-        return self.env['res.users'].search([
-            ('wechat_openid', '!=', False),
-            ('active', '=', True),
-            # ('wechat_openid', '=', 'o0CMV2NfIVkzQRwX2Jp-xnJiRVQ0'),      # 测试用
-        ])
+    def _iter_target_recipients(self, chunk_size=1000, exclude_message_id=None, segment=None):
+        """按主键游标分页遍历目标用户，逐块返回 (user_id, openid) 元组列表
+
+        只读取两列且每块之后清空环境缓存，内存占用与目标用户总数无关。
+        传入 exclude_message_id 时跳过该消息已有用户消息记录的用户，用于断点续发。
+        传入受众分组时从分组的预计算快照读取，否则遍历所有已绑定微信的用户。
+        """
+        self.env['res.users'].flush_model(['active', 'wechat_openid'])
+        self.env['wechat.user.message'].flush_model(['wechat_message_id', 'user_id'])
+        if segment:
+            segment.sudo()._ensure_snapshot()
+            query = """
+                SELECT s.user_id, s.wechat_openid
+                  FROM wechat_audience_snapshot s
+                 WHERE s.segment_id = %(segment_id)s
+                   AND s.user_id > %(last_id)s
+                   AND NOT EXISTS (
+                        SELECT 1 FROM wechat_user_message um
+                         WHERE um.wechat_message_id = %(message_id)s AND um.user_id = s.user_id
+                   )
+                 ORDER BY s.user_id
+                 LIMIT %(limit)s
+            """
+        else:
+            query = """
+                SELECT u.id, u.wechat_openid
+                  FROM res_users u
+                 WHERE u.id > %(last_id)s
+                   AND u.active
+                   AND u.wechat_openid IS NOT NULL
+                   AND u.wechat_openid != ''
+                   AND NOT EXISTS (
+                        SELECT 1 FROM wechat_user_message um
+                         WHERE um.wechat_message_id = %(message_id)s AND um.user_id = u.id
+                   )
+                 ORDER BY u.id
+                 LIMIT %(limit)s
+            """
+        params = {
+            'segment_id': segment.id if segment else 0,
+            'message_id': exclude_message_id or 0,
+            'limit': chunk_size,
+            'last_id': 0,
+        }
+        while True:
+            self.env.cr.execute(query, params)
+            rows = self.env.cr.fetchall()
+            if not rows:
+                return
+            yield rows
+            params['last_id'] = rows[-1][0]
+            self.env.invalidate_all()
 
     def _format_report_time(self, report_time):
         """格式化报告时间"""
@@ -179,10 +579,9 @@ class WechatNotificationService(models.Model):
         content = str(content).strip()
         return content if len(content) <= max_length else content[:max_length] + '...'
 
-    def _get_template_id(self):
-        """获取微信模板ID误"""
-        # 修复：正确的搜索语法
-        template_config = self.env['wechat.sso.config'].sudo().search([
+    def _get_template_id(self, config=None):
+        """获取微信模板ID，优先使用消息所属配置的模板，未传入配置时取任一启用的配置"""
+        template_config = config or self.env['wechat.sso.config'].sudo().search([
             ('active', '=', True)
         ], limit=1)
 
@@ -195,27 +594,9 @@ class WechatNotificationService(models.Model):
             'XGJp1jOypqrjRrjzok6FLa7KX5clXeRHRFtE3AojdqM'  # 默认模板ID
         )
 
-    def _create_user_message_record(self, user, message_record, state, message_id=None, error_message=None):
-        """创建用户消息记录"""
-        self.env['wechat.user.message'].create({
-            'wechat_message_id': message_record.id,
-            'user_id': user.id,
-            'state': state,
-            'message_id': message_id,
-            'error_message': error_message,
-            'send_time': fields.Datetime.now()
-        })
-
     @api.model
     def cron_retry_failed_messages(self):
-        """定时重试失败的消息"""
-        failed_messages = self.env['wechat.message'].search([
-            ('state', '=', 'failed'),
-            ('create_date', '>=', fields.Datetime.now() - timedelta(days=1))
-        ])
-
-        for message in failed_messages:
-            try:
-                self.send_wechat_message(message)
-            except Exception as e:
-                _logger.error(f"重试消息失败 {message.message_sequence}: {str(e)}")
\ No newline at end of file
+        """定时任务：按用户重试发送失败的记录"""
+        success_count = self.retry_failed_deliveries()
+        if success_count:
+            _logger.info(f"微信消息重试发送成功: {success_count}")
@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2025/09/23 10:33
+@Author  : Jason Zou
+@Email   : zou.jason@qq.com
+@Mobile  ：18951631470
+@Website: http://www.duodoo.tech
+"""
+from odoo import models, fields, api, tools, _
+from odoo.exceptions import UserError, ValidationError
+from odoo.addons.oudu_wechat_message.utils.rate_limiter import SharedRateLimiter
+from odoo.addons.oudu_wechat_message.utils.template_dispatcher import TemplateDispatcher
+from odoo.addons.oudu_wechat_message.utils.event_crypto import WechatEventCrypto
+from odoo.addons.oudu_wechat_message.utils.circuit_breaker import SharedCircuitBreaker
+from datetime import datetime, timedelta
+import logging
+import psycopg2
+
+_logger = logging.getLogger(__name__)
+
+
+class WechatConfig(models.Model):
+    _inherit = 'wechat.sso.config'
+
+    # 模板消息发送吞吐配置
+    send_workers = fields.Integer(
+        string='并发发送线程数',
+        default=4,
+        help='群发模板消息时的并发HTTP线程数，设置为1时逐条顺序发送'
+    )
+    send_batch_size = fields.Integer(
+        string='每批发送数量',
+        default=200,
+        help='每批提交给发送线程池的用户数量，结果按批写回数据库'
+    )
+    send_timeout = fields.Integer(
+        string='发送超时(秒)',
+        default=10,
+        help='单条模板消息HTTP请求的超时时间'
+    )
+
+    send_processes = fields.Integer(
+        string='分区发送进程数',
+        default=1,
+        help='消息选择分区发送时并行发送的进程数，建议不超过发送主机的CPU核数'
+    )
+
+    schedule_stagger_seconds = fields.Integer(
+        string='计划发送错峰间隔(秒)',
+        default=60,
+        help='多条计划消息同时到期时，相邻消息开始发送的间隔'
+    )
+
+    coalesce_window_minutes = fields.Integer(
+        string='消息合并窗口(分钟)',
+        default=0,
+        help='大于0时，同一用户在窗口内收到的通知合并为一条摘要消息发送，0表示逐条发送'
+    )
+
+    # 失败重试配置
+    retry_max_attempts = fields.Integer(
+        string='最大重试次数',
+        default=3,
+        help='可重试错误(系统繁忙、频率限制、token失效等)的单用户最大重试次数，0表示不重试'
+    )
+    retry_base_delay = fields.Integer(
+        string='重试基础间隔(秒)',
+        default=60,
+        help='第N次重试的间隔约为 基础间隔 × 2^N，并加入±25%的随机抖动'
+    )
+
+    # 接口限流配置（按app_id在所有进程间共享）
+    api_rate_limit = fields.Float(
+        string='接口调用上限(次/秒)',
+        default=20,
+        help='调用api.weixin.qq.com接口的每秒请求上限，0表示不限流'
+    )
+    api_rate_min = fields.Float(
+        string='限流退避下限(次/秒)',
+        default=1,
+        help='遇到45009/45011/45047等频率限制错误时，速率最低退避到此值，之后逐步恢复'
+    )
+
+    # 每日额度配置
+    template_daily_quota = fields.Integer(
+        string='模板消息每日额度',
+        default=100000,
+        help='公众号模板消息每日调用上限(北京时间零点重置)，0表示不限；超出额度的用户顺延到次日发送'
+    )
+    template_quota_reserve = fields.Integer(
+        string='预警消息预留额度',
+        default=1000,
+        help='每日额度中只有预警提醒类消息可以使用的部分，保证群发用完额度后预警仍能送达'
+    )
+
+    # 接口熔断配置（按app_id和接口在所有进程间共享）
+    circuit_failure_rate = fields.Float(
+        string='熔断失败率(%)',
+        default=50,
+        help='统计窗口内网络异常、超时和系统繁忙的比例达到此值时熔断，0表示不熔断'
+    )
+    circuit_min_requests = fields.Integer(
+        string='熔断最少请求数',
+        default=20,
+        help='统计窗口内请求数达到此值后才计算失败率'
+    )
+    circuit_window_seconds = fields.Integer(
+        string='熔断统计窗口(秒)',
+        default=60
+    )
+    circuit_open_seconds = fields.Integer(
+        string='熔断持续时间(秒)',
+        default=60,
+        help='熔断打开后经过此时间放行一个探测请求，探测成功后自动重发死信队列中的消息'
+    )
+    dead_letter_max_hours = fields.Integer(
+        string='死信保留时间(小时)',
+        default=24,
+        help='熔断期间未发出的用户消息超过此时间仍未重发成功时不再重发，保持发送失败，消息随即结束发送'
+    )
+
+    # 服务器配置(事件推送)
+    event_token = fields.Char(
+        string='服务器配置Token',
+        help='公众号后台"服务器配置"中填写的Token，用于校验事件推送签名；'
+             '令牌token字段保存的是access_token，不能用于签名校验'
+    )
+    event_url = fields.Char(string='服务器地址(URL)', compute='_compute_event_url',
+                            help='填写到公众号后台"服务器配置"的URL，接收模板消息送达回执等事件')
+
+    # 批量接入配置(外部系统推送通知)
+    ingest_token = fields.Char(
+        string='批量接入Token',
+        copy=False,
+        groups='base.group_system',
+        help='外部系统调用批量接入接口时在 Authorization: Bearer 请求头中携带，为空时不开放接入'
+    )
+    ingest_url = fields.Char(string='批量接入地址', compute='_compute_ingest_url',
+                             help='外部系统以NDJSON或JSON数组批量推送通知的地址')
+    ingest_max_queued = fields.Integer(
+        string='发送队列积压上限',
+        default=500000,
+        help='发送队列中待发送记录超过此值时批量接入接口返回429，要求调用方稍后重试，0表示不限'
+    )
+
+    def init(self):
+        super().init()
+        SharedRateLimiter.create_table(self.env.cr)
+        SharedCircuitBreaker.create_table(self.env.cr)
+
+    def _compute_event_url(self):
+        base_url = self.env['ir.config_parameter'].sudo().get_param('web.base.url')
+        for config in self:
+            config.event_url = f"{base_url}/wechat/message/event/{config.id}" if config.id else False
+
+    def _compute_ingest_url(self):
+        base_url = self.env['ir.config_parameter'].sudo().get_param('web.base.url')
+        for config in self:
+            config.ingest_url = f"{base_url}/wechat/message/ingest/{config.id}" if config.id else False
+
+    def _get_ingest_retry_after(self):
+        """发送队列积压超过上限时返回建议的重试等待秒数，未积压返回 None
+
+        只计数到上限为止，队列很长时也不会全表计数；等待时间按接口限流速率估算消化上限十分之一积压所需的时间。
+        """
+        self.ensure_one()
+        if not self.ingest_max_queued:
+            return None
+        queued = self.env['wechat.message.outbox'].sudo().count_queued(self, self.ingest_max_queued + 1)
+        if queued <= self.ingest_max_queued:
+            return None
+        rate = self.api_rate_limit or 100
+        return max(1, min(300, int(self.ingest_max_queued / 10 / rate)))
+
+    @tools.ormcache('config_id', 'write_date')
+    def _get_cached_event_crypto(self, config_id, write_date):
+        """按配置缓存事件推送的签名校验和解密对象，配置修改(write_date变化)后重建"""
+        config = self.browse(config_id)
+        return WechatEventCrypto(config.event_token, config.encoding_aes_key, config.app_id)
+
+    def _get_event_crypto(self):
+        """获取当前配置的事件推送签名校验和解密对象"""
+        self.ensure_one()
+        return self._get_cached_event_crypto(self.id, self.write_date)
+
+    def _get_pending_expiry_seconds(self):
+        """预占后仍未写回结果的记录多久后视为发送中断
+
+        按一批记录在限流退避到最低速率时的发送时间加上token刷新重发的超时估算，并留出一倍余量，至少15分钟。
+        """
+        self.ensure_one()
+        batch_size = self.send_batch_size or 200
+        timeout = self.send_timeout or 10
+        if self.api_rate_limit > 0:
+            send_seconds = batch_size / max(0.1, self.api_rate_min or 1)
+        else:
+            send_seconds = batch_size / max(1, self.send_workers or 1) * timeout
+        return int(max(900, 2 * (send_seconds + 2 * timeout)))
+
+    def _get_rate_limiter(self):
+        """获取当前配置app_id对应的共享限流器"""
+        self.ensure_one()
+        return SharedRateLimiter(self.env.registry, self.app_id, self.api_rate_limit, self.api_rate_min)
+
+    def _get_circuit_breaker(self):
+        """获取当前配置app_id对应的共享熔断器"""
+        self.ensure_one()
+        return SharedCircuitBreaker(self.env.registry, self.app_id,
+                                    failure_rate=self.circuit_failure_rate / 100.0,
+                                    min_requests=self.circuit_min_requests,
+                                    window_seconds=self.circuit_window_seconds,
+                                    open_seconds=self.circuit_open_seconds,
+                                    probe_timeout=(self.send_timeout or 10) * 3)
+
+    def _get_template_dispatcher(self):
+        """按当前配置创建模板消息发送器，token失效时自动刷新重发，接口故障时熔断"""
+        self.ensure_one()
+        return TemplateDispatcher(max_workers=self.send_workers, timeout=self.send_timeout or 10,
+                                  rate_limiter=self._get_rate_limiter(),
+                                  token_refresher=self._refresh_access_token,
+                                  circuit_breaker=self._get_circuit_breaker())
+
+    @api.model
+    def _get_template_send_url(self, access_token):
+        """模板消息发送接口地址"""
+        return f"{self._get_api_base_url()}/cgi-bin/message/template/send?access_token={access_token}"
+
+    def get_wechat_access_token(self):
+        """缓存的 token 可用时直接返回；需要调用微信接口时在独立事务中获取并立即提交
+
+        调用方的事务(一批发送可能持续较长时间)不写配置记录，不持有其行锁，
+        发送线程中刷新 token 的独立事务不会被调用方未提交的写入阻塞。
+        """
+        self.ensure_one()
+        if self._has_cached_access_token():
+            return self.token
+        return self._fetch_access_token()
+
+    def _has_cached_access_token(self):
+        """缓存的 token 是否仍可直接使用，判断规则与获取 token 时相同(提前5分钟刷新)"""
+        if not self.token or not self.access_token_expires:
+            return False
+        try:
+            expires_time = datetime.strptime(self.access_token_expires, '%Y-%m-%d %H:%M:%S')
+        except (TypeError, ValueError):
+            return False
+        return datetime.now() < expires_time - timedelta(minutes=5)
+
+    def _fetch_access_token(self, stale_token=None):
+        """在独立事务中获取 token 并提交，传入 stale_token 时强制刷新该失效 token
+
+        使用按配置ID的 PG advisory 锁代替锁定配置记录，多个进程和线程同时获取时只有一个真正调用微信接口，
+        其余等待锁释放后在新事务中读取已提交的 token。获得锁后先提交一次，保证读取到锁持有者提交的结果。
+        """
+        self.ensure_one()
+        with self.env.registry.cursor() as cr:
+            cr.execute("SET LOCAL lock_timeout = '10s'")
+            cr.execute("SELECT pg_advisory_lock(hashtext('wechat_token_refresh'), %s)", (self.id,))
+            try:
+                cr.commit()
+                config = self.with_env(self.env(cr=cr, su=True))
+                if stale_token is None:
+                    if config._has_cached_access_token():
+                        return config.token
+                elif config.token and config.token != stale_token:
+                    return config.token
+                else:
+                    config.access_token_expires = False
+
+                config._get_rate_limiter().acquire()
+                token = super(WechatConfig, config).get_wechat_access_token()
+                if stale_token is not None and token == stale_token:
+                    # 稳定版接口在token未过期时返回原token，此时需要强制刷新
+                    force_refresh = config.force_refresh
+                    config.write({'force_refresh': True, 'access_token_expires': False})
+                    config._get_rate_limiter().acquire()
+                    token = super(WechatConfig, config).get_wechat_access_token()
+                    config.force_refresh = force_refresh
+                cr.commit()
+                return token
+            except Exception:
+                cr.rollback()
+                raise
+            finally:
+                cr.execute("SELECT pg_advisory_unlock(hashtext('wechat_token_refresh'), %s)", (self.id,))
+
+    def _refresh_access_token(self, stale_token):
+        """发送过程中token失效时强制刷新，返回新token，失败返回None
+
+        可能在发送线程中调用，不使用调用方的游标。
+        """
+        self.ensure_one()
+        try:
+            token = self._fetch_access_token(stale_token)
+        except (psycopg2.errors.LockNotAvailable, UserError) as e:
+            _logger.warning(f"微信配置ID:{self.id} 刷新token失败: {str(e)}")
+            return None
+        _logger.info(f"微信配置ID:{self.id} 的token已在发送过程中刷新")
+        return token
+
+    @api.constrains('send_workers', 'send_batch_size', 'send_timeout', 'api_rate_limit', 'api_rate_min',
+                    'retry_max_attempts', 'retry_base_delay', 'schedule_stagger_seconds',
+                    'coalesce_window_minutes', 'send_processes', 'circuit_failure_rate',
+                    'circuit_min_requests', 'circuit_window_seconds', 'circuit_open_seconds', 'dead_letter_max_hours',
+                    'template_daily_quota', 'template_quota_reserve', 'ingest_max_queued')
+    def _check_send_settings(self):
+        for config in self:
+            if config.send_workers < 1 or config.send_workers > 64:
+                raise ValidationError(_('并发发送线程数必须在1到64之间'))
+            if config.send_processes < 1 or config.send_processes > 64:
+                raise ValidationError(_('分区发送进程数必须在1到64之间'))
+            if config.send_batch_size < 1:
+                raise ValidationError(_('每批发送数量必须大于0'))
+            if config.send_timeout < 1:
+                raise ValidationError(_('发送超时不能小于1秒'))
+            if config.api_rate_limit < 0 or config.api_rate_min < 0:
+                raise ValidationError(_('接口限流速率不能为负数'))
+            if config.schedule_stagger_seconds < 0:
+                raise ValidationError(_('计划发送错峰间隔不能为负数'))
+            if config.coalesce_window_minutes < 0:
+                raise ValidationError(_('消息合并窗口不能为负数'))
+            if config.retry_max_attempts < 0 or config.retry_base_delay < 1:
+                raise ValidationError(_('重试次数不能为负数，重试间隔不能小于1秒'))
+            if config.circuit_failure_rate < 0 or config.circuit_failure_rate > 100:
+                raise ValidationError(_('熔断失败率必须在0到100之间'))
+            if config.circuit_min_requests < 1 or config.circuit_window_seconds < 1 \
+                    or config.circuit_open_seconds < 1:
+                raise ValidationError(_('熔断最少请求数、统计窗口和持续时间必须大于0'))
+            if config.dead_letter_max_hours < 1:
+                raise ValidationError(_('死信保留时间不能小于1小时'))
+            if config.template_daily_quota < 0 or config.template_quota_reserve < 0:
+                raise ValidationError(_('每日额度和预留额度不能为负数'))
+            if config.template_daily_quota and config.template_quota_reserve >= config.template_daily_quota:
+                raise ValidationError(_('预警消息预留额度必须小于每日额度'))
+            if config.ingest_max_queued < 0:
+                raise ValidationError(_('发送队列积压上限不能为负数'))
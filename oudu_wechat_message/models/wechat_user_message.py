@@ -7,7 +7,21 @@
 @Website: http://www.duodoo.tech
 """
 from odoo import models, fields, api, _
+from odoo.tools.sql import create_index, add_foreign_key, get_foreign_keys
 from typing import Optional
+from collections import defaultdict
+from datetime import date
+from dateutil.relativedelta import relativedelta
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# 提前创建的月分区数量
+PARTITION_MONTHS_AHEAD = 3
+
+# 用户收件箱显示的状态，以及其中计为未读的状态
+INBOX_STATES = ('sent', 'delivered', 'read', 'clicked')
+UNREAD_STATES = ('sent', 'delivered')
 
 
 class WechatUserMessage(models.Model):
@@ -36,6 +50,7 @@ class WechatUserMessage(models.Model):
     )
 
     state = fields.Selection([
+        ('pending', '待发送'),
         ('sent', '已发送'),
         ('delivered', '已送达'),
         ('read', '已阅读'),
@@ -45,22 +60,330 @@ class WechatUserMessage(models.Model):
 
     message_id = fields.Char(string='微信消息ID')
     error_message = fields.Text(string='错误信息')
+    errcode = fields.Integer(string='错误码', readonly=True)
 
-    send_time = fields.Datetime(string='发送时间')
+    # 按用户重试
+    retry_count = fields.Integer(string='重试次数', default=0, readonly=True)
+    next_retry_time = fields.Datetime(string='下次重试时间', readonly=True, index='btree_not_null')
+
+    # 分区键：同一消息的所有记录取消息的开始发送时间，保证唯一约束和幂等预占跨分区有效
+    send_time = fields.Datetime(string='发送时间', required=True, index=True, readonly=True,
+                                default=fields.Datetime.now)
     read_time = fields.Datetime(string='阅读时间')
     click_time = fields.Datetime(string='点击时间')
 
     click_count = fields.Integer(string='点击次数', default=0)
 
-    # 索引优化
+    # 索引优化：分区表的唯一约束必须包含分区键
     _sql_constraints = [
-        ('unique_message_user', 'unique(wechat_message_id, user_id)', '同一消息对同一用户只能有一条记录!'),
+        ('unique_message_user', 'unique(wechat_message_id, user_id, send_time)', '同一消息对同一用户只能有一条记录!'),
     ]
 
+    def init(self):
+        super().init()
+        # 新安装时表为空，直接转换为分区表；已有数据的表由 18.0.3.1 的迁移脚本转换，不在加载注册表时重写
+        if not self._is_partitioned():
+            self.env.cr.execute(f"SELECT 1 FROM {self._table} LIMIT 1")
+            if not self.env.cr.fetchone():
+                self._partition_table()
+        self._create_partitions()
+        self._create_indexes()
+
+    def _create_indexes(self):
+        """创建字段索引和查询用的组合索引，已存在时跳过"""
+        cr = self.env.cr
+        create_index(cr, 'wechat_user_message__send_time_index', self._table, ['send_time'])
+        create_index(cr, 'wechat_user_message__next_retry_time_index', self._table,
+                     ['next_retry_time'], where='next_retry_time IS NOT NULL')
+        # 收件箱按用户游标分页，未读数只扫描部分索引
+        create_index(cr, 'wechat_user_message_user_inbox_index', self._table,
+                     ['user_id', 'send_time DESC', 'id DESC'])
+        create_index(cr, 'wechat_user_message_user_unread_index', self._table,
+                     ['user_id'], where="state IN ('sent', 'delivered')")
+        # 送达回执按微信返回的 msgid 查找记录
+        create_index(cr, 'wechat_user_message_msgid_index', self._table,
+                     ['message_id'], where='message_id IS NOT NULL')
+
+    def _create_foreign_keys(self):
+        """按字段定义创建外键，已存在时跳过"""
+        cr = self.env.cr
+        for column, ondelete in (('wechat_message_id', 'cascade'), ('user_id', 'restrict'),
+                                 ('create_uid', 'set null'), ('write_uid', 'set null')):
+            comodel = self.env[self._fields[column].comodel_name]
+            if not get_foreign_keys(cr, self._table, column, comodel._table, 'id', ondelete):
+                add_foreign_key(cr, self._table, column, comodel._table, 'id', ondelete)
+
+    # 用户收件箱
+    @api.model
+    def _get_inbox_page(self, user_id, limit=20, before=None):
+        """按 (send_time, id) 游标分页读取用户收件箱，返回 (条目列表, 下一页游标)
+
+        只读取页面显示的字段，走 (user_id, send_time DESC, id DESC) 索引，
+        翻到任何一页的代价都只与每页数量有关。before 为上一页返回的游标。
+        """
+        self.flush_model(['user_id', 'send_time', 'state', 'wechat_message_id'])
+        self.env['wechat.message'].flush_model(['report_title', 'report_type', 'report_time', 'report_content'])
+        before_time, before_id = before or (None, None)
+        self.env.cr.execute("""
+            SELECT um.id, um.state, um.send_time,
+                   m.id, m.report_title, m.report_type, m.report_time, left(m.report_content, 120)
+              FROM wechat_user_message um
+              JOIN wechat_message m ON m.id = um.wechat_message_id
+             WHERE um.user_id = %s
+               AND um.state IN %s
+               AND (%s::timestamp IS NULL OR (um.send_time, um.id) < (%s::timestamp, %s))
+             ORDER BY um.send_time DESC, um.id DESC
+             LIMIT %s
+        """, (user_id, INBOX_STATES, before_time, before_time, before_id, limit + 1))
+        rows = self.env.cr.fetchall()
+        items = [{
+            'id': row[0],
+            'state': row[1],
+            'send_time': row[2],
+            'message_id': row[3],
+            'report_title': row[4],
+            'report_type': row[5],
+            'report_time': row[6],
+            'report_content': row[7],
+        } for row in rows[:limit]]
+        next_cursor = (items[-1]['send_time'], items[-1]['id']) if len(rows) > limit else None
+        return items, next_cursor
+
+    @api.model
+    def _count_unread(self, user_id):
+        """用户未读消息数，一条 COUNT 查询"""
+        self.flush_model(['user_id', 'state'])
+        self.env.cr.execute("""
+            SELECT COUNT(*) FROM wechat_user_message
+             WHERE user_id = %s AND state IN %s
+        """, (user_id, UNREAD_STATES))
+        return self.env.cr.fetchone()[0]
+
+    # 按发送时间分区
+    def _is_partitioned(self):
+        self.env.cr.execute("SELECT relkind FROM pg_class WHERE relname = %s", (self._table,))
+        row = self.env.cr.fetchone()
+        return bool(row and row[0] == 'p')
+
+    @api.model
+    def _partition_name(self, month):
+        return f"{self._table}_p{month:%Y%m}"
+
+    def _partition_table(self):
+        """将普通表转换为按 send_time 按月范围分区的表，新安装或 18.0.3.1 迁移时执行
+
+        旧数据整体复制到各月分区，主键改为 (id, send_time)，序列和唯一约束迁移到新表，
+        索引和外键在新表上显式重建(迁移脚本在注册表检查之后运行，不能依赖注册表补建)。
+        """
+        cr = self.env.cr
+        if self._is_partitioned():
+            self._create_indexes()
+            self._create_foreign_keys()
+            return
+        _logger.info("将 wechat_user_message 转换为按发送时间分区的表")
+        cr.execute("""
+            UPDATE wechat_user_message
+               SET send_time = COALESCE(create_date, NOW() AT TIME ZONE 'UTC')
+             WHERE send_time IS NULL
+        """)
+        cr.execute("SELECT MIN(send_time) FROM wechat_user_message")
+        first_time = cr.fetchone()[0]
+
+        cr.execute("ALTER TABLE wechat_user_message RENAME TO wechat_user_message_legacy")
+        cr.execute("""
+            ALTER TABLE wechat_user_message_legacy
+                RENAME CONSTRAINT wechat_user_message_pkey TO wechat_user_message_legacy_pkey
+        """)
+        cr.execute("""
+            CREATE TABLE wechat_user_message (LIKE wechat_user_message_legacy INCLUDING DEFAULTS)
+                PARTITION BY RANGE (send_time)
+        """)
+        cr.execute("ALTER TABLE wechat_user_message ALTER COLUMN send_time SET NOT NULL")
+        cr.execute("ALTER TABLE wechat_user_message ADD CONSTRAINT wechat_user_message_pkey PRIMARY KEY (id, send_time)")
+        self._create_partitions(start=first_time.date() if first_time else None)
+        cr.execute("INSERT INTO wechat_user_message SELECT * FROM wechat_user_message_legacy")
+        cr.execute("ALTER SEQUENCE wechat_user_message_id_seq OWNED BY wechat_user_message.id")
+        cr.execute("DROP TABLE wechat_user_message_legacy")
+        cr.execute("""
+            ALTER TABLE wechat_user_message
+                ADD CONSTRAINT wechat_user_message_unique_message_user
+                UNIQUE (wechat_message_id, user_id, send_time)
+        """)
+        self._create_indexes()
+        self._create_foreign_keys()
+
+    def _create_partitions(self, start=None, months_ahead=PARTITION_MONTHS_AHEAD):
+        """创建从 start(默认本月) 到未来 months_ahead 个月的月分区，以及兜底的默认分区"""
+        cr = self.env.cr
+        if not self._is_partitioned():
+            return
+        this_month = date.today().replace(day=1)
+        month = (start or this_month).replace(day=1)
+        while month <= this_month + relativedelta(months=months_ahead):
+            next_month = month + relativedelta(months=1)
+            try:
+                with cr.savepoint():
+                    cr.execute(f"""
+                        CREATE TABLE IF NOT EXISTS "{self._partition_name(month)}"
+                            PARTITION OF wechat_user_message FOR VALUES FROM (%s) TO (%s)
+                    """, (month, next_month))
+            except Exception as e:
+                # 默认分区中已有该月的数据时无法创建，数据留在默认分区
+                _logger.warning(f"创建用户消息分区 {self._partition_name(month)} 失败: {str(e)}")
+            month = next_month
+        cr.execute(f'CREATE TABLE IF NOT EXISTS "{self._table}_default" PARTITION OF wechat_user_message DEFAULT')
+
+    @api.model
+    def _archive_partitions(self, retention_months):
+        """归档超过保留期的月分区
+
+        每个分区先按消息汇总写入归档表，再 DETACH 并 DROP 整个分区，
+        不产生大批量 DELETE。每个分区单独提交，返回归档的分区数量。
+        """
+        if retention_months <= 0 or not self._is_partitioned():
+            return 0
+        cr = self.env.cr
+        cutoff = date.today().replace(day=1) - relativedelta(months=retention_months)
+        cr.execute("""
+            SELECT c.relname
+              FROM pg_inherits i
+              JOIN pg_class c ON c.oid = i.inhrelid
+              JOIN pg_class p ON p.oid = i.inhparent
+             WHERE p.relname = %s AND c.relname ~ %s
+             ORDER BY c.relname
+        """, (self._table, f'^{self._table}_p[0-9]{{6}}$'))
+        archived = 0
+        for (partition,) in cr.fetchall():
+            month = date(int(partition[-6:-2]), int(partition[-2:]), 1)
+            if month >= cutoff:
+                break
+            self.flush_model()
+            cr.execute(f"""
+                INSERT INTO wechat_user_message_archive AS a
+                    (wechat_message_id, period, total, sent_count, failed_count, clicked_count, click_count,
+                     create_uid, write_uid, create_date, write_date)
+                SELECT wechat_message_id, %s, COUNT(*),
+                       COUNT(*) FILTER (WHERE state NOT IN ('failed', 'pending')),
+                       COUNT(*) FILTER (WHERE state = 'failed'),
+                       COUNT(*) FILTER (WHERE state = 'clicked'),
+                       COALESCE(SUM(click_count), 0),
+                       %s, %s, NOW() AT TIME ZONE 'UTC', NOW() AT TIME ZONE 'UTC'
+                  FROM "{partition}"
+                 GROUP BY wechat_message_id
+                ON CONFLICT (wechat_message_id, period) DO UPDATE SET
+                    total = a.total + EXCLUDED.total,
+                    sent_count = a.sent_count + EXCLUDED.sent_count,
+                    failed_count = a.failed_count + EXCLUDED.failed_count,
+                    clicked_count = a.clicked_count + EXCLUDED.clicked_count,
+                    click_count = a.click_count + EXCLUDED.click_count,
+                    write_date = EXCLUDED.write_date
+            """, (month, self.env.uid, self.env.uid))
+            cr.execute(f'ALTER TABLE wechat_user_message DETACH PARTITION "{partition}"')
+            cr.execute(f'DROP TABLE "{partition}"')
+            cr.commit()
+            archived += 1
+            _logger.info(f"用户消息分区 {partition} 已归档并删除")
+        self.invalidate_model()
+        return archived
+
+    @api.model
+    def cron_maintain_partitions(self):
+        """定时任务：创建未来的月分区，并按保留期归档旧分区
+
+        保留月数由系统参数 oudu_wechat_message.user_message_retention_months 配置，0表示永久保留。
+        """
+        self._create_partitions()
+        self.env.cr.commit()
+        retention = int(self.env['ir.config_parameter'].sudo().get_param(
+            'oudu_wechat_message.user_message_retention_months', 0) or 0)
+        archived = self._archive_partitions(retention)
+        if archived:
+            _logger.info(f"用户消息分区归档完成: {archived}")
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        """发送时间统一取消息的开始发送时间
+
+        唯一约束包含分区键 send_time，只有同一消息的记录发送时间相同时，
+        (消息, 用户) 才能保证只有一条记录，与 _reserve_recipients 的预占保持一致。
+        """
+        messages = self.env['wechat.message'].browse(
+            {vals['wechat_message_id'] for vals in vals_list if vals.get('wechat_message_id')})
+        send_times = {message.id: message._ensure_send_started_time() for message in messages}
+        for vals in vals_list:
+            if vals.get('wechat_message_id'):
+                vals['send_time'] = send_times[vals['wechat_message_id']]
+        records = super().create(vals_list)
+        records._apply_send_stats(records._collect_send_stats(1))
+        return records
+
+    def write(self, vals):
+        # 发送时间是分区键和唯一约束的一部分，创建后不能修改
+        vals.pop('send_time', None)
+        if 'state' not in vals:
+            return super().write(vals)
+        deltas = self._collect_send_stats(-1, with_total=False)
+        result = super().write(vals)
+        for message_id, delta in self._collect_send_stats(1, with_total=False).items():
+            deltas[message_id] = [a + b for a, b in zip(deltas[message_id], delta)]
+        self._apply_send_stats(deltas)
+        return result
+
+    def unlink(self):
+        deltas = self._collect_send_stats(-1)
+        result = super().unlink()
+        self._apply_send_stats(deltas)
+        return result
+
+    def _collect_send_stats(self, sign, with_total=True):
+        """按消息汇总本批记录对发送统计的影响，待发送记录只计入目标用户数"""
+        deltas = defaultdict(lambda: [0, 0, 0])
+        for record in self:
+            delta = deltas[record.wechat_message_id.id]
+            if with_total:
+                delta[0] += sign
+            if record.state == 'failed':
+                delta[2] += sign
+            elif record.state != 'pending':
+                delta[1] += sign
+        return deltas
+
+    def _apply_send_stats(self, deltas):
+        self.env['wechat.message'].sudo()._increment_send_stats(deltas)
+
     def mark_as_clicked(self) -> None:
-        """标记为已点击"""
+        """标记为已点击，点击次数用 x = x + 1 原子累加，并发点击不会因读改写丢失计数"""
+        if not self:
+            return
         self.write({
             'state': 'clicked',
             'click_time': fields.Datetime.now(),
-            'click_count': self.click_count + 1
-        })
\ No newline at end of file
+        })
+        self.flush_recordset(['click_count'])
+        self.env.cr.execute("""
+            UPDATE wechat_user_message SET click_count = click_count + 1 WHERE id IN %s
+        """, (tuple(self.ids),))
+        self.invalidate_recordset(['click_count'])
+
+class WechatUserMessageArchive(models.Model):
+    _name = 'wechat.user.message.archive'
+    _description = '微信用户消息归档汇总'
+    _order = 'period desc, wechat_message_id'
+
+    wechat_message_id = fields.Many2one(
+        'wechat.message',
+        string='微信消息',
+        required=True,
+        index=True,
+        ondelete='cascade'
+    )
+    period = fields.Date(string='归档月份', required=True)
+    total = fields.Integer(string='用户数')
+    sent_count = fields.Integer(string='成功发送数')
+    failed_count = fields.Integer(string='失败发送数')
+    clicked_count = fields.Integer(string='点击用户数')
+    click_count = fields.Integer(string='点击次数')
+
+    _sql_constraints = [
+        ('unique_message_period', 'unique(wechat_message_id, period)', '同一消息每个月只有一条归档汇总!'),
+    ]
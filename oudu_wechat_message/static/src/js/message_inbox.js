@@ -0,0 +1,41 @@
+/** @odoo-module **/
+
+/**
+ * 消息列表无限滚动
+ *
+ * "加载更多"链接进入可视区域时按游标请求下一页条目并追加到列表，
+ * 未启用脚本时链接仍可直接翻页。
+ */
+function setupInfiniteScroll(list) {
+    let loading = false;
+    const observer = new IntersectionObserver(async (entries) => {
+        const more = list.querySelector(".o_wechat_message_more");
+        if (loading || !more || !entries.some((entry) => entry.isIntersecting)) {
+            return;
+        }
+        loading = true;
+        try {
+            const response = await fetch(more.href, {
+                headers: { "X-Requested-With": "XMLHttpRequest" },
+            });
+            if (response.ok) {
+                more.remove();
+                list.insertAdjacentHTML("beforeend", await response.text());
+                const next = list.querySelector(".o_wechat_message_more");
+                if (next) {
+                    observer.observe(next);
+                }
+            }
+        } finally {
+            loading = false;
+        }
+    });
+    const more = list.querySelector(".o_wechat_message_more");
+    if (more) {
+        observer.observe(more);
+    }
+}
+
+document.addEventListener("DOMContentLoaded", () => {
+    document.querySelectorAll(".o_wechat_message_inbox").forEach(setupInfiniteScroll);
+});
@@ -0,0 +1,77 @@
+/** @odoo-module **/
+
+import { Component, onWillStart, onWillUnmount, useState } from "@odoo/owl";
+import { registry } from "@web/core/registry";
+import { useService } from "@web/core/utils/hooks";
+import { standardWidgetProps } from "@web/views/widgets/standard_widget_props";
+
+/**
+ * 微信消息发送进度
+ *
+ * 订阅 bus.bus 推送的发送进度，实时显示成功/失败数量、发送速率和预计剩余时间，
+ * 不需要刷新表单，也不产生额外的数据库查询。发送结束时重新加载一次表单记录。
+ * 频道名由服务端 ir.websocket 校验读取权限后转换为消息记录频道。
+ */
+export class WechatSendProgress extends Component {
+    static template = "oudu_wechat_message.WechatSendProgress";
+    static props = { ...standardWidgetProps };
+
+    setup() {
+        this.busService = useService("bus_service");
+        const data = this.props.record.data;
+        this.progress = useState({
+            state: data.state,
+            total: data.total_recipients,
+            sent: data.sent_count,
+            failed: data.failed_count,
+            rate: 0,
+            eta: null,
+        });
+        this.channel = `wechat_message_progress_${this.props.record.resId}`;
+        this.onProgress = this.onProgress.bind(this);
+
+        onWillStart(() => {
+            if (this.props.record.resId) {
+                this.busService.addChannel(this.channel);
+                this.busService.subscribe("wechat_message_progress", this.onProgress);
+            }
+        });
+        onWillUnmount(() => {
+            if (this.props.record.resId) {
+                this.busService.unsubscribe("wechat_message_progress", this.onProgress);
+                this.busService.deleteChannel(this.channel);
+            }
+        });
+    }
+
+    onProgress(payload) {
+        if (payload.id !== this.props.record.resId) {
+            return;
+        }
+        const finished = this.progress.state === "sending" && payload.state !== "sending";
+        Object.assign(this.progress, payload);
+        if (finished) {
+            this.props.record.load();
+        }
+    }
+
+    get percent() {
+        const { total, sent, failed } = this.progress;
+        return total ? Math.min(100, Math.round(((sent + failed) * 100) / total)) : 0;
+    }
+
+    get etaLabel() {
+        const eta = this.progress.eta;
+        if (!eta) {
+            return "-";
+        }
+        const hours = Math.floor(eta / 3600);
+        const minutes = Math.floor((eta % 3600) / 60);
+        const seconds = eta % 60;
+        return hours ? `${hours}时${minutes}分` : minutes ? `${minutes}分${seconds}秒` : `${seconds}秒`;
+    }
+}
+
+registry.category("view_widgets").add("wechat_send_progress", {
+    component: WechatSendProgress,
+});
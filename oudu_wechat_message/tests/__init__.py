@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from . import test_outbox
+from . import test_delivery
+from . import test_api_quota
+from . import test_canary
+from . import test_template_dispatcher
+from . import test_recipients
+from . import test_rate_limiter
+from . import test_compiled_payload
+from . import test_send_stats
+from . import test_scheduled_send
+from . import test_audience_segment
+from . import test_digest
+from . import test_access_token
+from . import test_send_progress
+from . import test_partitioned_send
+from . import test_user_message_partitions
+from . import test_inbox
+from . import test_click_events
+from . import test_event_crypto
+from . import test_receipts
+from . import test_circuit_breaker
+from . import test_batch_send
+from . import test_ingest
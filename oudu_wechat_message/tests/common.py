@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2025/09/23 10:33
+@Author  : Jason Zou
+@Email   : zou.jason@qq.com
+@Mobile  ：18951631470
+@Website: http://www.duodoo.tech
+"""
+import json
+from odoo import fields
+from odoo.tests.common import TransactionCase
+from odoo.addons.oudu_wechat_message.utils.template_dispatcher import TemplateDispatcher
+
+
+class WechatMessageCase(TransactionCase):
+    """发送队列相关测试的公共数据：独立公司下的微信配置和三个已绑定微信的用户
+
+    队列消费、结束发送等方法在批次之间提交事务，测试中将提交替换为空操作。
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # 额度台账和限流器使用独立游标，测试期间需要与测试事务共用连接
+        if cls.registry.test_cr is None:
+            cls.registry.enter_test_mode(cls.cr)
+            cls.addClassCleanup(cls.registry.leave_test_mode)
+        company = cls.env['res.company'].create({'name': 'WeChat Test Company'})
+        cls.config = cls.env['wechat.sso.config'].create({
+            'name': 'Test Config',
+            'company_id': company.id,
+            'app_id': 'wx_test_app',
+            'app_secret': 'secret',
+            'template_daily_quota': 0,
+            'circuit_failure_rate': 0,
+            'api_rate_limit': 0,
+        })
+        cls.users = cls.env['res.users'].create([{
+            'name': f'WeChat User {index}',
+            'login': f'wechat_user_{index}',
+            'wechat_openid': f'openid_{index}',
+        } for index in range(3)])
+        cls.recipients = [(user.id, user.wechat_openid) for user in cls.users]
+
+    def setUp(self):
+        super().setUp()
+        self.patch(self.env.cr, 'commit', lambda: None)
+        self.outbox = self.env['wechat.message.outbox']
+        self.service = self.env['wechat.notification.service']
+
+    def _create_message(self, **vals):
+        return self.env['wechat.message'].create({
+            'message_title': 'Test',
+            'report_title': 'Title',
+            'report_type': 'Type',
+            'report_target': 'Target',
+            'report_time': fields.Datetime.now(),
+            'report_content': 'Content',
+            'wechat_config_id': self.config.id,
+            **vals,
+        })
+
+    def _patch_send(self, handler=None):
+        """不请求微信接口：token 固定为 token_1，每个请求交给 handler(payload) 返回结果
+
+        返回按发送顺序记录的请求体(已解析为字典)列表，handler 默认全部成功。
+        """
+        payloads = []
+
+        def fake_post(dispatcher, url, payload):
+            payload = json.loads(payload) if isinstance(payload, bytes) else payload
+            payloads.append(payload)
+            return handler(payload) if handler else {'errcode': 0, 'msgid': len(payloads)}
+
+        self.patch(TemplateDispatcher, '_post', fake_post)
+        self.patch(type(self.env['wechat.sso.config']), 'get_wechat_access_token', lambda config: 'token_1')
+        return payloads
+
+    def _deliver(self, message, recipients, results):
+        """预占用户并按给定结果写回，模拟一批发送"""
+        reserved = self.service._reserve_recipients(message, recipients)
+        self.service._record_delivery_results(message, [row[0] for row in reserved], results)
+        return reserved
+
+    def _user_message_states(self, message):
+        user_messages = self.env['wechat.user.message'].search([('wechat_message_id', '=', message.id)])
+        return sorted(user_messages.mapped('state'))
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import requests
+from odoo.tests import tagged
+from .common import WechatMessageCase
+
+
+class FakeResponse:
+
+    def __init__(self, data):
+        self.data = data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.data
+
+
+@tagged('post_install', '-at_install')
+class TestAccessTokenRefresh(WechatMessageCase):
+
+    def setUp(self):
+        super().setUp()
+        self.requests = []
+
+        def fake_post(url, json=None, timeout=None):
+            self.requests.append(json)
+            return FakeResponse({'access_token': f'token_{len(self.requests)}', 'expires_in': 7200})
+
+        self.patch(requests, 'post', fake_post)
+
+    def test_get_token_cached(self):
+        self.assertEqual(self.config.get_wechat_access_token(), 'token_1')
+        self.config.invalidate_recordset()
+        self.assertEqual(self.config.get_wechat_access_token(), 'token_1')
+        self.assertEqual(len(self.requests), 1)
+
+    def test_refresh_stale_token_once(self):
+        stale = self.config.get_wechat_access_token()
+        self.assertEqual(self.config._refresh_access_token(stale), 'token_2')
+        # 其他线程随后报告同一个失效token时直接使用已刷新的token
+        self.assertEqual(self.config._refresh_access_token(stale), 'token_2')
+        self.assertEqual(len(self.requests), 2)
+
+    def test_refresh_while_caller_holds_row(self):
+        # 调用方事务中修改过配置记录(持有行锁)时刷新不会被阻塞
+        self.config.write({'send_timeout': 12})
+        self.config.flush_recordset()
+        self.assertEqual(self.config._refresh_access_token('token_old'), 'token_1')
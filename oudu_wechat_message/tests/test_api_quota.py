@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+from odoo.tests import tagged
+from odoo.addons.oudu_wechat_message.models.wechat_api_quota import QUOTA_EXCEEDED_ERRCODE
+from .common import WechatMessageCase
+
+
+@tagged('post_install', '-at_install')
+class TestWechatApiQuota(WechatMessageCase):
+
+    def setUp(self):
+        super().setUp()
+        self.quota = self.env['wechat.api.quota']
+        self.config.write({'template_daily_quota': 10, 'template_quota_reserve': 2})
+
+    def test_consume_within_limit(self):
+        self.assertEqual(self.quota.consume(self.config, 5), 5)
+        # 普通消息不能使用预留给预警消息的额度
+        self.assertEqual(self.quota.consume(self.config, 5), 3)
+        self.assertEqual(self.quota.remaining(self.config), 0)
+        self.assertEqual(self.quota.consume(self.config, 5, priority=True), 2)
+        self.assertEqual(self.quota.remaining(self.config, priority=True), 0)
+
+    def test_release(self):
+        self.quota.consume(self.config, 8)
+        self.quota.release(self.config, 3)
+        self.assertEqual(self.quota.remaining(self.config), 3)
+        self.quota.release(self.config, 100)
+        self.assertEqual(self.quota.remaining(self.config), 8)
+
+    def test_unlimited(self):
+        self.config.template_daily_quota = 0
+        self.assertEqual(self.quota.consume(self.config, 1000), 1000)
+        self.assertIsNone(self.quota.remaining(self.config))
+
+
+@tagged('post_install', '-at_install')
+class TestQuotaDelivery(WechatMessageCase):
+
+    def setUp(self):
+        super().setUp()
+        self.quota = self.env['wechat.api.quota']
+        self.config.write({'template_daily_quota': 10, 'template_quota_reserve': 2})
+        self.message = self._create_message()
+        self.message.state = 'sending'
+
+    def _deliver_batch(self):
+        reserved = self.service._reserve_recipients(self.message, self.recipients)
+        compiled = self.service._compile_payload('token_1', self.message)
+        with self.config._get_template_dispatcher() as dispatcher:
+            self.service._deliver_reserved(dispatcher, compiled, self.message, reserved)
+        return self.env['wechat.user.message'].browse([row[0] for row in reserved])
+
+    def test_beyond_quota_deferred(self):
+        payloads = self._patch_send()
+        self.quota.consume(self.config, 7)
+        user_messages = self._deliver_batch()
+        self.assertEqual(len(payloads), 1)
+        self.assertEqual(user_messages.mapped('state'), ['sent', 'failed', 'failed'])
+        self.assertEqual(user_messages[1:].mapped('errcode'), [QUOTA_EXCEEDED_ERRCODE] * 2)
+        self.assertEqual(set(user_messages[1:].mapped('next_retry_time')), {self.quota._next_reset()})
+
+    def test_circuit_open_refunded(self):
+        payloads = self._patch_send()
+        self.config.write({'circuit_failure_rate': 50, 'circuit_min_requests': 1})
+        self.config._get_circuit_breaker().record('/cgi-bin/message/template/send', False)
+        user_messages = self._deliver_batch()
+        self.assertFalse(payloads)
+        self.assertEqual(set(user_messages.mapped('state')), {'failed'})
+        self.assertEqual(self.quota.remaining(self.config), 8)
+        self.assertTrue(self.env['wechat.message.dead.letter']._has_dead_letters(self.message.id))
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from odoo.exceptions import UserError, ValidationError
+from odoo.tests import tagged
+from .common import WechatMessageCase
+
+
+@tagged('post_install', '-at_install')
+class TestAudienceSegment(WechatMessageCase):
+
+    def setUp(self):
+        super().setUp()
+        self.segment = self.env['wechat.audience.segment'].create({
+            'name': 'Test Segment',
+            'domain': str([('id', 'in', self.users[:2].ids)]),
+        })
+
+    def _snapshot(self):
+        snapshots = self.env['wechat.audience.snapshot'].search([('segment_id', '=', self.segment.id)])
+        return [(snapshot.user_id.id, snapshot.wechat_openid) for snapshot in snapshots]
+
+    def test_refresh_incremental(self):
+        self.segment.refresh_snapshot(chunk_size=1)
+        self.assertEqual(self._snapshot(), self.recipients[:2])
+        self.assertEqual(self.segment.snapshot_count, 2)
+
+        self.users[0].wechat_openid = 'openid_changed'
+        self.users[1].active = False
+        self.segment.domain = str([('id', 'in', self.users.ids)])
+        self.segment.refresh_snapshot(chunk_size=1)
+        self.assertEqual(self._snapshot(), [(self.users[0].id, 'openid_changed'), self.recipients[2]])
+
+    def test_send_reads_snapshot(self):
+        self.segment.refresh_snapshot()
+        # 快照之后绑定的用户不在本次发送范围内
+        self.segment.domain = str([('id', 'in', self.users.ids)])
+        message = self._create_message(segment_id=self.segment.id)
+        recipients = [row for chunk in self.service._iter_target_recipients(segment=self.segment) for row in chunk]
+        self.assertEqual(recipients, self.recipients[:2])
+        message.action_send_message()
+        queued = self.outbox.search([('wechat_message_id', '=', message.id)])
+        self.assertEqual(queued.user_id, self.users[:2])
+
+    def test_no_refresh_while_sending(self):
+        self.segment.refresh_snapshot()
+        message = self._create_message(segment_id=self.segment.id)
+        message.state = 'sending'
+        self.segment.domain = str([('id', 'in', self.users.ids)])
+        self.segment.refresh_snapshot()
+        self.assertEqual(len(self._snapshot()), 2)
+        with self.assertRaises(UserError):
+            self.segment.action_refresh_snapshot()
+
+    def test_invalid_domain(self):
+        with self.assertRaises(ValidationError):
+            self.segment.domain = "[('no_such_field', '=', 1)]"
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from odoo.tests import tagged
+from .common import WechatMessageCase
+
+
+@tagged('post_install', '-at_install')
+class TestBatchSend(WechatMessageCase):
+
+    def _vals(self, **vals):
+        return {
+            'message_title': 'Batch',
+            'report_title': 'Title',
+            'report_type': 'Type',
+            'report_target': 'Target',
+            'report_content': 'Content',
+            'wechat_config_id': self.config.id,
+            **vals,
+        }
+
+    def _queued_user_ids(self, message_id):
+        return set(self.outbox.search([('wechat_message_id', '=', message_id)]).mapped('user_id').ids)
+
+    def test_messages_queued_in_order(self):
+        message_ids = self.service.create_and_send_many([self._vals(message_title=f'Batch {n}') for n in range(3)])
+        messages = self.env['wechat.message'].browse(message_ids)
+        self.assertEqual(messages.mapped('message_title'), ['Batch 0', 'Batch 1', 'Batch 2'])
+        self.assertEqual(set(messages.mapped('state')), {'sending'})
+        for message in messages:
+            self.assertLessEqual(set(self.users.ids), self._queued_user_ids(message.id))
+
+    def test_sequences_allocated(self):
+        message_ids = self.service.create_and_send_many([self._vals() for _n in range(3)])
+        sequences = self.env['wechat.message'].browse(message_ids).mapped('message_sequence')
+        self.assertEqual(len(set(sequences)), 3)
+        self.assertNotIn('New', sequences)
+
+    def test_invalid_vals_return_none(self):
+        invalid = self._vals()
+        del invalid['report_content']
+        message_ids = self.service.create_and_send_many([self._vals(), invalid, self._vals()])
+        self.assertIsNone(message_ids[1])
+        self.assertTrue(message_ids[0] and message_ids[2])
+
+    def test_defaults_applied(self):
+        message_id, = self.service.create_and_send_many([self._vals()])
+        message = self.env['wechat.message'].browse(message_id)
+        self.assertEqual(message.message_type, 'system_notification')
+        self.assertTrue(message.report_time)
+
+    def test_coalesced_into_digest(self):
+        self.config.coalesce_window_minutes = 5
+        message_ids = self.service.create_and_send_many([self._vals(), self._vals()])
+        self.assertTrue(all(message_ids))
+        self.assertFalse(self.outbox.search([('wechat_message_id', 'in', message_ids)]))
+        digests = self.env['wechat.message.digest'].search([
+            ('wechat_config_id', '=', self.config.id), ('user_id', 'in', self.users.ids)])
+        self.assertEqual(len(digests), 3)
+        for digest in digests:
+            self.assertEqual(sorted(digest.message_ids.ids), sorted(message_ids))
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+from odoo.tests import tagged
+from odoo.addons.oudu_wechat_message.utils.circuit_breaker import CIRCUIT_OPEN_ERRCODE
+from .common import WechatMessageCase
+
+
+@tagged('post_install', '-at_install')
+class TestWechatMessageCanary(WechatMessageCase):
+
+    def _start_canary(self, results):
+        """前两个用户作为灰度用户并按给定结果发送完毕"""
+        message = self._create_message(canary_size=2, canary_error_threshold=20)
+        self.outbox.enqueue_message(message, [self.recipients])
+        self.outbox.assign_canary(message, 2)
+        message.write({'state': 'sending', 'canary_state': 'running'})
+        canary = self.outbox.search([('wechat_message_id', '=', message.id), ('canary', '=', True)])
+        self.assertEqual(len(canary), 2)
+        canary.write({'state': 'done'})
+        self._deliver(message, [(row.user_id.id, row.wechat_openid) for row in canary], results)
+        return message
+
+    def test_claim_only_canary_while_running(self):
+        message = self._create_message(canary_size=1)
+        self.outbox.enqueue_message(message, [self.recipients])
+        self.outbox.assign_canary(message, 1)
+        message.write({'state': 'sending', 'canary_state': 'running'})
+        claimed = self.outbox._claim_batch(10)
+        self.assertEqual(len(claimed), 1)
+        self.assertTrue(claimed.canary)
+
+    def test_canary_passed(self):
+        message = self._start_canary([{'errcode': 0, 'msgid': 1}] * 2)
+        message._evaluate_canary()
+        self.assertEqual(message.canary_state, 'passed')
+        self.assertEqual(message.state, 'sending')
+        self.assertEqual(len(self.outbox._claim_batch(10)), 1)
+
+    def test_canary_aborted(self):
+        message = self._start_canary([{'errcode': 0, 'msgid': 1}, {'errcode': 40037, 'errmsg': 'invalid template'}])
+        message._evaluate_canary()
+        self.assertEqual(message.canary_state, 'aborted')
+        self.assertEqual(message.state, 'failed')
+        self.assertIn('40037', message.canary_result)
+        self.assertFalse(self.outbox._claim_batch(10))
+
+    def test_canary_ignores_unsent(self):
+        message = self._start_canary([{'errcode': 0, 'msgid': 1},
+                                      {'errcode': CIRCUIT_OPEN_ERRCODE, 'errmsg': 'circuit open'}])
+        message._evaluate_canary()
+        self.assertEqual(message.canary_state, 'passed')
+
+    def test_canary_waits_for_results(self):
+        message = self._create_message(canary_size=2)
+        self.outbox.enqueue_message(message, [self.recipients])
+        self.outbox.assign_canary(message, 2)
+        message.write({'state': 'sending', 'canary_state': 'running'})
+        self.outbox._claim_batch(10).write({'state': 'done'})
+        message._evaluate_canary()
+        self.assertEqual(message.canary_state, 'running')
+
+    def test_aborted_not_retried(self):
+        message = self._start_canary([{'errcode': 0, 'msgid': 1}, {'errcode': -1, 'errmsg': 'timeout'}])
+        message._evaluate_canary()
+        self.assertEqual(message.canary_state, 'aborted')
+        self.env['wechat.user.message'].flush_model()
+        self.env.cr.execute("""
+            UPDATE wechat_user_message SET next_retry_time = NOW() AT TIME ZONE 'UTC' - interval '1 minute'
+             WHERE wechat_message_id = %s AND state = 'failed'
+        """, (message.id,))
+        payloads = self._patch_send()
+        self.assertEqual(self.service.retry_failed_deliveries(), 0)
+        self.assertFalse(payloads)
+        message.invalidate_recordset()
+        self.assertEqual(message.state, 'failed')
+
+    def test_aborted_dead_letters_not_replayed(self):
+        message = self._start_canary([{'errcode': CIRCUIT_OPEN_ERRCODE, 'errmsg': 'circuit open'},
+                                      {'errcode': 40037, 'errmsg': 'invalid template'}])
+        message._evaluate_canary()
+        self.assertEqual(message.canary_state, 'aborted')
+        payloads = self._patch_send()
+        self.assertEqual(self.env['wechat.message.dead.letter'].replay(), 0)
+        self.assertFalse(payloads)
+        message.invalidate_recordset()
+        self.assertEqual(message.state, 'failed')
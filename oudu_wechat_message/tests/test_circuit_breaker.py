@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+from odoo.tests import tagged
+from odoo.addons.oudu_wechat_message.utils.circuit_breaker import CIRCUIT_OPEN_ERRCODE
+from .common import WechatMessageCase
+
+SEND_ENDPOINT = '/cgi-bin/message/template/send'
+
+
+@tagged('post_install', '-at_install')
+class TestCircuitBreaker(WechatMessageCase):
+
+    def setUp(self):
+        super().setUp()
+        self.config.write({
+            'circuit_failure_rate': 50,
+            'circuit_min_requests': 3,
+            'circuit_window_seconds': 60,
+            'circuit_open_seconds': 60,
+        })
+        self.breaker = self.config._get_circuit_breaker()
+
+    def _open(self, seconds_ago=0):
+        for _i in range(3):
+            self.breaker.record(SEND_ENDPOINT, False)
+        self.env.cr.execute("""
+            UPDATE wechat_api_circuit SET opened_at = clock_timestamp() - make_interval(secs => %s)
+             WHERE endpoint = %s
+        """, (seconds_ago, f'{self.config.app_id}:{SEND_ENDPOINT}'))
+
+    def test_opens_on_failure_rate(self):
+        self.breaker.record(SEND_ENDPOINT, True)
+        self.breaker.record(SEND_ENDPOINT, False)
+        self.assertTrue(self.breaker.is_closed(SEND_ENDPOINT))
+        self.breaker.record(SEND_ENDPOINT, False)
+        self.assertFalse(self.breaker.is_closed(SEND_ENDPOINT))
+        self.assertFalse(self.breaker.allow(SEND_ENDPOINT))
+        self.assertFalse(self.breaker.probe_due(SEND_ENDPOINT))
+
+    def test_single_probe_closes(self):
+        self._open(seconds_ago=120)
+        self.assertTrue(self.breaker.probe_due(SEND_ENDPOINT))
+        self.assertEqual(self.breaker.allow(SEND_ENDPOINT), 'probe')
+        # 探测进行中其他请求仍直接失败
+        self.assertFalse(self.config._get_circuit_breaker().allow(SEND_ENDPOINT))
+        self.breaker.record(SEND_ENDPOINT, True, probe=True)
+        self.assertTrue(self.breaker.is_closed(SEND_ENDPOINT))
+        self.assertIs(self.breaker.allow(SEND_ENDPOINT), True)
+
+    def test_failed_probe_reopens(self):
+        self._open(seconds_ago=120)
+        self.assertEqual(self.breaker.allow(SEND_ENDPOINT), 'probe')
+        self.breaker.record(SEND_ENDPOINT, False, probe=True)
+        self.assertFalse(self.breaker.probe_due(SEND_ENDPOINT))
+        self.assertFalse(self.breaker.allow(SEND_ENDPOINT))
+
+    def test_dispatcher_skips_requests_while_open(self):
+        payloads = self._patch_send()
+        self._open()
+        with self.config._get_template_dispatcher() as dispatcher:
+            result = dispatcher.post(self.config._get_template_send_url('token_1'), {})
+        self.assertEqual(result['errcode'], CIRCUIT_OPEN_ERRCODE)
+        self.assertFalse(payloads)
+
+
+@tagged('post_install', '-at_install')
+class TestDeadLetters(WechatMessageCase):
+
+    def setUp(self):
+        super().setUp()
+        self.config.write({'circuit_failure_rate': 50, 'circuit_min_requests': 3, 'circuit_open_seconds': 60})
+        self.dead_letters = self.env['wechat.message.dead.letter']
+        self.message = self._create_message()
+        self.message.state = 'sending'
+        reserved = self._deliver(self.message, self.recipients[:1],
+                                 [{'errcode': CIRCUIT_OPEN_ERRCODE, 'errmsg': 'circuit open'}])
+        self.user_message = self.env['wechat.user.message'].browse(reserved[0][0])
+
+    def test_circuit_open_parked(self):
+        self.assertEqual(self.user_message.state, 'failed')
+        self.assertFalse(self.user_message.next_retry_time)
+        self.assertTrue(self.dead_letters._has_dead_letters(self.message.id))
+
+    def test_replay_after_recovery(self):
+        payloads = self._patch_send()
+        self.assertEqual(self.dead_letters.replay(), 1)
+        self.assertEqual([payload['touser'] for payload in payloads], ['openid_0'])
+        self.user_message.invalidate_recordset()
+        self.assertEqual(self.user_message.state, 'sent')
+        self.assertFalse(self.dead_letters._has_dead_letters(self.message.id))
+
+    def test_replay_waits_while_open(self):
+        payloads = self._patch_send()
+        breaker = self.config._get_circuit_breaker()
+        for _i in range(3):
+            breaker.record(SEND_ENDPOINT, False)
+        self.assertEqual(self.dead_letters.replay(), 0)
+        self.assertFalse(payloads)
+        self.assertTrue(self.dead_letters._has_dead_letters(self.message.id))
+
+    def test_expired_not_replayed(self):
+        payloads = self._patch_send()
+        self.config.dead_letter_max_hours = 1
+        self.env.flush_all()
+        self.env.cr.execute("""
+            UPDATE wechat_user_message SET create_date = NOW() AT TIME ZONE 'UTC' - interval '2 hours'
+             WHERE id = %s
+        """, (self.user_message.id,))
+        self.assertEqual(self.dead_letters.replay(), 0)
+        self.assertFalse(payloads)
+        self.assertFalse(self.dead_letters._has_dead_letters(self.message.id))
+        self.user_message.invalidate_recordset()
+        self.assertEqual(self.user_message.state, 'failed')
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from odoo.tests import tagged
+from .common import WechatMessageCase
+
+
+@tagged('post_install', '-at_install')
+class TestClickEvents(WechatMessageCase):
+
+    def setUp(self):
+        super().setUp()
+        self.events = self.env['wechat.message.click.event']
+        self.message = self._create_message()
+        self.user_messages = self.env['wechat.user.message'].create([{
+            'wechat_message_id': self.message.id,
+            'user_id': user.id,
+            'state': state,
+        } for user, state in zip(self.users, ('sent', 'sent', 'pending'))])
+
+    def _flush(self):
+        processed = self.events.flush_events()
+        (self.user_messages | self.message).invalidate_recordset()
+        return processed
+
+    def test_redirect_clicks_accumulate(self):
+        for _i in range(3):
+            self.events.record_event(self.message.id, user_id=self.users[0].id)
+        # 未登录时按跳转链接中的 openid 匹配用户
+        self.events.record_event(self.message.id, openid='openid_1')
+        self.assertEqual(self._flush(), 4)
+        self.assertEqual(self.user_messages.mapped('click_count'), [3, 1, 0])
+        self.assertEqual(self.user_messages.mapped('state'), ['clicked', 'clicked', 'pending'])
+        self.assertEqual(self.message.open_count, 4)
+        self.assertFalse(self.events.search_count([]))
+
+    def test_detail_counts_first_view_only(self):
+        self.events.record_event(self.message.id, user_id=self.users[0].id, source='detail')
+        self.events.record_event(self.message.id, user_id=self.users[0].id, source='detail')
+        self._flush()
+        self.events.record_event(self.message.id, user_id=self.users[0].id, source='detail')
+        self._flush()
+        self.assertEqual(self.user_messages[0].click_count, 1)
+        self.assertEqual(self.user_messages[0].state, 'clicked')
+        self.assertEqual(self.message.open_count, 0)
+
+    def test_event_without_user_ignored(self):
+        self.events.record_event(self.message.id)
+        self.events.record_event(self.message.id, openid='unknown_openid')
+        self.assertEqual(self._flush(), 1)
+        self.assertEqual(self.user_messages.mapped('click_count'), [0, 0, 0])
+
+    def test_mark_as_clicked_increments(self):
+        self.user_messages[0].mark_as_clicked()
+        self.user_messages[0].mark_as_clicked()
+        self.assertEqual(self.user_messages[0].click_count, 2)
+        self.assertEqual(self.user_messages[0].state, 'clicked')
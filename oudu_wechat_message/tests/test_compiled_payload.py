@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+import json
+from odoo.tests import tagged
+from .common import WechatMessageCase
+
+
+@tagged('post_install', '-at_install')
+class TestCompiledPayload(WechatMessageCase):
+
+    def setUp(self):
+        super().setUp()
+        self.config.template_id = 'template_a'
+        self.message = self._create_message()
+
+    def test_render_matches_message_data(self):
+        compiled = self.service._compile_payload('token_1', self.message)
+        template_data = self.service._prepare_template_data(self.message)
+        for openid in ('openid_0', 'open"id\\1'):
+            self.assertEqual(json.loads(compiled.render(openid)),
+                             self.service._build_wechat_message_data(openid, 'template_a', template_data))
+        self.assertIn('access_token=token_1', compiled.url)
+
+    def test_cached_per_message_and_token(self):
+        compiled = self.service._compile_payload('token_1', self.message)
+        self.assertIs(self.service._compile_payload('token_1', self.message), compiled)
+        rotated = self.service._compile_payload('token_2', self.message)
+        self.assertIsNot(rotated, compiled)
+        self.assertIn('access_token=token_2', rotated.url)
+
+    def test_template_from_message_config(self):
+        other_config = self.env['wechat.sso.config'].create({
+            'name': 'Other Config',
+            'company_id': self.env['res.company'].create({'name': 'WeChat Other Company'}).id,
+            'app_id': 'wx_other_app',
+            'app_secret': 'secret',
+            'template_id': 'template_b',
+        })
+        message = self._create_message(wechat_config_id=other_config.id)
+        payload = json.loads(self.service._compile_payload('token_1', message).render('openid_0'))
+        self.assertEqual(payload['template_id'], 'template_b')
+        payload = json.loads(self.service._compile_payload('token_1', self.message).render('openid_0'))
+        self.assertEqual(payload['template_id'], 'template_a')
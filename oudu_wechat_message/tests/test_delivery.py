@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+from odoo.tests import tagged
+from .common import WechatMessageCase
+
+
+@tagged('post_install', '-at_install')
+class TestWechatMessageDelivery(WechatMessageCase):
+
+    def test_reserve_recipients_once(self):
+        message = self._create_message()
+        reserved = self.service._reserve_recipients(message, self.recipients)
+        self.assertEqual(len(reserved), 3)
+        self.assertEqual(self.service._reserve_recipients(message, self.recipients), [])
+        message.invalidate_recordset()
+        self.assertEqual(message.total_recipients, 3)
+        self.assertEqual(self._user_message_states(message), ['pending'] * 3)
+
+    def test_results_written_once(self):
+        message = self._create_message()
+        reserved = self._deliver(message, self.recipients[:1], [{'errcode': 0, 'msgid': 1}])
+        # 已写回的记录不再是待发送状态，重复写回不会改变结果和统计
+        self.service._record_delivery_results(message, [reserved[0][0]], [{'errcode': -1, 'errmsg': 'x'}])
+        message.invalidate_recordset()
+        self.assertEqual(self._user_message_states(message), ['sent'])
+        self.assertEqual((message.sent_count, message.failed_count), (1, 0))
+
+    def test_results_written_in_bulk(self):
+        message = self._create_message()
+        reserved = self._deliver(message, self.recipients, [
+            {'errcode': 0, 'msgid': 101},
+            {'errcode': 0, 'msgid': 102},
+            {'errcode': 40003, 'errmsg': 'invalid openid'},
+        ])
+        user_messages = self.env['wechat.user.message'].browse([row[0] for row in reserved])
+        self.assertEqual(user_messages.mapped('state'), ['sent', 'sent', 'failed'])
+        self.assertEqual(user_messages.mapped('message_id'), ['101', '102', False])
+        self.assertEqual(user_messages[2].errcode, 40003)
+        self.assertEqual(user_messages[2].error_message, 'invalid openid')
+        self.assertEqual(user_messages.mapped('wechat_openid'), [openid for _user_id, openid in self.recipients])
+        message.invalidate_recordset()
+        self.assertEqual((message.total_recipients, message.sent_count, message.failed_count), (3, 2, 1))
+
+    def test_resend_skips_existing_recipients(self):
+        message = self._create_message()
+        message.state = 'sending'
+        self._deliver(message, self.recipients[:1], [{'errcode': 0, 'msgid': 1}])
+        self.assertTrue(self.service.send_wechat_message(message))
+        queued = self.outbox.search([('wechat_message_id', '=', message.id), ('user_id', 'in', self.users.ids)])
+        self.assertEqual(queued.user_id, self.users[1:])
+        # 再次调用不会重复入队
+        self.service.send_wechat_message(message)
+        self.assertEqual(self.outbox.search_count([('wechat_message_id', '=', message.id),
+                                                   ('user_id', 'in', self.users.ids)]), 2)
+
+    def test_expire_interrupted_pending(self):
+        message = self._create_message()
+        reserved = self.service._reserve_recipients(message, self.recipients[:2])
+        max_age = self.config._get_pending_expiry_seconds()
+        self.env['wechat.user.message'].flush_model()
+        for row_id, age in ((reserved[0][0], max_age - 60), (reserved[1][0], max_age + 60)):
+            self.env.cr.execute("""
+                UPDATE wechat_user_message SET write_date = NOW() AT TIME ZONE 'UTC' - make_interval(secs => %s)
+                 WHERE id = %s
+            """, (age, row_id))
+        self.assertEqual(self.service._expire_pending_deliveries(), 1)
+        self.assertEqual(self._user_message_states(message), ['failed', 'pending'])
+        message.invalidate_recordset()
+        self.assertEqual(message.failed_count, 1)
+
+    def test_pending_expiry_follows_rate(self):
+        self.config.write({'send_batch_size': 200, 'send_timeout': 10, 'api_rate_limit': 20, 'api_rate_min': 0.1})
+        # 一批200条按最低0.1次/秒发送需要2000秒，留出一倍余量
+        self.assertEqual(self.config._get_pending_expiry_seconds(), 2 * (2000 + 20))
+        self.config.api_rate_min = 10
+        self.assertEqual(self.config._get_pending_expiry_seconds(), 900)
+
+    def test_retry_delay(self):
+        self.config.write({'retry_max_attempts': 3, 'retry_base_delay': 60})
+        self.assertIsNone(self.service._get_retry_delay(self.config, 40003, 0))
+        self.assertIsNone(self.service._get_retry_delay(self.config, -1, 3))
+        for retry_count in range(3):
+            delay = self.service._get_retry_delay(self.config, -1, retry_count)
+            base = 60 * 2 ** retry_count
+            self.assertTrue(base * 0.75 <= delay <= base * 1.25)
+
+    def test_retry_claim(self):
+        message = self._create_message()
+        message.state = 'sending'
+        self._deliver(message, self.recipients[:2], [
+            {'errcode': -1, 'errmsg': 'system busy'},
+            {'errcode': 40003, 'errmsg': 'invalid openid'},
+        ])
+        # 只有到期的可重试失败记录会被领取
+        self.assertEqual(self.service._claim_retry_batch(10), [])
+        self.env['wechat.user.message'].flush_model()
+        self.env.cr.execute("""
+            UPDATE wechat_user_message SET next_retry_time = NOW() AT TIME ZONE 'UTC' - interval '1 minute'
+             WHERE wechat_message_id = %s AND next_retry_time IS NOT NULL
+        """, (message.id,))
+        rows = self.service._claim_retry_batch(10)
+        self.assertEqual([(row[2], row[4]) for row in rows], [(self.users[0].id, 1)])
+        message.invalidate_recordset()
+        self.assertEqual(message.failed_count, 1)
+        self.assertEqual(self._user_message_states(message), ['failed', 'pending'])
+
+    def test_retry_claim_skips_aborted_canary(self):
+        message = self._create_message()
+        message.state = 'sending'
+        self._deliver(message, self.recipients[:1], [{'errcode': -1, 'errmsg': 'system busy'}])
+        message.write({'state': 'failed', 'canary_state': 'aborted'})
+        self.env['wechat.user.message'].flush_model()
+        self.env.cr.execute("""
+            UPDATE wechat_user_message SET next_retry_time = NOW() AT TIME ZONE 'UTC' - interval '1 minute'
+             WHERE wechat_message_id = %s
+        """, (message.id,))
+        self.assertEqual(self.service._claim_retry_batch(10), [])
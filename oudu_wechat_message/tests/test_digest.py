@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+from odoo.tests import tagged
+from .common import WechatMessageCase
+
+
+@tagged('post_install', '-at_install')
+class TestMessageDigest(WechatMessageCase):
+
+    def setUp(self):
+        super().setUp()
+        self.config.coalesce_window_minutes = 10
+        self.digest = self.env['wechat.message.digest']
+        self.payloads = self._patch_send()
+
+    def _coalesce(self, count=2, **vals):
+        messages = self.env['wechat.message']
+        for index in range(count):
+            message = self._create_message(report_title=f'Title {index}', **vals)
+            self.digest.coalesce_message(message, [self.recipients])
+            message.state = 'sending'
+            messages |= message
+        return messages
+
+    def _end_windows(self):
+        self.digest.flush_model()
+        self.env.cr.execute("""
+            UPDATE wechat_message_digest SET window_end = NOW() AT TIME ZONE 'UTC' - interval '1 minute'
+             WHERE user_id = ANY(%s)
+        """, (self.users.ids,))
+        self.digest.invalidate_model()
+
+    def test_coalesce_into_open_digest(self):
+        messages = self._coalesce()
+        digests = self.digest.search([('user_id', 'in', self.users.ids)])
+        self.assertEqual(len(digests), 3)
+        for digest in digests:
+            self.assertEqual(digest.message_ids, messages)
+            self.assertEqual(digest.state, 'open')
+
+    def test_flush_waits_for_window(self):
+        self._coalesce()
+        self.assertEqual(self.digest.flush_due(), 0)
+        self.assertFalse(self.payloads)
+
+    def test_flush_sends_once_per_user(self):
+        messages = self._coalesce()
+        self._end_windows()
+        self.assertEqual(self.digest.flush_due(), 3)
+        self.assertEqual(sorted(payload['touser'] for payload in self.payloads), ['openid_0', 'openid_1', 'openid_2'])
+        self.assertTrue(all('2条' in payload['data']['thing16']['value'] for payload in self.payloads))
+        for message in messages:
+            self.assertEqual(self._user_message_states(message), ['sent'] * 3)
+
+    def test_count_only_reserved_messages(self):
+        messages = self._coalesce()
+        # 第一条消息已经单独发给了第一个用户
+        self._deliver(messages[0], self.recipients[:1], [{'errcode': 0, 'msgid': 1}])
+        self._end_windows()
+        self.digest.flush_due()
+        payload = next(payload for payload in self.payloads if payload['touser'] == 'openid_0')
+        self.assertEqual(payload['data']['thing16']['value'], 'Title 1')
+
+    def test_alert_uses_reserved_quota(self):
+        self.config.write({'template_daily_quota': 10, 'template_quota_reserve': 2})
+        self.env['wechat.api.quota'].consume(self.config, 8)
+        self._coalesce(message_type='alert_warning')
+        self._end_windows()
+        self.digest.flush_due()
+        self.assertEqual(len(self.payloads), 2)
+
+    def test_send_error_releases_quota(self):
+        self.config.write({'template_daily_quota': 10, 'template_quota_reserve': 0})
+        self._coalesce()
+        self._end_windows()
+
+        def token_error(config):
+            raise RuntimeError('token error')
+
+        self.patch(type(self.env['wechat.sso.config']), 'get_wechat_access_token', token_error)
+        self.digest.flush_due()
+        self.assertEqual(self.env['wechat.api.quota'].remaining(self.config), 10)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import base64
+import hashlib
+import os
+import struct
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from odoo.tests import tagged
+from odoo.tests.common import BaseCase
+from odoo.addons.oudu_wechat_message.utils.event_crypto import EventCryptoError, WechatEventCrypto
+
+TOKEN = 'event_token'
+AES_KEY = base64.b64encode(bytes(range(32))).decode().rstrip('=')
+APP_ID = 'wx_test_app'
+
+
+def encrypt(xml, app_id=APP_ID, key=AES_KEY):
+    """按微信安全模式加密推送内容"""
+    raw_key = base64.b64decode(key + '=')
+    plain = os.urandom(16) + struct.pack('>I', len(xml.encode())) + xml.encode() + app_id.encode()
+    pad = 32 - len(plain) % 32
+    plain += bytes([pad]) * pad
+    encryptor = Cipher(algorithms.AES(raw_key), modes.CBC(raw_key[:16])).encryptor()
+    return base64.b64encode(encryptor.update(plain) + encryptor.finalize()).decode()
+
+
+@tagged('post_install', '-at_install')
+class TestWechatEventCrypto(BaseCase):
+
+    def setUp(self):
+        super().setUp()
+        self.crypto = WechatEventCrypto(TOKEN, AES_KEY, APP_ID)
+
+    def test_check_signature(self):
+        signature = hashlib.sha1(''.join(sorted([TOKEN, '1700000000', 'nonce'])).encode()).hexdigest()
+        self.assertTrue(self.crypto.check_signature(signature, '1700000000', 'nonce'))
+        self.assertFalse(self.crypto.check_signature(signature, '1700000001', 'nonce'))
+        self.assertFalse(WechatEventCrypto('').check_signature(signature, '1700000000', 'nonce'))
+
+    def test_check_msg_signature(self):
+        encrypted = encrypt('<xml/>')
+        signature = hashlib.sha1(''.join(sorted([TOKEN, '1700000000', 'nonce', encrypted])).encode()).hexdigest()
+        self.assertTrue(self.crypto.check_signature(signature, '1700000000', 'nonce', encrypted))
+        self.assertFalse(self.crypto.check_signature(signature, '1700000000', 'nonce'))
+
+    def test_decrypt(self):
+        xml = '<xml><Event><![CDATA[TEMPLATESENDJOBFINISH]]></Event><Status>中文</Status></xml>'
+        self.assertEqual(self.crypto.decrypt(encrypt(xml)), xml)
+
+    def test_decrypt_other_app(self):
+        with self.assertRaises(EventCryptoError):
+            self.crypto.decrypt(encrypt('<xml/>', app_id='wx_other_app'))
+
+    def test_decrypt_invalid_input(self):
+        for encrypted in ('not base64!', base64.b64encode(b'short').decode(), base64.b64encode(bytes(32)).decode()):
+            with self.assertRaises(EventCryptoError):
+                self.crypto.decrypt(encrypted)
+
+    def test_invalid_key_only_fails_decrypt(self):
+        crypto = WechatEventCrypto(TOKEN, 'too_short', APP_ID)
+        signature = hashlib.sha1(''.join(sorted([TOKEN, '1', 'n'])).encode()).hexdigest()
+        self.assertTrue(crypto.check_signature(signature, '1', 'n'))
+        with self.assertRaises(EventCryptoError):
+            crypto.decrypt(encrypt('<xml/>'))
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from odoo.tests import tagged
+from odoo.addons.oudu_wechat_message.controllers.wechat_message_controllers import WechatMessageController
+from .common import WechatMessageCase
+
+
+@tagged('post_install', '-at_install')
+class TestUserInbox(WechatMessageCase):
+
+    def setUp(self):
+        super().setUp()
+        self.UserMessage = self.env['wechat.user.message']
+        self.user = self.users[0]
+        self.inbox = self.UserMessage.browse()
+        for state in ('sent', 'delivered', 'read', 'clicked', 'sent', 'pending', 'failed'):
+            self.inbox |= self.UserMessage.create({
+                'wechat_message_id': self._create_message().id,
+                'user_id': self.user.id,
+                'state': state,
+            })
+
+    def test_keyset_pages(self):
+        shown = self.inbox.filtered(lambda um: um.state not in ('pending', 'failed'))
+        expected = shown.sorted(lambda um: (um.send_time, um.id), reverse=True).ids
+        pages, before = [], None
+        while True:
+            items, before = self.UserMessage._get_inbox_page(self.user.id, limit=2, before=before)
+            pages.append([item['id'] for item in items])
+            if not before:
+                break
+        self.assertEqual(pages, [expected[0:2], expected[2:4], expected[4:]])
+        self.assertEqual(items[-1]['report_title'], 'Title')
+
+    def test_unread_count(self):
+        self.assertEqual(self.UserMessage._count_unread(self.user.id), 3)
+        self.assertEqual(self.UserMessage._count_unread(self.users[1].id), 0)
+
+    def test_cursor_round_trip(self):
+        items, cursor = self.UserMessage._get_inbox_page(self.user.id, limit=1)
+        value = WechatMessageController._format_inbox_cursor(cursor)
+        self.assertEqual(WechatMessageController._parse_inbox_cursor(value), cursor)
+        self.assertIsNone(WechatMessageController._parse_inbox_cursor('garbage'))
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import json
+from odoo import fields
+from odoo.tests import HttpCase, tagged
+
+NOTIFICATION = {
+    'report_title': 'Title',
+    'report_type': 'Type',
+    'report_target': 'Target',
+    'report_content': 'Content',
+}
+
+
+@tagged('post_install', '-at_install')
+class TestIngestEndpoint(HttpCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        company = cls.env['res.company'].create({'name': 'WeChat Ingest Company'})
+        cls.config = cls.env['wechat.sso.config'].create({
+            'name': 'Ingest Config',
+            'company_id': company.id,
+            'app_id': 'wx_ingest_app',
+            'app_secret': 'secret',
+            'template_daily_quota': 0,
+            'circuit_failure_rate': 0,
+            'api_rate_limit': 0,
+            'ingest_token': 'ingest-secret',
+        })
+        cls.users = cls.env['res.users'].create([{
+            'name': f'WeChat Ingest User {index}',
+            'login': f'wechat_ingest_user_{index}',
+            'wechat_openid': f'ingest_openid_{index}',
+        } for index in range(2)])
+        cls.url = f'/wechat/message/ingest/{cls.config.id}'
+
+    def _post(self, body, content_type='application/x-ndjson', token='ingest-secret', url=None):
+        headers = {'Content-Type': content_type}
+        if token:
+            headers['Authorization'] = f'Bearer {token}'
+        return self.url_open(url or self.url, data=body, headers=headers)
+
+    def _ndjson(self, *lines):
+        return '\n'.join(line if isinstance(line, str) else json.dumps(line) for line in lines).encode()
+
+    def test_authentication(self):
+        self.assertEqual(self._post(self._ndjson(NOTIFICATION), token=None).status_code, 401)
+        self.assertEqual(self._post(self._ndjson(NOTIFICATION), token='wrong').status_code, 401)
+        self.assertEqual(self._post(self._ndjson(NOTIFICATION), url='/wechat/message/ingest/0').status_code, 404)
+
+    def test_ndjson_enqueued(self):
+        response = self._post(self._ndjson(
+            NOTIFICATION,
+            {**NOTIFICATION, 'message_type': 'alert_warning'},
+            '{not json',
+            {'report_title': 'Title'},
+        ))
+        self.assertEqual(response.status_code, 202)
+        result = response.json()
+        self.assertEqual((result['accepted'], result['rejected']), (2, 2))
+        self.assertEqual([error['index'] for error in result['errors']], [2, 3])
+        messages = self.env['wechat.message'].browse(result['ids'][:2])
+        self.assertEqual(messages.mapped('message_type'), ['system_notification', 'alert_warning'])
+        self.assertEqual(set(messages.mapped('wechat_config_id').ids), {self.config.id})
+        self.assertEqual(set(messages.mapped('state')), {'sending'})
+        queued = self.env['wechat.message.outbox'].search([('wechat_message_id', 'in', messages.ids)])
+        self.assertLessEqual(set(self.users.ids), set(queued.mapped('user_id').ids))
+
+    def test_json_array(self):
+        response = self._post(json.dumps([NOTIFICATION, {**NOTIFICATION, 'message_type': 'unknown'}]),
+                              content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+        result = response.json()
+        self.assertTrue(result['ids'][0])
+        self.assertIsNone(result['ids'][1])
+        self.assertEqual(result['errors'], [{'index': 1, 'error': 'invalid message_type'}])
+
+    def test_malformed_body_rejected(self):
+        count = self.env['wechat.message'].search_count([])
+        response = self._post(json.dumps(NOTIFICATION), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self._post(self._ndjson(NOTIFICATION), content_type='text/plain').status_code, 400)
+        self.assertEqual(self.env['wechat.message'].search_count([]), count)
+
+    def test_saturated_outbox(self):
+        self.config.ingest_max_queued = 1
+        message = self.env['wechat.message'].create({
+            'message_title': 'Backlog',
+            'report_title': 'Title',
+            'report_type': 'Type',
+            'report_target': 'Target',
+            'report_time': fields.Datetime.now(),
+            'report_content': 'Content',
+            'wechat_config_id': self.config.id,
+        })
+        self.env['wechat.message.outbox'].enqueue_message(
+            message, [[(user.id, user.wechat_openid) for user in self.users]])
+        self.env.flush_all()
+        response = self._post(self._ndjson(NOTIFICATION))
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '1')
+        self.assertEqual(response.json()['retry_after'], 1)
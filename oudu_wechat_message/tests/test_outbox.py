@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+from odoo import fields
+from odoo.tests import tagged
+from .common import WechatMessageCase
+
+
+@tagged('post_install', '-at_install')
+class TestWechatMessageOutbox(WechatMessageCase):
+
+    def test_enqueue_is_idempotent(self):
+        message = self._create_message()
+        self.assertEqual(self.outbox.enqueue_message(message, [self.recipients]), 3)
+        self.assertEqual(self.outbox.enqueue_message(message, [self.recipients[:1]]), 0)
+
+    def test_enqueue_messages_shares_recipients(self):
+        messages = self._create_message() | self._create_message()
+        queued = self.outbox.enqueue_messages(messages, [self.recipients[:2], self.recipients[2:]])
+        self.assertEqual(queued, {messages[0].id: 3, messages[1].id: 3})
+
+    def test_claim_only_sending_messages(self):
+        message = self._create_message()
+        self.outbox.enqueue_message(message, [self.recipients])
+        self.assertFalse(self.outbox._claim_batch(10))
+        message.state = 'sending'
+        self.assertEqual(len(self.outbox._claim_batch(10)), 3)
+
+    def test_claim_respects_dispatch_after(self):
+        message = self._create_message()
+        self.outbox.enqueue_message(message, [self.recipients])
+        message.write({'state': 'sending', 'dispatch_after': fields.Datetime.now() + timedelta(hours=1)})
+        self.assertFalse(self.outbox._claim_batch(10))
+        message.dispatch_after = fields.Datetime.now() - timedelta(minutes=1)
+        self.assertEqual(len(self.outbox._claim_batch(10)), 3)
+
+    def test_claim_skips_partitioned_messages_without_partition(self):
+        message = self._create_message(partition_mode='openid_hash')
+        self.outbox.enqueue_message(message, [self.recipients])
+        message.write({'state': 'sending', 'partition_count': 2})
+        self.outbox.assign_partitions(message)
+        self.assertFalse(self.outbox._claim_batch(10))
+        claimed = self.outbox._claim_batch(10, message_id=message.id, partition=0) \
+            | self.outbox._claim_batch(10, message_id=message.id, partition=1)
+        self.assertEqual(len(claimed), 3)
+
+    def test_cancel_stops_claims(self):
+        message = self._create_message()
+        self.outbox.enqueue_message(message, [self.recipients])
+        message.state = 'sending'
+        self.assertEqual(self.outbox.cancel_message(message), 3)
+        self.assertFalse(self.outbox._claim_batch(10))
+
+    def test_finalize_waits_for_queue(self):
+        message = self._create_message()
+        self.outbox.enqueue_message(message, [self.recipients])
+        message.state = 'sending'
+        self.outbox._finalize_messages(message.ids)
+        self.assertEqual(message.state, 'sending')
+
+        self.outbox._claim_batch(10).write({'state': 'done'})
+        self._deliver(message, self.recipients, [{'errcode': 0, 'msgid': 1}] * 3)
+        self.outbox._finalize_messages(message.ids)
+        message.invalidate_recordset()
+        self.assertEqual(message.state, 'sent')
+        self.assertEqual(message.sent_count, 3)
+
+    def test_finalize_all_failed(self):
+        message = self._create_message()
+        message.state = 'sending'
+        self._deliver(message, self.recipients, [{'errcode': 40003, 'errmsg': 'invalid openid'}] * 3)
+        self.outbox._finalize_messages(message.ids)
+        message.invalidate_recordset()
+        self.assertEqual(message.state, 'failed')
+        self.assertEqual(message.failed_count, 3)
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from odoo.tests import tagged
+from .common import WechatMessageCase
+
+
+@tagged('post_install', '-at_install')
+class TestPartitionedSend(WechatMessageCase):
+
+    def _queued(self, message):
+        return self.outbox.search([('wechat_message_id', '=', message.id), ('user_id', 'in', self.users.ids)])
+
+    def _start(self, partition_mode, processes=2):
+        self.config.send_processes = processes
+        message = self._create_message(partition_mode=partition_mode)
+        queued = self.outbox.enqueue_message(message, [self.recipients])
+        message._start_queued_send(queued)
+        return message
+
+    def test_partition_count_from_config(self):
+        message = self._start('openid_hash', processes=8)
+        self.assertEqual(message.partition_count, 3)
+        self.assertTrue(all(0 <= row.partition_no < 3 for row in self._queued(message)))
+
+    def test_id_range_partitions_are_contiguous(self):
+        message = self._start('id_range')
+        self.assertEqual(self._queued(message).sorted('user_id').mapped('partition_no'), [0, 0, 1])
+
+    def test_no_partition_with_single_process(self):
+        message = self._start('id_range', processes=1)
+        self.assertFalse(message.partition_count)
+        self.assertEqual(len(self.outbox._claim_batch(10)), 3)
+
+    def test_drain_single_partition(self):
+        payloads = self._patch_send()
+        message = self._start('id_range')
+        self.assertEqual(self.outbox.drain(message_id=message.id, partition=1), 1)
+        self.assertEqual([payload['touser'] for payload in payloads], ['openid_2'])
+        self.assertEqual(self.outbox.drain(message_id=message.id, partition=0), 2)
+        self.assertEqual(len(payloads), 3)
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from odoo.tests import tagged
+from odoo.addons.oudu_wechat_message.utils.rate_limiter import SharedRateLimiter
+from .common import WechatMessageCase
+
+
+@tagged('post_install', '-at_install')
+class TestSharedRateLimiter(WechatMessageCase):
+
+    def setUp(self):
+        super().setUp()
+        self.config.write({'api_rate_limit': 10, 'api_rate_min': 1})
+        self.limiter = self.config._get_rate_limiter()
+
+    def _bucket_rate(self):
+        self.env.cr.execute("SELECT rate FROM wechat_api_rate_bucket WHERE app_id = %s", (self.config.app_id,))
+        return self.env.cr.fetchone()[0]
+
+    def test_take_uses_blocks(self):
+        acquired = []
+        self.patch(SharedRateLimiter, 'acquire', lambda limiter, count=1: acquired.append(count) or 0)
+        # 10次/秒时每块为 0.2 秒的令牌，即 2 个
+        for _i in range(5):
+            self.limiter.take()
+        self.assertEqual(acquired, [2, 2, 2])
+
+    def test_acquire_consumes_shared_tokens(self):
+        self.assertEqual(self.limiter.acquire(4), 0)
+        self.env.cr.execute("SELECT tokens FROM wechat_api_rate_bucket WHERE app_id = %s", (self.config.app_id,))
+        self.assertAlmostEqual(self.env.cr.fetchone()[0], 6, delta=1)
+        # 另一个限流器实例(其他进程)共用同一个令牌桶
+        self.config._get_rate_limiter().acquire(1)
+        self.env.cr.execute("SELECT tokens FROM wechat_api_rate_bucket WHERE app_id = %s", (self.config.app_id,))
+        self.assertAlmostEqual(self.env.cr.fetchone()[0], 5, delta=1)
+
+    def test_throttled_halves_rate_once_per_second(self):
+        self.limiter.take()
+        self.limiter.throttled()
+        self.assertAlmostEqual(self._bucket_rate(), 5, delta=0.5)
+        self.limiter.throttled()
+        self.assertAlmostEqual(self._bucket_rate(), 5, delta=0.5)
+
+    def test_throttled_drops_local_tokens(self):
+        acquired = []
+        self.patch(SharedRateLimiter, 'acquire', lambda limiter, count=1: acquired.append(count) or 0)
+        self.patch(SharedRateLimiter, '_execute', lambda limiter, query, params: None)
+        self.limiter.take()
+        self.limiter.throttled()
+        self.limiter.take()
+        self.assertEqual(acquired, [2, 2])
+
+    def test_disabled(self):
+        self.config.api_rate_limit = 0
+        limiter = self.config._get_rate_limiter()
+        self.patch(SharedRateLimiter, '_execute', lambda limiter, query, params: self.fail('不应访问令牌桶'))
+        self.assertEqual(limiter.take(), 0)
+        self.assertEqual(limiter.acquire(), 0)
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from odoo.tests import tagged
+from .common import WechatMessageCase
+
+
+@tagged('post_install', '-at_install')
+class TestDeliveryReceipts(WechatMessageCase):
+
+    def setUp(self):
+        super().setUp()
+        self.receipts = self.env['wechat.message.receipt']
+        self.message = self._create_message()
+        reserved = self._deliver(self.message, self.recipients,
+                                 [{'errcode': 0, 'msgid': msgid} for msgid in (101, 102, 103)])
+        self.user_messages = self.env['wechat.user.message'].browse([row[0] for row in reserved])
+
+    def _buffered(self):
+        self.env.cr.execute("SELECT msgid FROM wechat_message_receipt ORDER BY id")
+        return [row[0] for row in self.env.cr.fetchall()]
+
+    def test_apply_receipts(self):
+        self.receipts.record_receipt(101, 'success')
+        self.receipts.record_receipt(102, 'failed:user block')
+        self.assertEqual(self.receipts.flush_receipts(), 2)
+        self.assertEqual(self.user_messages.mapped('state'), ['delivered', 'failed', 'sent'])
+        self.assertEqual(self.user_messages[1].error_message, 'failed:user block')
+        self.message.invalidate_recordset()
+        self.assertEqual((self.message.sent_count, self.message.failed_count), (2, 1))
+        self.assertEqual(self._buffered(), [])
+
+    def test_receipt_does_not_downgrade(self):
+        self.user_messages[0].state = 'clicked'
+        self.receipts.record_receipt(101, 'failed:system failed')
+        self.assertEqual(self.receipts.flush_receipts(), 0)
+        self.assertEqual(self.user_messages[0].state, 'clicked')
+
+    def test_unmatched_receipt_waits(self):
+        self.receipts.record_receipt(999, 'success')
+        self.receipts.record_receipt(998, 'success')
+        self.env.cr.execute("""
+            UPDATE wechat_message_receipt SET received_time = NOW() AT TIME ZONE 'UTC' - interval '2 hours'
+             WHERE msgid = '998'
+        """)
+        self.assertEqual(self.receipts.flush_receipts(), 0)
+        # 匹配窗口内的回执放回缓冲，过期的丢弃
+        self.assertEqual(self._buffered(), ['999'])
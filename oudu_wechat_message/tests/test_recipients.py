@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from odoo.tests import tagged
+from .common import WechatMessageCase
+
+
+@tagged('post_install', '-at_install')
+class TestWechatRecipients(WechatMessageCase):
+
+    def _iter_test_recipients(self, **kwargs):
+        """遍历目标用户，只保留本测试创建的用户，返回 (分块列表, 用户列表)"""
+        chunks = list(self.service._iter_target_recipients(**kwargs))
+        recipients = [row for chunk in chunks for row in chunk if row[0] in self.users.ids]
+        return chunks, recipients
+
+    def test_keyset_pages(self):
+        chunks, recipients = self._iter_test_recipients(chunk_size=2)
+        self.assertTrue(all(len(chunk) <= 2 for chunk in chunks))
+        user_ids = [row[0] for chunk in chunks for row in chunk]
+        self.assertEqual(user_ids, sorted(set(user_ids)))
+        self.assertEqual(recipients, self.recipients)
+
+    def test_skips_users_without_openid(self):
+        self.users[1].wechat_openid = False
+        self.users[2].active = False
+        _chunks, recipients = self._iter_test_recipients(chunk_size=10)
+        self.assertEqual(recipients, self.recipients[:1])
+
+    def test_excludes_existing_user_messages(self):
+        message = self._create_message()
+        self.service._reserve_recipients(message, self.recipients[:2])
+        _chunks, recipients = self._iter_test_recipients(chunk_size=10, exclude_message_id=message.id)
+        self.assertEqual(recipients, self.recipients[2:])
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+from odoo import fields
+from odoo.tests import tagged
+from .common import WechatMessageCase
+
+
+@tagged('post_install', '-at_install')
+class TestScheduledSend(WechatMessageCase):
+
+    def setUp(self):
+        super().setUp()
+        self.config.schedule_stagger_seconds = 30
+
+    def _create_scheduled(self, minutes_ago):
+        """创建计划发送的草稿，计划时间直接改到过去(约束不允许创建过去的计划时间)"""
+        message = self._create_message(scheduled_send_time=fields.Datetime.now() + timedelta(hours=1))
+        message.flush_recordset()
+        self.env.cr.execute("""
+            UPDATE wechat_message SET scheduled_send_time = NOW() AT TIME ZONE 'UTC' - make_interval(mins => %s)
+             WHERE id = %s
+        """, (minutes_ago, message.id))
+        message.invalidate_recordset()
+        return message
+
+    def test_dispatch_due_messages(self):
+        first, second = self._create_scheduled(2), self._create_scheduled(1)
+        future = self._create_message(scheduled_send_time=fields.Datetime.now() + timedelta(hours=1))
+        self.env['wechat.message'].cron_dispatch_scheduled_messages()
+        (first | second | future).invalidate_recordset()
+        self.assertEqual((first.state, second.state, future.state), ('sending', 'sending', 'draft'))
+        # 同一配置下按计划时间依次错开启动
+        self.assertEqual(second.dispatch_after - first.dispatch_after, timedelta(seconds=30))
+        self.assertTrue(self.outbox.search_count([('wechat_message_id', '=', first.id)]))
+
+    def test_stagger_after_sending_messages(self):
+        running = self._create_message()
+        running.write({'state': 'sending', 'dispatch_after': fields.Datetime.now() + timedelta(minutes=5)})
+        message = self._create_scheduled(1)
+        message._assign_dispatch_slots()
+        self.assertEqual(message.dispatch_after, running.dispatch_after + timedelta(seconds=30))
+
+    def test_claim_waits_for_slot(self):
+        message = self._create_scheduled(1)
+        running = self._create_message()
+        running.write({'state': 'sending', 'dispatch_after': fields.Datetime.now() + timedelta(minutes=5)})
+        self.env['wechat.message'].cron_dispatch_scheduled_messages()
+        message.invalidate_recordset()
+        self.assertEqual(message.state, 'sending')
+        self.assertFalse(self.outbox._claim_batch(10, message_id=message.id))
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from odoo.tests import tagged
+from odoo.addons.website.tools import MockRequest
+from .common import WechatMessageCase
+
+
+@tagged('post_install', '-at_install')
+class TestSendProgress(WechatMessageCase):
+
+    def setUp(self):
+        super().setUp()
+        self.notifications = []
+        self.patch(type(self.env['bus.bus']), '_sendone',
+                   lambda bus, target, notification_type, message: self.notifications.append((target, message)))
+        self.message = self._create_message()
+        self.message.write({'state': 'sending', 'total_recipients': 200})
+        self.message.flush_recordset()
+        self.env.cr.execute("""
+            UPDATE wechat_message SET send_started_time = NOW() AT TIME ZONE 'UTC' - interval '100 seconds'
+             WHERE id = %s
+        """, (self.message.id,))
+        self.message.invalidate_recordset()
+        self.notifications.clear()
+
+    def test_push_per_progress_step(self):
+        # 总数200时每处理2条推送一次
+        self.message._increment_send_stats({self.message.id: [0, 1, 0]})
+        self.assertFalse(self.notifications)
+        self.message._increment_send_stats({self.message.id: [0, 1, 0]})
+        self.message._increment_send_stats({self.message.id: [0, 7, 1]})
+        self.assertEqual(len(self.notifications), 2)
+        target, payload = self.notifications[-1]
+        self.assertEqual(target, (self.message, 'progress'))
+        self.assertEqual((payload['sent'], payload['failed']), (9, 1))
+        # 速率按开始发送时间和累计数计算
+        self.assertAlmostEqual(payload['rate'], 0.1, delta=0.02)
+        self.assertAlmostEqual(payload['eta'], 1900, delta=400)
+
+    def test_push_on_state_change(self):
+        self.message.state = 'sent'
+        self.assertEqual(len(self.notifications), 1)
+        self.assertEqual(self.notifications[0][1]['state'], 'sent')
+
+    def test_channel_requires_read_access(self):
+        channel = f'wechat_message_progress_{self.message.id}'
+        with MockRequest(self.env):
+            admin_channels = self.env['ir.websocket'].with_user(self.env.ref('base.user_admin')) \
+                ._build_bus_channel_list([channel])
+            user_channels = self.env['ir.websocket'].with_user(self.users[0])._build_bus_channel_list([channel])
+        self.assertIn((self.message, 'progress'), admin_channels)
+        self.assertNotIn(channel, admin_channels)
+        self.assertNotIn((self.message, 'progress'), user_channels)
+        self.assertNotIn(channel, user_channels)
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from odoo.tests import tagged
+from .common import WechatMessageCase
+
+
+@tagged('post_install', '-at_install')
+class TestWechatSendStats(WechatMessageCase):
+
+    def _stats(self, message):
+        message.invalidate_recordset()
+        return message.total_recipients, message.sent_count, message.failed_count
+
+    def _create_user_messages(self, message, states):
+        return self.env['wechat.user.message'].create([{
+            'wechat_message_id': message.id,
+            'user_id': user.id,
+            'state': state,
+        } for user, state in zip(self.users, states)])
+
+    def test_create_write_unlink(self):
+        message = self._create_message()
+        user_messages = self._create_user_messages(message, ['sent', 'failed', 'pending'])
+        self.assertEqual(self._stats(message), (3, 1, 1))
+        user_messages[2].state = 'clicked'
+        user_messages[1].state = 'sent'
+        self.assertEqual(self._stats(message), (3, 3, 0))
+        user_messages[0].unlink()
+        self.assertEqual(self._stats(message), (2, 2, 0))
+
+    def test_write_without_state_keeps_stats(self):
+        message = self._create_message()
+        user_messages = self._create_user_messages(message, ['sent', 'failed'])
+        user_messages.write({'error_message': 'note'})
+        self.assertEqual(self._stats(message), (2, 1, 1))
+
+    def test_recompute_corrects_drift(self):
+        message = self._create_message()
+        self._create_user_messages(message, ['sent', 'delivered', 'failed'])
+        message.flush_recordset()
+        self.env.cr.execute("UPDATE wechat_message SET sent_count = 0, failed_count = 5 WHERE id = %s",
+                            (message.id,))
+        message.invalidate_recordset()
+        message._recompute_send_stats()
+        self.assertEqual(self._stats(message), (3, 2, 1))
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import requests
+from odoo.tests import tagged
+from odoo.tests.common import BaseCase
+from odoo.addons.oudu_wechat_message.utils.template_dispatcher import TemplateDispatcher
+
+SEND_URL = 'https://api.weixin.qq.com/cgi-bin/message/template/send?access_token=token_1'
+
+
+@tagged('post_install', '-at_install')
+class TestTemplateDispatcher(BaseCase):
+
+    def _patch_post(self, handler):
+        """用 handler(url, payload) 代替HTTP请求，返回记录的请求列表"""
+        calls = []
+        lock = threading.Lock()
+
+        def fake_post(dispatcher, url, payload):
+            with lock:
+                calls.append((url, payload))
+            return handler(url, payload)
+
+        self.patch(TemplateDispatcher, '_post', fake_post)
+        return calls
+
+    def test_map_keeps_order(self):
+        def handler(url, payload):
+            # 靠后的请求先返回
+            time.sleep(0.01 * (5 - payload['n']))
+            return {'errcode': 0, 'msgid': payload['n']}
+
+        self._patch_post(handler)
+        with TemplateDispatcher(max_workers=4) as dispatcher:
+            results = list(dispatcher.map(SEND_URL, [{'n': n} for n in range(5)]))
+        self.assertEqual([result['msgid'] for result in results], list(range(5)))
+
+    def test_map_runs_concurrently(self):
+        lock = threading.Lock()
+        active, peak = [0], [0]
+
+        def handler(url, payload):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.05)
+            with lock:
+                active[0] -= 1
+            return {'errcode': 0}
+
+        self._patch_post(handler)
+        with TemplateDispatcher(max_workers=4) as dispatcher:
+            list(dispatcher.map(SEND_URL, [{}] * 8))
+        self.assertGreater(peak[0], 1)
+        self.assertLessEqual(peak[0], 4)
+
+    def test_request_error_becomes_errcode(self):
+        def fail(session, *args, **kwargs):
+            raise requests.ConnectionError('connection refused')
+
+        self.patch(requests.Session, 'post', fail)
+        with TemplateDispatcher(max_workers=1) as dispatcher:
+            result = dispatcher.post(SEND_URL, {'touser': 'openid_0'})
+        self.assertEqual(result['errcode'], -1)
+        self.assertIn('connection refused', result['errmsg'])
+
+    def test_token_refreshed_once(self):
+        refreshed = []
+
+        def handler(url, payload):
+            if 'access_token=token_1' in url:
+                return {'errcode': 40001, 'errmsg': 'invalid credential'}
+            return {'errcode': 0, 'msgid': 1}
+
+        def refresher(stale_token):
+            refreshed.append(stale_token)
+            return 'token_2'
+
+        calls = self._patch_post(handler)
+        with TemplateDispatcher(max_workers=3, token_refresher=refresher) as dispatcher:
+            results = list(dispatcher.map(SEND_URL, [{}] * 6))
+            # 之后仍带旧token的请求直接使用新token
+            self.assertEqual(dispatcher.post(SEND_URL, {})['errcode'], 0)
+        self.assertEqual(refreshed, ['token_1'])
+        self.assertTrue(all(result['errcode'] == 0 for result in results))
+        self.assertIn('access_token=token_2', calls[-1][0])
+
+    def test_token_refresh_failure_keeps_error(self):
+        self._patch_post(lambda url, payload: {'errcode': 42001, 'errmsg': 'access_token expired'})
+        with TemplateDispatcher(max_workers=1, token_refresher=lambda stale_token: None) as dispatcher:
+            self.assertEqual(dispatcher.post(SEND_URL, {})['errcode'], 42001)
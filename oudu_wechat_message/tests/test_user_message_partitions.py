@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import psycopg2
+from dateutil.relativedelta import relativedelta
+from odoo import fields
+from odoo.tests import tagged
+from odoo.tools import mute_logger
+from .common import WechatMessageCase
+
+
+@tagged('post_install', '-at_install')
+class TestUserMessagePartitions(WechatMessageCase):
+
+    def setUp(self):
+        super().setUp()
+        self.UserMessage = self.env['wechat.user.message']
+
+    def _create_user_messages(self, message, users, **vals):
+        return self.UserMessage.create([{
+            'wechat_message_id': message.id,
+            'user_id': user.id,
+            **vals,
+        } for user in users])
+
+    def test_table_partitioned(self):
+        self.assertTrue(self.UserMessage._is_partitioned())
+        this_month = fields.Date.today().replace(day=1)
+        self.env.cr.execute("SELECT 1 FROM pg_class WHERE relname = %s",
+                            (self.UserMessage._partition_name(this_month),))
+        self.assertTrue(self.env.cr.fetchone())
+
+    def test_send_time_from_message_start(self):
+        message = self._create_message()
+        first = self._create_user_messages(message, self.users[:1])
+        later = self._create_user_messages(message, self.users[1:],
+                                           send_time=fields.Datetime.now() + relativedelta(days=1))
+        message.invalidate_recordset()
+        self.assertEqual(set((first | later).mapped('send_time')), {message.send_started_time})
+        reserved = self.service._reserve_recipients(message, self.recipients)
+        self.assertEqual(reserved, [])
+
+    def test_unique_message_user(self):
+        message = self._create_message()
+        self._create_user_messages(message, self.users[:1])
+        with self.assertRaises(psycopg2.IntegrityError), mute_logger('odoo.sql_db'):
+            self._create_user_messages(message, self.users[:1])
+            self.UserMessage.flush_model()
+
+    def test_archive_old_partitions(self):
+        month = fields.Date.today().replace(day=1) - relativedelta(months=25)
+        self.UserMessage._create_partitions(start=month)
+        message = self._create_message()
+        message.send_started_time = fields.Datetime.now() - relativedelta(months=25)
+        self._create_user_messages(message, self.users[:2], state='sent')
+        self._create_user_messages(message, self.users[2:], state='failed')
+        self.UserMessage.flush_model()
+
+        self.assertGreaterEqual(self.UserMessage._archive_partitions(24), 1)
+        self.assertFalse(self.UserMessage.search([('wechat_message_id', '=', message.id)]))
+        archive = self.env['wechat.user.message.archive'].search([('wechat_message_id', '=', message.id)])
+        self.assertEqual((archive.period, archive.total, archive.sent_count, archive.failed_count),
+                         (month, 3, 2, 1))
+        # 归档后重新统计仍计入归档汇总
+        message._recompute_send_stats()
+        message.invalidate_recordset()
+        self.assertEqual((message.total_recipients, message.sent_count, message.failed_count), (3, 2, 1))
+
+    def test_retention_disabled(self):
+        self.assertEqual(self.UserMessage._archive_partitions(0), 0)
@@ -0,0 +1,5 @@
+from . import rate_limiter
+from . import template_dispatcher
+from . import partitioned_dispatch
+from . import event_crypto
+from . import circuit_breaker
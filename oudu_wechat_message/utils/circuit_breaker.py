@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+# 熔断期间未发出的请求返回的错误码，调用方据此将记录转入死信队列
+CIRCUIT_OPEN_ERRCODE = -2
+# 计入失败率的错误码：网络异常、超时、HTTP错误和微信系统繁忙
+CIRCUIT_FAILURE_ERRCODES = (-1,)
+# 熔断关闭时，本地累计的成功结果最多间隔多久写入共享状态
+FLUSH_INTERVAL = 1.0
+# 本地缓存熔断状态的秒数，避免每个请求都查询数据库
+STATE_CACHE_SECONDS = 1.0
+
+
+class SharedCircuitBreaker:
+    """跨进程共享的接口熔断器
+
+    熔断状态保存在 PostgreSQL UNLOGGED 表中，按 app_id + 接口路径区分，所有进程和线程共用。
+    关闭状态下统计窗口内的请求数和失败数，失败率达到阈值后打开；打开期间请求直接失败，
+    不再等待超时。打开时间结束后只放行一个探测请求(半开)，探测成功关闭熔断，失败则重新打开。
+    与限流器一样，每次读写都使用独立的短事务，不持有业务事务的行锁。
+    """
+
+    TABLE = 'wechat_api_circuit'
+
+    def __init__(self, registry, app_id, failure_rate=0.5, min_requests=20,
+                 window_seconds=60, open_seconds=60, probe_timeout=30):
+        self.registry = registry
+        self.app_id = app_id
+        self.failure_rate = float(failure_rate or 0)
+        self.min_requests = max(1, int(min_requests or 1))
+        self.window_seconds = max(1, int(window_seconds or 1))
+        self.open_seconds = max(1, int(open_seconds or 1))
+        self.probe_timeout = probe_timeout
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._flushed_at = {}
+        self._states = {}
+
+    @classmethod
+    def create_table(cls, cr):
+        """创建熔断状态表"""
+        cr.execute("""
+            CREATE UNLOGGED TABLE IF NOT EXISTS wechat_api_circuit (
+                endpoint varchar PRIMARY KEY,
+                state varchar NOT NULL DEFAULT 'closed',
+                window_start timestamp NOT NULL DEFAULT clock_timestamp(),
+                requests integer NOT NULL DEFAULT 0,
+                failures integer NOT NULL DEFAULT 0,
+                opened_at timestamp,
+                probe_at timestamp
+            )
+        """)
+
+    @property
+    def enabled(self):
+        return self.failure_rate > 0
+
+    def _key(self, endpoint):
+        return f"{self.app_id}:{endpoint}"
+
+    def _execute(self, query, params):
+        with self.registry.cursor() as cr:
+            cr.execute(query, params)
+            return cr.fetchone()
+
+    def _get_state(self, endpoint):
+        row = self._execute("SELECT state FROM wechat_api_circuit WHERE endpoint = %s", (self._key(endpoint),))
+        return row[0] if row else 'closed'
+
+    def is_closed(self, endpoint):
+        """熔断是否处于关闭状态"""
+        return not self.enabled or self._get_state(endpoint) == 'closed'
+
+    def probe_due(self, endpoint):
+        """熔断关闭或已到可以发出探测请求的时间，熔断时间未到时返回 False"""
+        if not self.enabled:
+            return True
+        row = self._execute("""
+            SELECT state = 'closed'
+                   OR (state = 'open' AND opened_at <= clock_timestamp() - make_interval(secs => %s))
+                   OR (state = 'half_open' AND probe_at <= clock_timestamp() - make_interval(secs => %s))
+              FROM wechat_api_circuit
+             WHERE endpoint = %s
+        """, (self.open_seconds, self.probe_timeout, self._key(endpoint)))
+        return row[0] if row else True
+
+    def allow(self, endpoint):
+        """是否允许发出请求：关闭时返回 True，本请求作为半开探测时返回 'probe'，熔断中返回 False"""
+        if not self.enabled:
+            return True
+        now = time.monotonic()
+        cached = self._states.get(endpoint)
+        if cached and cached[0] == 'closed' and now - cached[1] < STATE_CACHE_SECONDS:
+            return True
+        # 打开时间结束后，只有一个请求能把状态切换为半开；探测请求超时未回报时允许新的探测
+        row = self._execute("""
+            UPDATE wechat_api_circuit
+               SET state = 'half_open', probe_at = clock_timestamp()
+             WHERE endpoint = %s
+               AND ((state = 'open' AND opened_at <= clock_timestamp() - make_interval(secs => %s))
+                    OR (state = 'half_open' AND probe_at <= clock_timestamp() - make_interval(secs => %s)))
+            RETURNING state
+        """, (self._key(endpoint), self.open_seconds, self.probe_timeout))
+        if row:
+            self._states[endpoint] = ('half_open', now)
+            return 'probe'
+        state = self._get_state(endpoint)
+        self._states[endpoint] = (state, now)
+        return state == 'closed'
+
+    def record(self, endpoint, success, probe=False):
+        """回报请求结果
+
+        探测请求的结果立即决定熔断关闭或重新打开；关闭状态下成功结果在本地累计后定期写入，
+        失败结果立即写入，以便尽快达到熔断阈值。
+        """
+        if not self.enabled:
+            return
+        if probe:
+            self._finish_probe(endpoint, success)
+            return
+        with self._lock:
+            requests, failures = self._pending.get(endpoint, (0, 0))
+            requests, failures = requests + 1, failures + (0 if success else 1)
+            now = time.monotonic()
+            if success and now - self._flushed_at.get(endpoint, 0) < FLUSH_INTERVAL:
+                self._pending[endpoint] = (requests, failures)
+                return
+            self._pending[endpoint] = (0, 0)
+            self._flushed_at[endpoint] = now
+        self._flush(endpoint, requests, failures)
+
+    def flush(self):
+        """写入本地累计的结果"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for endpoint, (requests, failures) in pending.items():
+            if requests:
+                self._flush(endpoint, requests, failures)
+
+    def _flush(self, endpoint, requests, failures):
+        """累加窗口计数，失败率达到阈值时打开熔断"""
+        row = self._execute("""
+            INSERT INTO wechat_api_circuit AS c (endpoint, state, window_start, requests, failures)
+            VALUES (%(endpoint)s, 'closed', clock_timestamp(), %(requests)s, %(failures)s)
+            ON CONFLICT (endpoint) DO UPDATE SET
+                window_start = CASE WHEN c.window_start <= clock_timestamp() - make_interval(secs => %(window)s)
+                                    THEN clock_timestamp() ELSE c.window_start END,
+                requests = CASE WHEN c.window_start <= clock_timestamp() - make_interval(secs => %(window)s)
+                                THEN %(requests)s ELSE c.requests + %(requests)s END,
+                failures = CASE WHEN c.window_start <= clock_timestamp() - make_interval(secs => %(window)s)
+                                THEN %(failures)s ELSE c.failures + %(failures)s END
+             WHERE c.state = 'closed'
+            RETURNING requests, failures
+        """, {
+            'endpoint': self._key(endpoint),
+            'requests': requests,
+            'failures': failures,
+            'window': self.window_seconds,
+        })
+        if not row:
+            return
+        total, failed = row
+        if total >= self.min_requests and failed >= total * self.failure_rate:
+            opened = self._execute("""
+                UPDATE wechat_api_circuit
+                   SET state = 'open', opened_at = clock_timestamp()
+                 WHERE endpoint = %s AND state = 'closed'
+                RETURNING endpoint
+            """, (self._key(endpoint),))
+            if opened:
+                self._states[endpoint] = ('open', time.monotonic())
+                _logger.warning("微信接口 %s 失败率过高(%s/%s)，已熔断 %s 秒",
+                                self._key(endpoint), failed, total, self.open_seconds)
+
+    def _finish_probe(self, endpoint, success):
+        """半开探测结束：成功关闭熔断并重置窗口，失败重新打开"""
+        if success:
+            self._execute("""
+                UPDATE wechat_api_circuit
+                   SET state = 'closed', window_start = clock_timestamp(), requests = 0, failures = 0,
+                       opened_at = NULL, probe_at = NULL
+                 WHERE endpoint = %s AND state = 'half_open'
+                RETURNING endpoint
+            """, (self._key(endpoint),))
+            self._states[endpoint] = ('closed', time.monotonic())
+            _logger.info("微信接口 %s 探测成功，熔断已关闭", self._key(endpoint))
+        else:
+            self._execute("""
+                UPDATE wechat_api_circuit
+                   SET state = 'open', opened_at = clock_timestamp(), probe_at = NULL
+                 WHERE endpoint = %s AND state = 'half_open'
+                RETURNING endpoint
+            """, (self._key(endpoint),))
+            self._states[endpoint] = ('open', time.monotonic())
+            _logger.warning("微信接口 %s 探测失败，继续熔断 %s 秒", self._key(endpoint), self.open_seconds)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+import base64
+import hashlib
+import hmac
+import socket
+import struct
+
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+# 微信消息加解密使用 32 字节块的 PKCS#7 填充
+PKCS7_BLOCK_SIZE = 32
+
+
+class EventCryptoError(Exception):
+    """事件推送签名校验或解密失败"""
+
+
+class WechatEventCrypto:
+    """服务器配置的事件推送签名校验和安全模式解密
+
+    对象只保存由 Token、EncodingAESKey 派生的密钥，可按配置缓存复用，
+    每次推送只做一次 SHA1 和一次 AES-CBC 解密。
+    EncodingAESKey 无效时只在解密时报错，明文模式的推送和接入验证不受影响。
+    """
+
+    def __init__(self, token, encoding_aes_key=None, app_id=None):
+        self.token = token or ''
+        self.app_id = app_id or ''
+        self.key = None
+        self.key_error = None
+        if encoding_aes_key:
+            try:
+                self.key = base64.b64decode(encoding_aes_key + '=')
+            except (ValueError, TypeError) as e:
+                self.key_error = f"EncodingAESKey 无效: {e}"
+            else:
+                if len(self.key) != 32:
+                    self.key, self.key_error = None, "EncodingAESKey 长度必须为43个字符"
+
+    def _signature(self, *parts):
+        return hashlib.sha1(''.join(sorted(str(part) for part in parts)).encode()).hexdigest()
+
+    def check_signature(self, signature, timestamp, nonce, encrypt=None):
+        """校验 signature(明文) 或 msg_signature(安全模式，包含密文)"""
+        if not self.token or not signature:
+            return False
+        parts = (self.token, timestamp, nonce) + ((encrypt,) if encrypt is not None else ())
+        return hmac.compare_digest(self._signature(*parts), signature)
+
+    def decrypt(self, encrypt):
+        """解密安全模式的 Encrypt 字段，返回明文 XML
+
+        明文结构为 16字节随机串 + 4字节网络字节序长度 + 消息 + AppID，AppID 必须与配置一致。
+        """
+        if not self.key:
+            raise EventCryptoError(self.key_error or "未配置 EncodingAESKey，无法解密")
+        try:
+            decryptor = Cipher(algorithms.AES(self.key), modes.CBC(self.key[:16])).decryptor()
+            plain = decryptor.update(base64.b64decode(encrypt)) + decryptor.finalize()
+        except ValueError as e:
+            raise EventCryptoError(f"解密失败: {e}") from e
+        pad = plain[-1] if plain else 0
+        if pad < 1 or pad > PKCS7_BLOCK_SIZE:
+            raise EventCryptoError("解密后填充无效")
+        content = plain[16:-pad]
+        try:
+            length = socket.ntohl(struct.unpack('I', content[:4])[0])
+            if length > len(content) - 4:
+                raise EventCryptoError("解密后消息长度无效")
+            xml, app_id = content[4:4 + length], content[4 + length:]
+            if self.app_id and app_id.decode() != self.app_id:
+                raise EventCryptoError("AppID 不匹配")
+            return xml.decode()
+        except (struct.error, UnicodeDecodeError) as e:
+            raise EventCryptoError(f"解密后内容无效: {e}") from e
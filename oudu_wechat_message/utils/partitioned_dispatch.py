@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import multiprocessing
+import traceback
+from typing import List, Optional, Tuple
+
+from odoo import api, sql_db, SUPERUSER_ID
+from odoo.modules.registry import Registry
+
+_logger = logging.getLogger(__name__)
+
+# fork 继承自父进程的连接池只保留引用、从不关闭：关闭会向数据库发送终止消息，断开父进程的会话
+_inherited_connections = []
+
+
+def _detach_inherited_connections(registry):
+    """子进程改用自己的数据库连接池"""
+    _inherited_connections.append((
+        sql_db._Pool,
+        getattr(sql_db, '_Pool_readonly', None),
+        registry._db,
+        getattr(registry, '_db_readonly', None),
+    ))
+    sql_db._Pool = None
+    if hasattr(sql_db, '_Pool_readonly'):
+        sql_db._Pool_readonly = None
+    registry._db = sql_db.db_connect(registry.db_name)
+    if getattr(registry, '_db_readonly', None) is not None:
+        registry._db_readonly = sql_db.db_connect(registry.db_name, readonly=True)
+
+
+def _drain_partition(args):
+    """子进程入口：用独立的游标和HTTP连接池消费一个分区，返回 (处理数量, 错误信息)
+
+    异常不在子进程中吞掉，错误堆栈返回给父进程记录，避免异常退出的分区被当作没有待发送记录。
+    """
+    db_name, message_id, partition, batch_size, time_limit = args
+    registry = Registry(db_name)
+    _detach_inherited_connections(registry)
+    try:
+        with registry.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            return env['wechat.message.outbox'].drain(
+                batch_size=batch_size, time_limit=time_limit,
+                message_id=message_id, partition=partition), None
+    except Exception:
+        return 0, traceback.format_exc()
+    finally:
+        sql_db.close_all()
+
+
+def run_partitions(db_name: str, message_id: int, partitions: int,
+                   batch_size: int = 200, time_limit: int = 240) -> List[Tuple[int, Optional[str]]]:
+    """在进程池中并行消费一条消息的所有分区，返回各分区的 (处理数量, 错误信息)
+
+    调用前必须提交事务，子进程只能看到已提交的队列记录。
+    每个分区在单独的子进程中运行，子进程执行完即退出，不复用连接。
+    """
+    context = multiprocessing.get_context('fork')
+    tasks = [(db_name, message_id, partition, batch_size, time_limit) for partition in range(partitions)]
+    with context.Pool(processes=partitions, maxtasksperchild=1) as pool:
+        return pool.map(_drain_partition, tasks)
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import math
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+# 微信接口频率限制相关错误码
+THROTTLE_ERRCODES = (45009, 45011, 45047)
+# 每个线程一次从共享令牌桶取出约这么多秒的令牌，在本地逐个使用
+BLOCK_SECONDS = 0.2
+# 每个进程同时访问令牌桶的连接数上限，避免大量发送线程同时占用数据库连接
+_DB_SLOTS = threading.BoundedSemaphore(2)
+
+
+class SharedRateLimiter:
+    """跨进程共享的自适应令牌桶限流器
+
+    令牌桶状态保存在 PostgreSQL UNLOGGED 表中，按 app_id 区分，
+    所有Odoo进程和线程共用同一个桶。每次取令牌都使用独立的短事务，
+    不会持有业务事务的行锁。遇到限流错误码时速率减半，之后随时间线性恢复到上限。
+    发送线程通过 take() 按块取令牌并在本地逐个使用，每块只访问一次数据库。
+    """
+
+    TABLE = 'wechat_api_rate_bucket'
+
+    def __init__(self, registry, app_id, max_rate, min_rate=1.0, ramp_seconds=60):
+        self.registry = registry
+        self.app_id = app_id
+        self.max_rate = float(max_rate or 0)
+        self.min_rate = max(0.1, min(float(min_rate or 1.0), self.max_rate or 1.0))
+        self.ramp = (self.max_rate - self.min_rate) / max(1, ramp_seconds)
+        self.block_size = max(1, math.ceil(self.max_rate * BLOCK_SECONDS))
+        self._local = threading.local()
+
+    @classmethod
+    def create_table(cls, cr):
+        """创建令牌桶状态表"""
+        cr.execute("""
+            CREATE UNLOGGED TABLE IF NOT EXISTS wechat_api_rate_bucket (
+                app_id varchar PRIMARY KEY,
+                tokens double precision NOT NULL,
+                rate double precision NOT NULL,
+                updated_at timestamp NOT NULL DEFAULT clock_timestamp(),
+                throttled_at timestamp
+            )
+        """)
+
+    def _execute(self, query, params):
+        with _DB_SLOTS, self.registry.cursor() as cr:
+            cr.execute(query, params)
+            return cr.fetchone()
+
+    def take(self):
+        """为一次请求取一个令牌
+
+        当前线程本地没有剩余令牌时，从共享令牌桶一次取出一块(约 BLOCK_SECONDS 秒的令牌)，
+        并像 acquire 一样等待到这一块令牌可用，之后的请求直接使用本地令牌。
+        """
+        if self.max_rate <= 0:
+            return 0
+        remaining = getattr(self._local, 'tokens', 0)
+        if remaining > 0:
+            self._local.tokens = remaining - 1
+            return 0
+        wait = self.acquire(self.block_size)
+        self._local.tokens = self.block_size - 1
+        return wait
+
+    def acquire(self, count=1):
+        """获取令牌，令牌不足时阻塞等待，返回等待的秒数"""
+        if self.max_rate <= 0:
+            return 0
+        tokens, rate = self._execute("""
+            INSERT INTO wechat_api_rate_bucket AS b (app_id, tokens, rate, updated_at)
+            VALUES (%(app_id)s, %(max_rate)s - %(count)s, %(max_rate)s, clock_timestamp())
+            ON CONFLICT (app_id) DO UPDATE SET
+                rate = LEAST(%(max_rate)s, GREATEST(%(min_rate)s,
+                    b.rate + %(ramp)s * EXTRACT(EPOCH FROM clock_timestamp() - b.updated_at))),
+                tokens = LEAST(LEAST(%(max_rate)s, b.rate),
+                    b.tokens + b.rate * EXTRACT(EPOCH FROM clock_timestamp() - b.updated_at)) - %(count)s,
+                updated_at = clock_timestamp()
+            RETURNING tokens, rate
+        """, {
+            'app_id': self.app_id,
+            'max_rate': self.max_rate,
+            'min_rate': self.min_rate,
+            'ramp': self.ramp,
+            'count': count,
+        })
+        wait = -tokens / rate if tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def throttled(self):
+        """收到限流错误码后退避：速率减半并清空剩余令牌
+
+        并发请求同时被限流时，一秒内只退避一次。
+        """
+        if self.max_rate <= 0:
+            return
+        # 本线程已取出的令牌按退避前的速率计算，不再使用
+        self._local.tokens = 0
+        row = self._execute("""
+            UPDATE wechat_api_rate_bucket
+               SET rate = GREATEST(%s, rate / 2),
+                   tokens = LEAST(tokens, 0),
+                   updated_at = clock_timestamp(),
+                   throttled_at = clock_timestamp()
+             WHERE app_id = %s
+               AND (throttled_at IS NULL OR throttled_at < clock_timestamp() - interval '1 second')
+            RETURNING rate
+        """, (self.min_rate, self.app_id))
+        if row:
+            _logger.warning("微信接口触发频率限制，app_id %s 速率降至 %.2f 次/秒", self.app_id, row[0])
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Dict, Any, Iterable, Iterator, List, Optional, Union
+from urllib.parse import urlsplit, parse_qsl, urlencode, urlunsplit
+from requests.adapters import HTTPAdapter
+from .rate_limiter import THROTTLE_ERRCODES
+from .circuit_breaker import CIRCUIT_OPEN_ERRCODE, CIRCUIT_FAILURE_ERRCODES
+
+_logger = logging.getLogger(__name__)
+
+JSON_HEADERS = {'Content-Type': 'application/json; charset=utf-8'}
+_TOUSER_PLACEHOLDER = '\x00touser\x00'
+
+# access_token 失效相关错误码：无效、过期、格式错误
+TOKEN_INVALID_ERRCODES = (40001, 40014, 42001)
+
+
+class CompiledTemplateMessage:
+    """预编译的模板消息请求
+
+    消息体只序列化一次并在touser处切分，发送时只需拼接经过JSON转义的openid。
+    """
+
+    def __init__(self, url: str, message_data: Dict[str, Any]):
+        self.url = url
+        body = json.dumps(dict(message_data, touser=_TOUSER_PLACEHOLDER), ensure_ascii=False)
+        prefix, suffix = body.split(json.dumps(_TOUSER_PLACEHOLDER), 1)
+        self._prefix = prefix.encode('utf-8')
+        self._suffix = suffix.encode('utf-8')
+
+    def render(self, openid: str) -> bytes:
+        """生成指定用户的请求体"""
+        return self._prefix + json.dumps(openid or '').encode('utf-8') + self._suffix
+
+
+class TemplateDispatcher:
+    """微信模板消息并发发送器
+
+    只负责HTTP请求，不访问ORM：每个工作线程持有独立的keep-alive会话，
+    发送结果按提交顺序返回给调用方，由调用方在主线程游标上落库。
+    传入共享限流器时，每次请求前先获取令牌，被限流的请求在退避后重试一次。
+    传入 token_refresher 时，access_token 失效的请求在刷新token后重发一次：
+    同一个失效token只刷新一次，之后的请求直接使用新token。
+    传入共享熔断器时，熔断期间的请求不发出，直接返回 CIRCUIT_OPEN_ERRCODE。
+    """
+
+    def __init__(self, max_workers: int = 4, timeout: int = 10, rate_limiter=None,
+                 token_refresher: Optional[Callable[[str], Optional[str]]] = None,
+                 circuit_breaker=None):
+        self.max_workers = max(1, int(max_workers or 1))
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.token_refresher = token_refresher
+        self.circuit_breaker = circuit_breaker
+        self._local = threading.local()
+        self._sessions: List[requests.Session] = []
+        self._lock = threading.Lock()
+        self._token_lock = threading.Lock()
+        self._refreshed_tokens: Dict[str, Optional[str]] = {}
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers,
+            thread_name_prefix='wechat_dispatch'
+        )
+
+    def _get_session(self) -> requests.Session:
+        """获取当前线程的HTTP会话"""
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            self._local.session = session
+            with self._lock:
+                self._sessions.append(session)
+        return session
+
+    def post(self, url: str, payload: Union[Dict[str, Any], bytes]) -> Dict[str, Any]:
+        """发送单条消息，熔断期间直接失败，结果回报给熔断器"""
+        if not self.circuit_breaker:
+            return self._post_refreshing(url, payload)
+        endpoint = urlsplit(url).path
+        permit = self.circuit_breaker.allow(endpoint)
+        if not permit:
+            return {'errcode': CIRCUIT_OPEN_ERRCODE, 'errmsg': '微信接口熔断中，请求未发出'}
+        result = self._post_refreshing(url, payload)
+        self.circuit_breaker.record(endpoint, result.get('errcode') not in CIRCUIT_FAILURE_ERRCODES,
+                                    probe=permit == 'probe')
+        return result
+
+    def _post_refreshing(self, url: str, payload: Union[Dict[str, Any], bytes]) -> Dict[str, Any]:
+        """按限流器控制速率发送，token失效时刷新后重发"""
+        if not self.token_refresher:
+            return self._post_limited(url, payload)
+        url = self._replace_token(url, self._refreshed_tokens.get(self._get_token(url)))
+        result = self._post_limited(url, payload)
+        if result.get('errcode') in TOKEN_INVALID_ERRCODES:
+            fresh_token = self._refresh_token(self._get_token(url))
+            if fresh_token:
+                result = self._post_limited(self._replace_token(url, fresh_token), payload)
+        return result
+
+    def _post_limited(self, url: str, payload: Union[Dict[str, Any], bytes]) -> Dict[str, Any]:
+        """经过限流器发送单条消息，被限流时退避后重试一次"""
+        if not self.rate_limiter:
+            return self._post(url, payload)
+        for attempt in range(2):
+            self.rate_limiter.take()
+            result = self._post(url, payload)
+            if result.get('errcode') not in THROTTLE_ERRCODES:
+                break
+            self.rate_limiter.throttled()
+        return result
+
+    def _refresh_token(self, stale_token: str) -> Optional[str]:
+        """刷新失效的token，同一失效token在所有工作线程间只刷新一次"""
+        with self._token_lock:
+            if stale_token not in self._refreshed_tokens:
+                try:
+                    fresh_token = self.token_refresher(stale_token)
+                except Exception as e:
+                    _logger.error(f"刷新微信access_token失败: {str(e)}")
+                    fresh_token = None
+                self._refreshed_tokens[stale_token] = fresh_token if fresh_token != stale_token else None
+                if self._refreshed_tokens[stale_token]:
+                    _logger.warning("微信access_token在发送过程中失效，已刷新并重发失败的请求")
+            return self._refreshed_tokens[stale_token]
+
+    @staticmethod
+    def _get_token(url: str) -> Optional[str]:
+        return dict(parse_qsl(urlsplit(url).query)).get('access_token')
+
+    @staticmethod
+    def _replace_token(url: str, access_token: Optional[str]) -> str:
+        if not access_token:
+            return url
+        parts = urlsplit(url)
+        query = dict(parse_qsl(parts.query), access_token=access_token)
+        return urlunsplit(parts._replace(query=urlencode(query)))
+
+    def _post(self, url: str, payload: Union[Dict[str, Any], bytes]) -> Dict[str, Any]:
+        """发送单条消息，异常统一转换为errcode=-1
+
+        payload 可以是字典，也可以是预编译模板生成的JSON字节串。
+        """
+        try:
+            session = self._get_session()
+            if isinstance(payload, bytes):
+                response = session.post(url, data=payload, headers=JSON_HEADERS, timeout=self.timeout)
+            else:
+                response = session.post(url, json=payload, timeout=self.timeout)
+            response.raise_for_status()
+            return response.json()
+        except Exception as e:
+            _logger.error(f"发送微信消息异常: {str(e)}")
+            return {'errcode': -1, 'errmsg': str(e)}
+
+    def map(self, url: str, payloads: Iterable[Union[Dict[str, Any], bytes]]) -> Iterator[Dict[str, Any]]:
+        """并发发送一批消息，按输入顺序返回结果"""
+        return self._executor.map(partial(self.post, url), payloads)
+
+    def close(self) -> None:
+        """关闭线程池和所有HTTP会话"""
+        self._executor.shutdown(wait=True)
+        if self.circuit_breaker:
+            self.circuit_breaker.flush()
+        with self._lock:
+            for session in self._sessions:
+                session.close()
+            self._sessions = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()